@@ -77,9 +77,10 @@ class Profile(models.Model):
             """
         if self.thumbnail_img.name != "default_profile.png":
             return self.thumbnail_img.url
-        elif hasattr(self.user.socialaccount_set.last(), 'extra_data'):
-            if 'properties' in self.user.socialaccount_set.last().extra_data:
-                return self.user.socialaccount_set.last().extra_data['properties'].get('thumbnail')
+        social_account = self.user.socialaccount_set.last()  # query once (chat.user_cards does the same in bulk)
+        if hasattr(social_account, 'extra_data'):
+            if 'properties' in social_account.extra_data:
+                return social_account.extra_data['properties'].get('thumbnail')
         else:
             return self.thumbnail_img.url
 
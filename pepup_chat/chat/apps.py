@@ -1,5 +1,44 @@
 from django.apps import AppConfig
+from django.core import checks
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_migrate, post_save
 
 
 class ChatConfig(AppConfig):
     name = 'chat'
+
+    def ready(self):
+        from django.contrib.auth import get_user_model
+
+        from accounts.models import Profile
+        from chat import context, db_pool, index_audit, journal, log, metrics, room_state, user_cards
+        from chat.models import ChatMessage, ChatRoom, ChatRoomParticipant
+        from chat.search import signals as search_signals
+
+        post_save.connect(search_signals.index_chat_message, sender=ChatMessage,
+                          dispatch_uid='chat_search_index_message')
+        post_delete.connect(search_signals.remove_chat_message, sender=ChatMessage,
+                            dispatch_uid='chat_search_remove_message')
+        post_migrate.connect(search_signals.setup_search_backend, sender=self,
+                             dispatch_uid='chat_search_setup_backend')
+        for model in (get_user_model(), Profile):
+            post_save.connect(user_cards.invalidate_user_card_on_change, sender=model,
+                              dispatch_uid='chat_user_card_invalidate_save_{}'.format(model.__name__))
+            post_delete.connect(user_cards.invalidate_user_card_on_change, sender=model,
+                                dispatch_uid='chat_user_card_invalidate_delete_{}'.format(model.__name__))
+        for model in (ChatRoom, ChatRoomParticipant):
+            post_save.connect(context.notify_room_changed_on_save, sender=model,
+                              dispatch_uid='chat_context_room_changed_save_{}'.format(model.__name__))
+            post_delete.connect(context.notify_room_changed_on_save, sender=model,
+                                dispatch_uid='chat_context_room_changed_delete_{}'.format(model.__name__))
+        connection_created.connect(index_audit.install_query_capture,
+                                   dispatch_uid='chat_index_audit_query_capture')
+        connection_created.connect(metrics.install_query_counter,
+                                   dispatch_uid='chat_metrics_query_counter')
+        connection_created.connect(db_pool.track_connection,
+                                   dispatch_uid='chat_db_pool_track_connection')
+        checks.register(room_state.check_room_state_cache)
+        db_pool.install()
+        metrics.start_periodic_log()
+        journal.install()
+        log.setup_queue_logging()
@@ -0,0 +1,243 @@
+# -*- encoding: utf-8 -*-
+import fcntl
+import gzip
+import json
+import os
+import re
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.core import serializers
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils import timezone
+
+from chat.models import ChatMessage
+
+"""
+오래된 ChatMessage를 압축 JSONL segment 파일로 옮기는(archive) 모듈입니다.
+
+- 저장 위치 : settings.CHAT_ARCHIVE['ROOT']
+    {ROOT}/room-{room_id}/{first_id:012d}-{last_id:012d}.jsonl.gz  : 닫힌 segment
+    {ROOT}/room-{room_id}/{first_id:012d}-open.jsonl.gz            : 아직 이어 쓰는 segment (room마다 하나)
+    {ROOT}/state.json   : 마지막으로 archive한 message id, 열린 segment의 확정된 크기 (resume용)
+- 진행 순서 (batch 단위, id 오름차순)
+    1. id > state.last_id 이고 created_at < cutoff 인 메세지를 batch_size만큼 가져옵니다.
+    2. room별 열린 segment에 gzip member 하나를 이어 붙입니다. (batch마다 파일을 새로 만들지 않습니다)
+    3. DB에서 해당 메세지를 삭제합니다.
+    4. state(last_id, 열린 segment 크기)를 갱신합니다.
+    5. SEGMENT_MAX_ROWS / SEGMENT_MAX_BYTES 를 넘은 segment는 {first_id}-{last_id} 이름으로 닫습니다.
+  어느 단계에서 중단되더라도, 다시 실행하면 열린 segment를 state에 기록된 크기까지 잘라내고 같은 batch를 다시 쓰므로 안전합니다.
+  (읽을 때도 state에 기록된 크기까지만 읽으므로 확정되지 않은 member는 보이지 않습니다)
+- 조회는 chat.history.fetch_room_history 를 사용하면 hot table -> archive 순으로 자연스럽게 이어집니다.
+"""
+
+DEFAULT_MAX_AGE_DAYS = 180
+DEFAULT_BATCH_SIZE = 5000
+DEFAULT_SEGMENT_MAX_ROWS = 50000
+DEFAULT_SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+
+_SEGMENT_RE = re.compile(r'^(\d+)-(\d+|open)\.jsonl\.gz$')
+
+
+def get_archive_config():
+    return getattr(settings, 'CHAT_ARCHIVE', {})
+
+
+class ArchiveStore(object):
+    """
+    segment 파일 읽기/쓰기를 담당합니다.
+    """
+
+    def __init__(self, root=None):
+        if root is None:
+            root = get_archive_config().get('ROOT', os.path.join(settings.BASE_DIR, '../../chat_archive'))
+        self.root = root
+
+    #
+    # state
+    #
+    @property
+    def state_path(self):
+        return os.path.join(self.root, 'state.json')
+
+    def load_state(self):
+        if not os.path.exists(self.state_path):
+            return {'last_id': 0}
+        with open(self.state_path) as f:
+            return json.load(f)
+
+    def save_state(self, state):
+        self._atomic_write(self.state_path, json.dumps(state).encode('utf-8'))
+
+    @contextmanager
+    def lock(self):
+        """
+        archive 작업이 동시에 두 개 이상 실행되지 않도록 합니다.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, '.lock'), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)  # raises BlockingIOError if locked
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    #
+    # segments
+    #
+    def _room_dir(self, room_id):
+        return os.path.join(self.root, 'room-{}'.format(room_id))
+
+    def _atomic_write(self, path, data):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+
+    def _open_segment_path(self, room_id, first_id):
+        return os.path.join(self._room_dir(room_id), '{:012d}-open.jsonl.gz'.format(first_id))
+
+    def _closed_segment_path(self, room_id, first_id, last_id):
+        return os.path.join(self._room_dir(room_id), '{:012d}-{:012d}.jsonl.gz'.format(first_id, last_id))
+
+    def append_segment(self, state, room_id, chat_msgs):
+        """
+        room의 열린 segment에 chat_msgs를 gzip member 하나로 이어 붙이고 state['open_segments']를 갱신합니다.
+        state에 기록된 크기 뒤의 내용(state를 저장하기 전에 중단된 실행이 쓴 것)은 잘라내고 씁니다.
+        :param chat_msgs: 한 room의 메세지 (id 오름차순)
+        """
+        open_segments = state.setdefault('open_segments', {})
+        segment = open_segments.get(str(room_id)) or {'first_id': chat_msgs[0].id, 'rows': 0, 'size': 0}
+        os.makedirs(self._room_dir(room_id), exist_ok=True)
+        lines = [json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False)
+                 for row in serializers.serialize('python', chat_msgs)]
+        data = gzip.compress(('\n'.join(lines) + '\n').encode('utf-8'))
+        path = self._open_segment_path(room_id, segment['first_id'])
+        with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+            f.truncate(segment['size'])
+            f.seek(segment['size'])
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        open_segments[str(room_id)] = {'first_id': segment['first_id'], 'last_id': chat_msgs[-1].id,
+                                       'rows': segment['rows'] + len(chat_msgs), 'size': segment['size'] + len(data)}
+
+    def close_full_segments(self, state, max_rows, max_bytes):
+        """
+        max_rows / max_bytes 에 도달한 열린 segment를 {first_id}-{last_id} 이름으로 닫습니다.
+        rename 후 state를 저장하기 전에 중단되었다면(열린 파일이 없다면) state에서만 지웁니다.
+        :return: state가 바뀌었으면 True
+        """
+        changed = False
+        open_segments = state.get('open_segments', {})
+        for room_id, segment in list(open_segments.items()):
+            path = self._open_segment_path(room_id, segment['first_id'])
+            if os.path.exists(path):
+                if segment['rows'] < max_rows and segment['size'] < max_bytes:
+                    continue
+                with open(path, 'r+b') as f:
+                    f.truncate(segment['size'])
+                os.rename(path, self._closed_segment_path(room_id, segment['first_id'], segment['last_id']))
+            del open_segments[room_id]
+            changed = True
+        return changed
+
+    def list_segments(self, room_id, state=None):
+        """
+        :param state: load_state() 결과. 열린 segment의 확정된 범위를 정합니다.
+        :return: list of (first_id, last_id, path, size), last_id 내림차순 (size가 None이면 파일 전체)
+        """
+        room_dir = self._room_dir(room_id)
+        if not os.path.isdir(room_dir):
+            return []
+        if state is None:
+            state = self.load_state()
+        open_segment = state.get('open_segments', {}).get(str(room_id))
+        segments = []
+        for filename in os.listdir(room_dir):
+            match = _SEGMENT_RE.match(filename)
+            if not match:
+                continue
+            first_id, path = int(match.group(1)), os.path.join(room_dir, filename)
+            if match.group(2) != 'open':
+                segments.append((first_id, int(match.group(2)), path, None))
+            elif open_segment is not None and open_segment['first_id'] == first_id:
+                segments.append((first_id, open_segment['last_id'], path, open_segment['size']))
+            # state에 없는 열린 segment는 아직 확정되지 않았으므로 읽지 않습니다.
+        segments.sort(key=lambda segment: segment[1], reverse=True)
+        return segments
+
+    def _read_segment(self, path, size=None):
+        with open(path, 'rb') as f:
+            data = f.read() if size is None else f.read(size)
+        rows = [json.loads(line) for line in gzip.decompress(data).decode('utf-8').splitlines() if line.strip()]
+        return [deserialized.object for deserialized in serializers.deserialize('python', rows)]
+
+    def read_room_messages(self, room_id, before_id=None, limit=50):
+        """
+        archive된 메세지를 최신순으로 읽습니다.
+        :return: list of ChatMessage (DB에 저장되어 있지 않은 instance; pk는 원래 값)
+        """
+        messages = []
+        for first_id, last_id, path, size in self.list_segments(room_id):
+            if before_id is not None and first_id >= before_id:
+                continue
+            chat_msgs = [chat_msg for chat_msg in self._read_segment(path, size)
+                         if before_id is None or chat_msg.id < before_id]
+            chat_msgs.reverse()
+            messages.extend(chat_msgs[:limit - len(messages)])
+            if len(messages) >= limit:
+                break
+        return messages
+
+
+def archive_messages(store=None, max_age_days=None, batch_size=None, max_batches=None, progress=None):
+    """
+    오래된 메세지를 archive합니다. 중단 후 다시 호출하면 state.json 부터 이어서 진행합니다.
+    :param progress: callable(batch_count, archived_count, last_id)
+    :return: archived message count
+    """
+    config = get_archive_config()
+    store = store or ArchiveStore()
+    if max_age_days is None:
+        max_age_days = config.get('MAX_AGE_DAYS', DEFAULT_MAX_AGE_DAYS)
+    if batch_size is None:
+        batch_size = config.get('BATCH_SIZE', DEFAULT_BATCH_SIZE)
+    max_rows = config.get('SEGMENT_MAX_ROWS', DEFAULT_SEGMENT_MAX_ROWS)
+    max_bytes = config.get('SEGMENT_MAX_BYTES', DEFAULT_SEGMENT_MAX_BYTES)
+    cutoff = timezone.now() - timedelta(days=max_age_days)
+
+    archived_count = 0
+    batch_count = 0
+    with store.lock():
+        state = store.load_state()
+        if store.close_full_segments(state, max_rows, max_bytes):
+            store.save_state(state)
+        while max_batches is None or batch_count < max_batches:
+            batch = list(ChatMessage.objects
+                         .filter(id__gt=state['last_id'], created_at__lt=cutoff)
+                         .order_by('id')[:batch_size])
+            if not batch:
+                break
+            room_messages = defaultdict(list)
+            for chat_msg in batch:
+                room_messages[chat_msg.room_id].append(chat_msg)
+            for room_id, chat_msgs in room_messages.items():
+                store.append_segment(state, room_id, chat_msgs)
+            with transaction.atomic():
+                ChatMessage.objects.filter(id__in=[chat_msg.id for chat_msg in batch]).delete()
+            state['last_id'] = batch[-1].id
+            store.save_state(state)
+            if store.close_full_segments(state, max_rows, max_bytes):
+                store.save_state(state)
+
+            batch_count += 1
+            archived_count += len(batch)
+            if progress:
+                progress(batch_count, archived_count, state['last_id'])
+    return archived_count
@@ -0,0 +1,224 @@
+# -*- encoding: utf-8 -*-
+import datetime
+import platform
+import statistics
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+
+import django
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.utils import timezone
+
+from chat.converters import ChatMessageUserDataSerializer
+from chat.message_models import ButtonsMessageTmpl, PostbackAction, TextChatMessageTmpl, UriAction
+from chat.models import ChatMessage, ChatRoom
+from chat.profile_models import ChatSource
+from chat.send_utils import MessageSender
+from chat.serializers import ChatMessageReadSerializer, ChatMessageWriteSerializer
+from chat.utils import MBunch, get_mocked_serializer_context
+
+"""
+hot function microbenchmark 모음입니다. (manage.py chat_benchmark / chat_benchmark_compare)
+
+- network(channel layer, redis)는 사용하지 않습니다.
+- DB가 필요한 benchmark(requires_db=True)는 transaction 안에서 실행 후 rollback하며,
+  ChatRoom이 하나도 없으면 건너뜁니다.
+- 결과는 JSON으로 저장되며, median 기준으로 이전 결과와 비교합니다.
+"""
+
+_benchmarks = OrderedDict()  # name -> (setup function, requires_db)
+
+
+def benchmark(name, requires_db=False):
+    """
+    setup 함수를 등록합니다. setup(fixture)은 측정할 0-인자 callable을 반환해야 합니다.
+    """
+    def decorator(setup):
+        _benchmarks[name] = (setup, requires_db)
+        return setup
+    return decorator
+
+
+class SkipBenchmark(Exception):
+    pass
+
+
+#
+# fixtures
+#
+class Fixture(object):
+    def __init__(self):
+        User = get_user_model()
+        self.room = ChatRoom.objects.select_related('owner').order_by('id').first()
+        self.user = self.room.owner if self.room else User(id=1)
+        self.room_id = self.room.id if self.room else 1
+        self.messages = [self._make_message(i) for i in range(100)]
+
+    def _make_message(self, i):
+        return ChatMessage(id=i + 1, message_type=1, room_id=self.room_id, text='benchmark message {}'.format(i),
+                           code='chat$chat', version=1, created_at=timezone.now(), token=uuid.uuid4(),
+                           template={}, extras={}, is_hidden=False)
+
+    def text_tmpl(self):
+        return TextChatMessageTmpl(source=ChatSource(user=self.user), text='hello').with_room_id(self.room_id)
+
+    def buttons_tmpl(self):
+        actions = [PostbackAction('menu$select', 'menu {}'.format(i), params={'index': i}) for i in range(4)]
+        actions.append(UriAction('home', 'https://pepup.world/'))
+        return ButtonsMessageTmpl(source=ChatSource(user=self.user), action_code='menu', actions=actions,
+                                  text='choose').with_room_id(self.room_id)
+
+
+class _PayloadCapturingSender(MessageSender):
+    """
+    channel layer 없이 deliver_messages의 payload 생성 비용만 측정합니다.
+    """
+
+    def _send_payload_to_group(self, payload, immediately):
+        self.payloads.append(payload)
+
+    def _send_payload_to_user(self, payload, target_user, target_handler_version, immediately):
+        self.payloads.append(payload)
+
+    def _send_payload_to_reply_channel(self, payload, immediately):
+        self.payloads.append(payload)
+
+
+#
+# benchmarks
+#
+@benchmark('read_serializer.single')
+def bench_read_serializer_single(fixture):
+    chat_msg = fixture.messages[0]
+    return lambda: ChatMessageReadSerializer(chat_msg).data
+
+
+@benchmark('read_serializer.many_100')
+def bench_read_serializer_many(fixture):
+    chat_msgs = fixture.messages
+    return lambda: ChatMessageReadSerializer(chat_msgs, many=True).data
+
+
+@benchmark('write_serializer.validate', requires_db=True)
+def bench_write_serializer_validate(fixture):
+    tmpl = fixture.text_tmpl()
+    return lambda: ChatMessageWriteSerializer(data=tmpl).is_valid(raise_exception=True)
+
+
+@benchmark('tmpl.save', requires_db=True)
+def bench_tmpl_save(fixture):
+    tmpl = fixture.text_tmpl()
+    return lambda: tmpl.save()
+
+
+@benchmark('tmpl.fake', requires_db=True)
+def bench_tmpl_fake(fixture):
+    tmpl = fixture.text_tmpl()
+    return lambda: tmpl.fake()
+
+
+@benchmark('tmpl.buttons_fake', requires_db=True)
+def bench_buttons_tmpl_fake(fixture):
+    tmpl = fixture.buttons_tmpl()
+    return lambda: tmpl.fake()
+
+
+@benchmark('user_data.convert', requires_db=True)
+def bench_user_data_convert(fixture):
+    room = MBunch(id=fixture.room_id, room_type='chat')
+    context = get_mocked_serializer_context(fixture.user, room, client_handler_version=1)
+    return lambda: ChatMessageUserDataSerializer(data={'text': 'hello'}, context=context).convert()
+
+
+@benchmark('sender.deliver_messages_100')
+def bench_deliver_messages(fixture):
+    sender = _PayloadCapturingSender(channel_layer=None, room_id=fixture.room_id, reply_channel=None)
+    sender._cache_room = MBunch(get_role_dict=lambda: {})
+    chat_msgs = fixture.messages
+
+    def run():
+        sender.payloads = []
+        sender.deliver_messages(chat_msgs)
+    return run
+
+
+#
+# runner
+#
+def _time_callable(func, number, repeat):
+    func()  # warm-up
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - started) / number * 1e6)
+    return timings
+
+
+def _autorange(func, target_seconds=0.2):
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        if time.perf_counter() - started >= target_seconds or number >= 100000:
+            return number
+        number *= 2
+
+
+def run_benchmarks(name_filter=None, repeat=5, number=None, progress=None):
+    """
+    :return: dict (JSON 저장용)
+    """
+    fixture = Fixture()
+    results = OrderedDict()
+    for name, (setup, requires_db) in _benchmarks.items():
+        if name_filter and name_filter not in name:
+            continue
+        try:
+            if requires_db and fixture.room is None:
+                raise SkipBenchmark('no ChatRoom fixture in database')
+            with transaction.atomic():
+                func = setup(fixture)
+                loops = number or _autorange(func)
+                timings = _time_callable(func, loops, repeat)
+                transaction.set_rollback(True)
+            results[name] = {
+                'median_us': statistics.median(timings),
+                'min_us': min(timings),
+                'number': loops,
+                'repeat': repeat,
+            }
+        except SkipBenchmark as e:
+            results[name] = {'skipped': str(e)}
+        except Exception:
+            results[name] = {'error': traceback.format_exc(limit=3)}
+        if progress:
+            progress(name, results[name])
+    return {
+        'meta': {
+            'created_at': datetime.datetime.utcnow().isoformat() + 'Z',
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'machine': platform.machine(),
+        },
+        'results': results,
+    }
+
+
+def compare_results(base, new, threshold=0.1):
+    """
+    :return: list of (name, base median, new median, ratio, regressed)
+    """
+    rows = []
+    for name, new_result in new['results'].items():
+        base_result = base['results'].get(name, {})
+        if 'median_us' not in new_result or 'median_us' not in base_result:
+            continue
+        ratio = new_result['median_us'] / base_result['median_us']
+        rows.append((name, base_result['median_us'], new_result['median_us'], ratio, ratio > 1 + threshold))
+    return rows
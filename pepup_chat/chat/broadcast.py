@@ -0,0 +1,144 @@
+# -*- encoding: utf-8 -*-
+import asyncio
+import json
+import uuid
+from collections import namedtuple
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from chat import metrics
+from chat.models import ChatMessage
+from chat.search import get_search_backend, is_search_enabled
+from chat.serializers import ChatMessageReadSerializer
+
+"""
+같은 template 메세지를 여러 방에 한 번에 보내는(broadcast) 모듈입니다. (공지 등, manage.py broadcast_chat_message)
+
+- 방 id 오름차순으로 chunk 단위로 진행합니다.
+    1. 방마다 ChatMessage를 1개씩 bulk_create 합니다.
+       token = uuid5(broadcast_id, room_id) 이므로, 같은 broadcast를 다시 실행해도 메세지가 중복 생성되지 않습니다.
+    2. payload는 chunk의 첫 메세지로 한 번만 serialize하고, 방마다 id / room_id / token 만 바꿉니다.
+    3. "room-{id}" group으로 group_send를 동시에 보냅니다. (CONCURRENCY 개까지)
+- 실패하면 BroadcastError.last_room_id 에 전송을 마친 마지막 방 id가 담깁니다.
+  같은 broadcast_id, resume_after=last_room_id 로 다시 호출하면 이어서 진행합니다.
+  (실패한 chunk의 방들은 다시 전송되므로 client는 token으로 중복을 걸러야 합니다)
+
+settings 예시:
+    CHAT_BROADCAST = {
+        'CHUNK_SIZE': 500,
+        'CONCURRENCY': 50,
+    }
+"""
+
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_CONCURRENCY = 50
+
+BroadcastResult = namedtuple('BroadcastResult', ['broadcast_id', 'room_count', 'last_room_id'])
+
+
+class BroadcastError(Exception):
+    def __init__(self, broadcast_id, last_room_id, cause):
+        super(BroadcastError, self).__init__('broadcast {} failed after room {}: {!r}'.format(
+            broadcast_id, last_room_id, cause))
+        self.broadcast_id = broadcast_id
+        self.last_room_id = last_room_id
+        self.cause = cause
+
+
+def get_broadcast_config():
+    return getattr(settings, 'CHAT_BROADCAST', {})
+
+
+def get_broadcast_token(broadcast_id, room_id):
+    return uuid.uuid5(broadcast_id, str(room_id))
+
+
+def _create_messages(message_kwargs, broadcast_id, room_ids, created_at):
+    """
+    :return: list of ChatMessage (pk 포함, room_ids 순서)
+    """
+    chat_msgs = [ChatMessage(room_id=room_id, token=get_broadcast_token(broadcast_id, room_id),
+                             created_at=created_at, **message_kwargs)
+                 for room_id in room_ids]
+    with transaction.atomic():
+        # 이미 만들어진 메세지(resume)는 token unique 제약으로 건너뜁니다.
+        ChatMessage.objects.bulk_create(chat_msgs, ignore_conflicts=True)
+        ids = dict(ChatMessage.objects.filter(token__in=[chat_msg.token for chat_msg in chat_msgs])
+                   .values_list('token', 'id'))
+        for chat_msg in chat_msgs:
+            chat_msg.id = ids[chat_msg.token]
+        if is_search_enabled():
+            # bulk_create는 post_save signal을 보내지 않으므로 직접 index합니다.
+            transaction.on_commit(lambda: get_search_backend().index_messages(chat_msgs))
+    return chat_msgs
+
+
+def _build_payloads(chat_msgs):
+    """
+    첫 메세지만 serialize하고, 나머지는 방마다 다른 값만 바꿔 끼웁니다.
+    :return: list of (room id, payload)
+    """
+    with metrics.stage_timer('serialize'):
+        base = dict(ChatMessageReadSerializer(chat_msgs[0]).data)
+        payloads = []
+        for chat_msg in chat_msgs:
+            message = dict(base, id=chat_msg.id, room_id=chat_msg.room_id, token=str(chat_msg.token))
+            payloads.append((chat_msg.room_id, json.dumps({'type': 'messages', 'messages': [message]})))
+    return payloads
+
+
+async def _group_send_many(channel_layer, payloads, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(room_id, payload):
+        async with semaphore:
+            with metrics.layer_call('group_send'):
+                await channel_layer.group_send('room-{}'.format(room_id),
+                                               {'type': 'chat.payload', 'text': payload, 'room_id': str(room_id)})
+
+    await asyncio.gather(*[send(room_id, payload) for room_id, payload in payloads])
+
+
+def broadcast_template(tmpl, rooms, broadcast_id=None, resume_after=None, chunk_size=None, concurrency=None,
+                       channel_layer=None, progress=None):
+    """
+    :param tmpl: MessageTmplBase (room은 지정하지 않아도 됩니다)
+    :param rooms: ChatRoom queryset
+    :param broadcast_id: 이어서 진행할 때 이전 broadcast_id (uuid.UUID)
+    :param resume_after: 이 방 id까지는 이미 전송한 것으로 보고 건너뜁니다.
+    :param progress: callable(room_count, last_room_id)
+    :return: BroadcastResult
+    :raises: BroadcastError, serializers.ValidationError
+    """
+    config = get_broadcast_config()
+    chunk_size = chunk_size or config.get('CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+    concurrency = concurrency or config.get('CONCURRENCY', DEFAULT_CONCURRENCY)
+    channel_layer = channel_layer or get_channel_layer()
+    broadcast_id = broadcast_id or uuid.uuid4()
+
+    message_kwargs = tmpl.to_message_kwargs(required=('message_type',))
+    message_kwargs.pop('room_id', None)
+    message_kwargs.pop('token', None)
+    created_at = tmpl.created_at or timezone.now()
+    send_many = async_to_sync(_group_send_many)
+
+    room_count = 0
+    last_room_id = resume_after or 0
+    while True:
+        room_ids = list(rooms.filter(id__gt=last_room_id).order_by('id').values_list('id', flat=True)[:chunk_size])
+        if not room_ids:
+            break
+        try:
+            chat_msgs = _create_messages(message_kwargs, broadcast_id, room_ids, created_at)
+            send_many(channel_layer, _build_payloads(chat_msgs), concurrency)
+        except Exception as e:
+            raise BroadcastError(broadcast_id, last_room_id, e)
+        room_count += len(room_ids)
+        last_room_id = room_ids[-1]
+        if progress:
+            progress(room_count, last_room_id)
+    return BroadcastResult(broadcast_id, room_count, last_room_id)
@@ -1,54 +1,330 @@
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from urllib.parse import parse_qs
 import json
+import re
+import time
 
-class ChatConsumer(AsyncWebsocketConsumer):
+from chat import metrics
+from chat.context import ConnectionContext
+from chat.executors import run_read
+from chat.heartbeat import HeartbeatMixin
+from chat.log import get_chat_logger
+from chat.ratelimit import Policy, RateLimiter, TokenBucket, classify_frame
+from chat.room_state import get_snapshot_payloads
+from chat.send_utils import get_group_names, matches_handler_version, tag_frame
+from core.routers import start_pin_scope
+
+
+def get_handler_version(scope):
+    """
+    접속 URL의 query string("?handler_version=N")에서 client handler version을 읽습니다.
+    """
+    query = parse_qs(scope.get('query_string', b'').decode('latin1'))
+    try:
+        return int(query['handler_version'][0])
+    except (KeyError, IndexError, ValueError):
+        return None
+
+
+class ChatConsumer(HeartbeatMixin, AsyncWebsocketConsumer):
     async def connect(self):
+        start_pin_scope()  # 이 접속에서 write한 뒤에는 잠시 primary에서 읽습니다. (core/routers.py)
         self.room_name = self.scope['url_route']['kwargs']['room_name']
-        self.room_group_name = 'chat_%s' % self.room_name
-        print('connect!!!!')
-        user = self.scope['user']
-        print('scope: ', user)
-        # Join room group
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
-        print('join group!!!')
+        user_id = self.user_id = getattr(self.scope['user'], 'id', None)
+        self.scope['handler_version'] = get_handler_version(self.scope)
+        # "room-{}" (+ "room-{}-user-{}") : send_utils / broadcast 와 같은 group 이름
+        self.group_names = get_group_names(self.room_name, user_id)
+        self.room_group_name = self.group_names[0]
+        self.log = get_chat_logger(room_id=self.room_name, user_id=user_id,
+                                   conn=self.channel_name, name=__name__)
+        self.rate_limiter = RateLimiter(self.channel_layer, user_id=user_id, room_id=self.room_name)
+        self.rate_limit_notified_until = 0.0
+        self.log.debug('connect', fields={'handler_version': self.scope['handler_version']})
+        # 방 / role / session / sender 는 접속하는 동안 재사용합니다. (chat/context.py)
+        self.context = ConnectionContext(self, self.room_name, self.scope['user'])
+        self.sender = self.context.sender
+        if not await self.context.load():
+            self.log.info('rejected', fields={'reason': 'room not found or inactive'})
+            await self.close()
+            return
+        # Join room (and user) group
+        for group_name in self.group_names:
+            with metrics.layer_call('group_add'):
+                await self.channel_layer.group_add(
+                    group_name,
+                    self.channel_name
+                )
         await self.accept()
-        print('accepted!!!!')
+        self.log.info('accepted')
+        await self.send_room_state_snapshots()
+
+    async def send_room_state_snapshots(self):
+        # 이후의 room_states는 patch로 오므로, 접속할 때 전체 상태를 먼저 보냅니다. (chat/room_state.py)
+        for payload in await run_read(get_snapshot_payloads, self.room_name, self.user_id):
+            await self.send(text_data=payload)
 
     async def disconnect(self, close_code):
-        # Leave room group
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
-        print('disconnected!!!')
+        # Leave room (and user) group
+        for group_name in getattr(self, 'group_names', ()):
+            with metrics.layer_call('group_discard'):
+                await self.channel_layer.group_discard(
+                    group_name,
+                    self.channel_name
+                )
+        self.log.info('disconnected', fields={'close_code': close_code})
 
     # Receive message from WebSocket
     async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        message = text_data_json['message']
-        print('receive-----message')
-        print(message)
-
-        # Send message to room group
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'chat_message',
-                'message': message
-            }
-        )
-        print('send!!')
+        with metrics.stage_timer('receive'), metrics.count_queries('inbound_message'):
+            with metrics.stage_timer('convert'):
+                text_data_json = json.loads(text_data)
+            if not self.context.is_active:
+                self.sender.send_error('room is not active')
+                return
+            frame_type = classify_frame(text_data_json)
+            decision = await self.rate_limiter.check(frame_type)
+            if not decision.allowed:
+                self.reject_frame(frame_type, decision)
+                return
+            if text_data_json.get('type') == 'resync_room_states':
+                await self.send_room_state_snapshots()
+                return
+            message = text_data_json['message']
+            self.log.debug('receive', fields={'message': message})
+
+            # Send message to room group
+            with metrics.stage_timer('group_send'), metrics.layer_call('group_send'):
+                await self.channel_layer.group_send(
+                    self.room_group_name,
+                    {
+                        'type': 'chat_message',
+                        'message': message,
+                        'room_id': self.room_name,
+                    }
+                )
+            self.log.debug('group_send')
+
+    def reject_frame(self, frame_type, decision):
+        self.log.info('rate limited', fields={'type': frame_type, 'scope': decision.scope,
+                                              'retry_after': decision.retry_after})
+        if self.rate_limiter.should_close():
+            self.sender.send_close()
+            return
+        # 거절 안내도 retry_after마다 한 번만 보냅니다.
+        now = time.monotonic()
+        if now < self.rate_limit_notified_until:
+            return
+        self.rate_limit_notified_until = now + max(decision.retry_after, 1.0)
+        self.sender.send_toast('메세지를 너무 빠르게 보내고 있어요. 잠시 후 다시 시도해 주세요.')
+        self.sender.send_error('rate limited: type={} scope={} retry_after={:.2f}s'.format(
+            frame_type, decision.scope, decision.retry_after))
+
+    # Room / participants changed (chat.context.notify_room_changed)
+    async def chat_room_changed(self, event):
+        await self.context.refresh()
+        self.log.debug('context refreshed', fields={'active': self.context.is_active})
 
     # Receive message from room group
     async def chat_message(self, event):
         message = event['message']
-        print('chat!!_-----messafgea')
-        print(message)
         # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'message': message
-        }))
-        print('chat sended!!!')
+        with metrics.stage_timer('serialize'):
+            text_data = json.dumps({
+                'message': message
+            })
+        with metrics.stage_timer('socket_send'):
+            await self.send(text_data=text_data)
+        self.log.debug('chat_message sent', fields={'message': message})
+
+    # Receive pre-encoded payload from room/user group (ex: MessageSender, chat.broadcast)
+    async def chat_payload(self, event):
+        if not matches_handler_version(event.get('handler_version'), self.scope['handler_version']):
+            # 다른 handler version으로 접속한 client에게 보낸 frame
+            self.log.debug('chat_payload skipped', fields={'handler_version': event['handler_version']})
+            return
+        with metrics.stage_timer('socket_send'):
+            await self.send(text_data=event['text'])
+        self.log.debug('chat_payload sent')
+
+
+
+#
+# Multiplexed connection ("ws/chat/")
+#
+ROOM_ID_RE = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')  # channel layer group 이름에 들어갈 수 있는 문자
+DEFAULT_MAX_ROOMS = 100
+DEFAULT_CONTROL_RATE = (5, 50)
+
+
+def get_multiplex_config():
+    return getattr(settings, 'CHAT_MULTIPLEX', {})
+
+
+class RoomSubscription(object):
+    __slots__ = ('room_id', 'group_names', 'context', 'sender', 'rate_limiter', 'log', 'rate_limit_notified_until')
+
+    def __init__(self, consumer, room_id, user_id):
+        self.room_id = room_id
+        self.group_names = get_group_names(room_id, user_id)
+        self.context = ConnectionContext(consumer, room_id, consumer.scope['user'], reply_room_id=room_id)
+        self.sender = self.context.sender
+        self.rate_limiter = RateLimiter(consumer.channel_layer, user_id=user_id, room_id=room_id,
+                                        connection_buckets=consumer.connection_buckets)
+        self.log = get_chat_logger(room_id=room_id, user_id=user_id, conn=consumer.channel_name, name=__name__)
+        self.rate_limit_notified_until = 0.0
+
+
+class MultiplexChatConsumer(HeartbeatMixin, AsyncWebsocketConsumer):
+    """
+    하나의 접속으로 여러 방을 구독합니다. (auth / session load는 접속할 때 한 번)
+    client -> server
+        {"type": "subscribe", "room": "<room id>"}
+        {"type": "unsubscribe", "room": "<room id>"}
+        {"room": "<room id>", "message": ...}       : ChatConsumer.receive 와 같은 frame에 "room"을 붙인 것
+        {"type": "ping", "identifier": ...}         : "room" 없이 바로 pong (chat/heartbeat.py)
+    server -> client
+        {"type": "subscribed" | "unsubscribed", "room": "<room id>"}
+        {"type": "error", "error": "..."}           : 방과 관계없는 오류
+        {"room": "<room id>", "frame": {...}}       : 방의 frame (ChatConsumer가 보내는 frame과 같음, send_utils.tag_frame)
+    group 이름은 ChatConsumer와 같으므로("room-{}", "room-{}-user-{}") MessageSender / broadcast를 그대로 사용합니다.
+    """
+
+    async def connect(self):
+        start_pin_scope()
+        self.user_id = getattr(self.scope['user'], 'id', None)
+        self.scope['handler_version'] = get_handler_version(self.scope)
+        self.subscriptions = {}  # room id -> RoomSubscription
+        self.connection_buckets = {}
+        self.control_bucket = TokenBucket(Policy(*get_multiplex_config().get('CONTROL_RATE', DEFAULT_CONTROL_RATE)))
+        self.log = get_chat_logger(user_id=self.user_id, conn=self.channel_name, name=__name__)
+        await self.accept()
+        self.log.info('accepted', fields={'multiplex': True, 'handler_version': self.scope['handler_version']})
+
+    async def disconnect(self, close_code):
+        for room_id in list(getattr(self, 'subscriptions', ())):
+            await self.unsubscribe(room_id)
+        self.log.info('disconnected', fields={'close_code': close_code})
+
+    async def send_control(self, frame):
+        await self.send(text_data=json.dumps(frame))
+
+    async def subscribe(self, room_id):
+        """
+        :return: None이면 구독 중, 아니면 오류 메세지
+        """
+        if room_id in self.subscriptions:
+            return None
+        if len(self.subscriptions) >= get_multiplex_config().get('MAX_ROOMS', DEFAULT_MAX_ROOMS):
+            return 'too many rooms'
+        subscription = RoomSubscription(self, room_id, self.user_id)
+        if not await subscription.context.load():
+            return 'room not found or inactive'
+        self.subscriptions[room_id] = subscription
+        for group_name in subscription.group_names:
+            with metrics.layer_call('group_add'):
+                await self.channel_layer.group_add(group_name, self.channel_name)
+        subscription.log.debug('subscribed')
+        return None
+
+    async def unsubscribe(self, room_id):
+        subscription = self.subscriptions.pop(room_id, None)
+        if subscription is None:
+            return
+        for group_name in subscription.group_names:
+            with metrics.layer_call('group_discard'):
+                await self.channel_layer.group_discard(group_name, self.channel_name)
+        subscription.log.debug('unsubscribed')
+
+    async def receive(self, text_data):
+        with metrics.stage_timer('receive'), metrics.count_queries('inbound_message'):
+            with metrics.stage_timer('convert'):
+                data = json.loads(text_data)
+            room_id = data.get('room')
+            room_id = None if room_id is None else str(room_id)
+            if room_id is None or not ROOM_ID_RE.match(room_id):
+                await self.send_control({'type': 'error', 'error': 'invalid room'})
+                return
+
+            frame_type = data.get('type')
+            if frame_type in ('subscribe', 'unsubscribe'):
+                if not self.control_bucket.take(time.monotonic()):
+                    await self.send_control({'type': 'error', 'error': 'rate limited', 'room': room_id})
+                    return
+                if frame_type == 'unsubscribe':
+                    await self.unsubscribe(room_id)
+                else:
+                    error = await self.subscribe(room_id)
+                    if error is not None:
+                        await self.send_control({'type': 'error', 'error': error, 'room': room_id})
+                        return
+                await self.send_control({'type': frame_type + 'd', 'room': room_id})
+                if frame_type == 'subscribe':
+                    await self.send_room_state_snapshots(room_id)
+                return
+
+            subscription = self.subscriptions.get(room_id)
+            if subscription is None:
+                await self.send_control({'type': 'error', 'error': 'not subscribed', 'room': room_id})
+                return
+            if not subscription.context.is_active:
+                subscription.sender.send_error('room is not active')
+                return
+            frame_type = classify_frame(data)
+            decision = await subscription.rate_limiter.check(frame_type)
+            if not decision.allowed:
+                self.reject_frame(subscription, frame_type, decision)
+                return
+            if data.get('type') == 'resync_room_states':
+                await self.send_room_state_snapshots(room_id)
+                return
+            message = data['message']
+            subscription.log.debug('receive', fields={'message': message})
+
+            with metrics.stage_timer('group_send'), metrics.layer_call('group_send'):
+                await self.channel_layer.group_send(subscription.group_names[0], {
+                    'type': 'chat_message',
+                    'message': message,
+                    'room_id': room_id,
+                })
+
+    async def send_room_state_snapshots(self, room_id):
+        for payload in await run_read(get_snapshot_payloads, room_id, self.user_id):
+            await self.send(text_data=tag_frame(room_id, payload))
+
+    def reject_frame(self, subscription, frame_type, decision):
+        subscription.log.info('rate limited', fields={'type': frame_type, 'scope': decision.scope,
+                                                      'retry_after': decision.retry_after})
+        if subscription.rate_limiter.should_close():
+            subscription.sender.send_close()
+            return
+        now = time.monotonic()
+        if now < subscription.rate_limit_notified_until:
+            return
+        subscription.rate_limit_notified_until = now + max(decision.retry_after, 1.0)
+        subscription.sender.send_toast('메세지를 너무 빠르게 보내고 있어요. 잠시 후 다시 시도해 주세요.')
+        subscription.sender.send_error('rate limited: type={} scope={} retry_after={:.2f}s'.format(
+            frame_type, decision.scope, decision.retry_after))
+
+    async def chat_room_changed(self, event):
+        subscription = self.subscriptions.get(event.get('room_id'))
+        if subscription is not None:
+            await subscription.context.refresh()
+
+    async def chat_message(self, event):
+        room_id = event.get('room_id')
+        if room_id not in self.subscriptions:
+            return  # unsubscribe 직전에 보낸 frame
+        with metrics.stage_timer('serialize'):
+            text_data = tag_frame(room_id, json.dumps({'message': event['message']}))
+        with metrics.stage_timer('socket_send'):
+            await self.send(text_data=text_data)
+
+    async def chat_payload(self, event):
+        room_id = event.get('room_id')
+        if room_id not in self.subscriptions:
+            return
+        if not matches_handler_version(event.get('handler_version'), self.scope['handler_version']):
+            return
+        with metrics.stage_timer('socket_send'):
+            await self.send(text_data=tag_frame(room_id, event['text']))
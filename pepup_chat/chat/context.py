@@ -0,0 +1,88 @@
+# -*- encoding: utf-8 -*-
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+from chat import metrics
+from chat.executors import run_read
+from chat.models import ChatRoom
+from chat.send_utils import ConsumerReplyChannel, MessageSender
+
+"""
+접속(consumer) 하나가 계속 사용하는 방 정보입니다.
+
+- ConnectionContext : 접속할 때 한 번 만들고 load 합니다. (query 2번 : 방, 참여자 role)
+    - room / role_dict / session_data / sender(MessageSender) 를 접속이 끝날 때까지 재사용합니다.
+      sender는 room과 role_dict를 들고 있으므로 전송할 때 DB를 읽지 않습니다.
+    - is_active : ChatRoom.active 를 DB 대신 이 cache에서 확인합니다.
+- 방이나 참여자가 바뀌면 notify_room_changed가 "room-{}" group에 chat.room_changed event를 보내고,
+  consumer는 context를 다시 load 합니다. (AppConfig.ready 에서 ChatRoom / ChatRoomParticipant signal 연결)
+"""
+
+# serializer context로 넘길 session 값 (ex: ChatMessageReadSerializer의 screen_width)
+SESSION_CONTEXT_KEYS = ('screen_width',)
+
+
+def load_room_context(room_id, session=None):
+    """
+    :return: (ChatRoom or None, role dict, session data)
+    """
+    session_data = {}
+    if session is not None:
+        session_data = {key: session[key] for key in SESSION_CONTEXT_KEYS if key in session}
+    try:
+        room = ChatRoom.objects.get(id=room_id)
+    except (ChatRoom.DoesNotExist, ValueError):
+        return None, {}, session_data
+    return room, room.get_role_dict(), session_data
+
+
+class ConnectionContext(object):
+
+    def __init__(self, consumer, room_id, user, reply_room_id=None):
+        """
+        :param reply_room_id: reply frame에 붙일 방 id (MultiplexChatConsumer)
+        """
+        self.consumer = consumer
+        self.room_id = room_id
+        self.user = user
+        self.room = None
+        self.role_dict = {}
+        self.session_data = {}
+        self.sender = MessageSender(consumer.channel_layer, room_id,
+                                    ConsumerReplyChannel(consumer, room_id=reply_room_id))
+
+    @property
+    def is_active(self):
+        return self.room is not None and self.room.active
+
+    async def load(self):
+        """
+        :return: 방이 있고 active이면 True
+        """
+        with metrics.stage_timer('context_load'):
+            self.room, self.role_dict, self.session_data = await run_read(
+                load_room_context, self.room_id, self.consumer.scope.get('session'))
+        self.sender.session_data = self.session_data
+        self.sender.set_room(self.room, self.role_dict)
+        return self.is_active
+
+    refresh = load
+
+
+def notify_room_changed(room_id):
+    """
+    방에 접속한 consumer들에게 context를 다시 load하라고 알립니다. (commit 이후)
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    event = {'type': 'chat.room_changed', 'room_id': str(room_id)}
+    transaction.on_commit(lambda: async_to_sync(channel_layer.group_send)('room-{}'.format(room_id), event))
+
+
+def notify_room_changed_on_save(sender, instance, **kwargs):
+    """
+    ChatRoom / ChatRoomParticipant post_save, post_delete receiver.
+    """
+    notify_room_changed(instance.pk if isinstance(instance, ChatRoom) else instance.room_id)
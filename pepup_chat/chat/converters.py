@@ -1,6 +1,8 @@
 # -*- encoding: utf-8 -*-
 from rest_framework import serializers
 
+from chat import metrics
+from chat.journal import save_message
 from chat.message_models import (
     TextChatMessageTmpl,
     ImageChatMessageTmpl,
@@ -45,6 +47,7 @@ class ChatMessageUserDataSerializer(serializers.Serializer):
     def get_source(self, data):
         return ChatSource(user=self.context['request'].user)
 
+    @metrics.timed_stage('convert')
     def convert(self):
         """
         :return: ChatMessage instance
@@ -79,9 +82,10 @@ class ChatMessageUserDataSerializer(serializers.Serializer):
         else:
             message_tmpl = UserPostbackChatMessageTmpl(source=chat_source, code=code,
                                                        text=text, image_key=image_key, extras=extras)
-        chat_msg_instance = (message_tmpl
-                             .with_room_id(room_id=room.id)
-                             .with_postback_parent_id(postback_parent_id)
-                             .with_client_handler_version(client_handler_version)
-                             .save())
+        message_tmpl = (message_tmpl
+                        .with_room_id(room_id=room.id)
+                        .with_postback_parent_id(postback_parent_id)
+                        .with_client_handler_version(client_handler_version))
+        with metrics.stage_timer('save'):
+            chat_msg_instance = save_message(message_tmpl)  # CHAT_JOURNAL이 켜져 있으면 write-behind (pk 없음)
         return chat_msg_instance
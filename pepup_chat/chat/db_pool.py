@@ -0,0 +1,226 @@
+# -*- encoding: utf-8 -*-
+import asyncio
+import logging
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+from chat import metrics
+
+"""
+chat worker(ASGI)의 DB connection pool 입니다. (settings.CHAT_DB_POOL['ENABLED'])
+
+database_sync_to_async 는 event loop의 default executor에서 실행되고, thread마다 DB connection을 하나씩 엽니다.
+CONN_MAX_AGE 없이 매 호출마다 connection을 닫으므로 트래픽이 몰리면 connect/close가 반복됩니다.
+
+- install() : SIZE개 thread의 PooledExecutor를 default executor로 지정하고, ALIASES의 CONN_MAX_AGE를 설정합니다.
+              -> worker thread마다 connection 하나를 계속 사용하므로, alias마다 connection은 최대 SIZE개입니다.
+- health check : HEALTH_CHECK_IDLE초 이상 쉬었던 connection은 작업 전에 is_usable()로 확인하고, 끊겼으면 닫습니다.
+                 (다음 ORM 호출이 새로 연결합니다)
+- reaper : REAP_INTERVAL마다, 종료된 thread가 열어둔 connection을 닫습니다. (pool 밖의 thread 포함)
+- metrics : chat_db_pool_size, chat_db_pool_busy, chat_db_pool_queue_depth, chat_db_pool_wait_ms,
+            chat_db_connections_open, chat_db_connections_reaped_total, chat_db_health_checks_total
+
+settings 예시:
+    CHAT_DB_POOL = {
+        'ENABLED': False,
+        'SIZE': 16,
+        'ALIASES': None,  # None이면 DATABASES 전체
+        'CONN_MAX_AGE': 300,
+        'HEALTH_CHECK_IDLE': 30,
+        'REAP_INTERVAL': 30,
+    }
+"""
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZE = 16
+DEFAULT_CONN_MAX_AGE = 300
+DEFAULT_HEALTH_CHECK_IDLE = 30
+DEFAULT_REAP_INTERVAL = 30
+
+
+def get_db_pool_config():
+    return getattr(settings, 'CHAT_DB_POOL', {})
+
+
+def get_pool_aliases():
+    aliases = get_db_pool_config().get('ALIASES')
+    return list(connections.databases) if aliases is None else aliases
+
+
+#
+# health check
+#
+_thread_state = threading.local()
+
+
+def check_idle_connections(aliases, idle_seconds):
+    """
+    현재 thread의 connection이 idle_seconds 이상 사용되지 않았다면 살아있는지 확인합니다.
+    """
+    last_used = getattr(_thread_state, 'last_used', None)
+    if last_used is None or time.monotonic() - last_used < idle_seconds:
+        return
+    for alias in aliases:
+        connection = connections[alias]
+        if connection.connection is None or connection.in_atomic_block:
+            continue
+        if connection.is_usable():
+            result = 'ok'
+        else:
+            connection.close()
+            result = 'closed'
+        metrics.registry.counter('chat_db_health_checks_total', 'Idle DB connection health checks',
+                                 alias=alias, result=result).inc()
+
+
+class PooledExecutor(ThreadPoolExecutor):
+    """
+    작업마다 대기 시간 / 대기 중인 작업 수 / 사용 중인 thread 수를 기록하고, 작업 전에 idle connection을 확인합니다.
+    """
+
+    def __init__(self, max_workers, aliases, health_check_idle, name='default'):
+        super(PooledExecutor, self).__init__(max_workers=max_workers, thread_name_prefix='chat-db-{}'.format(name))
+        self.name = name
+        self.aliases = aliases
+        self.health_check_idle = health_check_idle
+        self._busy = metrics.registry.gauge('chat_db_pool_busy', 'DB pool threads running a task', pool=name)
+        self._queued = metrics.registry.gauge('chat_db_pool_queue_depth', 'Tasks waiting for a DB pool thread',
+                                              pool=name)
+        self._wait = metrics.registry.histogram('chat_db_pool_wait_ms',
+                                                'Time a task waited for a DB pool thread in milliseconds', pool=name)
+        metrics.registry.gauge('chat_db_pool_size', 'DB pool threads (= persistent connections per alias)',
+                               pool=name).set(max_workers)
+
+    def submit(self, fn, *args, **kwargs):
+        self._queued.inc()
+        return super(PooledExecutor, self).submit(self._run, time.perf_counter(), fn, *args, **kwargs)
+
+    def _run(self, queued_at, fn, *args, **kwargs):
+        self._queued.dec()
+        self._wait.observe((time.perf_counter() - queued_at) * 1000)
+        self._busy.inc()
+        try:
+            check_idle_connections(self.aliases, self.health_check_idle)
+            return fn(*args, **kwargs)
+        finally:
+            _thread_state.last_used = time.monotonic()
+            self._busy.dec()
+
+
+#
+# reaper
+#
+class ConnectionRegistry(object):
+    """
+    connection(DatabaseWrapper)과 그 connection을 연 thread를 기록합니다.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}  # id(connection) -> (thread weakref, connection)
+
+    def track(self, connection):
+        with self._lock:
+            self._entries[id(connection)] = (weakref.ref(threading.current_thread()), connection)
+
+    def reap(self):
+        """
+        종료된 thread의 connection을 닫습니다.
+        :return: 닫은 connection 수
+        """
+        with self._lock:
+            entries = list(self._entries.items())
+        reaped = 0
+        open_count = 0
+        for key, (thread_ref, connection) in entries:
+            thread = thread_ref()
+            if thread is not None and thread.is_alive():
+                open_count += connection.connection is not None
+                continue
+            with self._lock:
+                self._entries.pop(key, None)
+            if connection.connection is not None:
+                _close_foreign(connection)
+                reaped += 1
+        metrics.registry.gauge('chat_db_connections_open', 'Open DB connections tracked by the pool').set(open_count)
+        if reaped:
+            metrics.registry.counter('chat_db_connections_reaped_total',
+                                     'DB connections closed after their thread exited').inc(reaped)
+            logger.info('closed %s DB connections left by finished threads', reaped)
+        return reaped
+
+
+def _close_foreign(connection):
+    # 다른 thread가 연 connection이므로 thread sharing을 잠시 허용하고 닫습니다.
+    connection.inc_thread_sharing()
+    try:
+        connection.close()
+    except DatabaseError:
+        logger.warning('failed to close leaked connection %s', connection.alias, exc_info=True)
+    finally:
+        connection.dec_thread_sharing()
+
+
+connection_registry = ConnectionRegistry()
+
+
+def track_connection(sender, connection, **kwargs):
+    """
+    connection_created receiver.
+    """
+    connection_registry.track(connection)
+
+
+_reaper_thread = None
+
+
+def start_reaper():
+    global _reaper_thread
+    interval = get_db_pool_config().get('REAP_INTERVAL', DEFAULT_REAP_INTERVAL)
+    if not interval or _reaper_thread is not None:
+        return
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                connection_registry.reap()
+            except Exception:
+                logger.exception('DB connection reaper failed')
+
+    _reaper_thread = threading.Thread(target=run, name='chat-db-reaper', daemon=True)
+    _reaper_thread.start()
+
+
+#
+# install
+#
+_executor = None
+
+
+def install(loop=None):
+    """
+    CHAT_DB_POOL['ENABLED']이면 pool을 event loop의 default executor로 지정합니다. (AppConfig.ready)
+    :return: PooledExecutor (사용하지 않으면 None)
+    """
+    global _executor
+    config = get_db_pool_config()
+    if not config.get('ENABLED', False):
+        return None
+    if _executor is None:
+        aliases = get_pool_aliases()
+        max_age = config.get('CONN_MAX_AGE', DEFAULT_CONN_MAX_AGE)
+        for alias in aliases:
+            # DatabaseWrapper.settings_dict는 alias마다 모든 thread가 공유하는 dict입니다.
+            connections.databases[alias]['CONN_MAX_AGE'] = max_age
+        _executor = PooledExecutor(max_workers=config.get('SIZE', DEFAULT_SIZE), aliases=aliases,
+                                   health_check_idle=config.get('HEALTH_CHECK_IDLE', DEFAULT_HEALTH_CHECK_IDLE))
+        start_reaper()
+    (loop or asyncio.get_event_loop()).set_default_executor(_executor)
+    return _executor
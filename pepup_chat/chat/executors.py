@@ -0,0 +1,149 @@
+# -*- encoding: utf-8 -*-
+import asyncio
+import contextvars
+import functools
+import threading
+import weakref
+
+from channels.auth import AuthMiddleware, get_user
+from channels.sessions import CookieMiddleware, SessionMiddleware
+from django.conf import settings
+from django.db import close_old_connections
+
+from chat import metrics
+from chat.db_pool import DEFAULT_HEALTH_CHECK_IDLE, PooledExecutor, get_db_pool_config, get_pool_aliases
+
+"""
+consumer의 sync ORM 작업을 종류별 executor에서 실행합니다. (database_sync_to_async 대체)
+
+database_sync_to_async 는 모든 작업을 하나의 default executor에서 실행하므로, 한 방의 느린 query가 다른 방의
+메세지 저장이나 접속(auth)까지 막습니다.
+
+- pool : 'write'(메세지 저장), 'read'(fetch / history), 'auth'(접속 시 user 조회)
+         consumer는 아직 메세지를 저장하지 않으므로(receive는 group_send만 합니다) 'write' pool을 쓰는 곳은 없습니다.
+         consumer에서 저장할 때는 run_write(journal.save_message, tmpl, room_id=...)를 사용하세요.
+         pool마다 thread 수(= 동시 실행 수)가 따로 있고, chat_db_pool_queue_depth{pool} 로 대기 작업 수를 봅니다.
+- run_in_pool(pool, func, *args, room_id=None, **kwargs)
+    room_id를 주면 같은 방의 작업은 들어온 순서대로 하나씩 실행됩니다. (방마다 asyncio.Lock, FIFO)
+    다른 방의 작업은 서로 기다리지 않습니다.
+- database_sync_to_async 와 같이 작업 전후로 close_old_connections()를 호출하고, contextvar를 전달합니다.
+- PooledAuthMiddlewareStack : AuthMiddlewareStack과 같지만 user 조회를 'auth' pool에서 실행합니다.
+    session / user 조회(pool 대기 포함) 시간은 stage_timer('auth')로 기록합니다.
+
+settings 예시:
+    CHAT_EXECUTORS = {
+        'POOLS': {'write': 8, 'read': 16, 'auth': 4},
+    }
+"""
+
+WRITE = 'write'
+READ = 'read'
+AUTH = 'auth'
+DEFAULT_POOL_SIZES = {WRITE: 8, READ: 16, AUTH: 4}
+
+
+def get_executors_config():
+    return getattr(settings, 'CHAT_EXECUTORS', {})
+
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(pool):
+    """
+    :return: PooledExecutor (처음 사용할 때 만듭니다)
+    """
+    executor = _executors.get(pool)
+    if executor is None:
+        if pool not in DEFAULT_POOL_SIZES:
+            raise ValueError('unknown executor pool: {}'.format(pool))
+        with _executors_lock:
+            executor = _executors.get(pool)
+            if executor is None:
+                sizes = dict(DEFAULT_POOL_SIZES, **get_executors_config().get('POOLS', {}))
+                executor = PooledExecutor(
+                    max_workers=sizes[pool], aliases=get_pool_aliases(), name=pool,
+                    health_check_idle=get_db_pool_config().get('HEALTH_CHECK_IDLE', DEFAULT_HEALTH_CHECK_IDLE))
+                _executors[pool] = executor
+    return executor
+
+
+class RoomLocks(object):
+    """
+    room_id -> asyncio.Lock. 기다리거나 잡고 있는 작업이 없으면 lock은 사라집니다.
+    """
+
+    def __init__(self):
+        self._locks = weakref.WeakValueDictionary()
+
+    def get(self, room_id):
+        lock = self._locks.get(room_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[room_id] = lock
+        return lock
+
+    def __len__(self):
+        return len(self._locks)
+
+
+room_locks = RoomLocks()
+
+
+def _call_with_cleanup(context, func, args, kwargs):
+    close_old_connections()
+    try:
+        return context.run(func, *args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run_in_pool(pool, func, *args, room_id=None, **kwargs):
+    """
+    func(*args, **kwargs)를 pool thread에서 실행하고 결과를 돌려줍니다.
+    """
+    call = functools.partial(_call_with_cleanup, contextvars.copy_context(), func, args, kwargs)
+    loop = asyncio.get_event_loop()
+    if room_id is None:
+        return await loop.run_in_executor(get_executor(pool), call)
+    async with room_locks.get(room_id):
+        return await loop.run_in_executor(get_executor(pool), call)
+
+
+def run_write(func, *args, room_id, **kwargs):
+    return run_in_pool(WRITE, func, *args, room_id=room_id, **kwargs)
+
+
+def run_read(func, *args, **kwargs):
+    return run_in_pool(READ, func, *args, **kwargs)
+
+
+def run_auth(func, *args, **kwargs):
+    return run_in_pool(AUTH, func, *args, **kwargs)
+
+
+def sync_to_pool(pool):
+    """
+    database_sync_to_async 처럼 사용하는 decorator 입니다.
+        @sync_to_pool(READ)
+        def fetch(room_id): ...
+        await fetch(room_id)
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def inner(*args, **kwargs):
+            return await run_in_pool(pool, func, *args, **kwargs)
+        return inner
+    return decorator
+
+
+class PooledAuthMiddleware(AuthMiddleware):
+    async def resolve_scope(self, scope):
+        # channels.auth.get_user는 database_sync_to_async로 감싼 함수이므로 원래 함수(.func)를 실행합니다.
+        with metrics.stage_timer('auth'):
+            scope['user']._wrapped = await run_auth(get_user.func, scope)
+
+
+def PooledAuthMiddlewareStack(inner):
+    return CookieMiddleware(SessionMiddleware(PooledAuthMiddleware(inner)))
@@ -0,0 +1,177 @@
+# -*- encoding: utf-8 -*-
+import asyncio
+import hashlib
+import time
+from collections import namedtuple
+
+import msgpack
+from channels.exceptions import ChannelFull
+
+from chat import metrics
+
+try:
+    from channels_redis.core import RedisChannelLayer
+except ImportError:  # channels_redis가 없는 환경 (InMemoryChannelLayer 등)
+    RedisChannelLayer = None
+
+"""
+group 전송(fan-out)을 group 하나당 Redis round-trip 한 번으로 처리하는 모듈입니다.
+
+channels_redis의 group_send는 group member 조회(ZRANGE) 후 shard마다 Lua script를 한 번 더 실행하고,
+기존 send_to_group(immediately=True)은 member마다 send를 호출했습니다. (member 수만큼 round-trip)
+여기서는 member 조회와 channel별 LPUSH를 하나의 Lua script 안에서 처리합니다.
+    - channels_redis 2.4의 저장 형식을 그대로 따릅니다. (channel key = prefix + non-local name, msgpack list)
+    - 같은 process의 channel들("specific.xxx!...")은 channels_redis와 같이 redis key 하나에 메세지 하나를 넣고,
+      __asgi_channel__ 에 channel 목록을 담습니다.
+    - 용량(capacity)을 넘은 channel은 script가 돌려주며, 그 channel만 layer.send로 재시도합니다.
+      재시도도 모두 실패하면 FanoutChannelFull(ChannelFull)을 발생시킵니다. (기존 send_to_group과 같음)
+- script를 쓸 수 없는 경우(Redis layer가 아님, 여러 host로 sharding, 암호화, channel별 capacity 설정)에는
+  layer.group_send로 보냅니다. (report.fallback=True)
+"""
+
+RETRY_COUNT = 3
+
+FanoutReport = namedtuple('FanoutReport', [
+    'group',
+    'member_count',  # None if fallback
+    'retried',  # 용량 초과로 재시도한 channel 목록
+    'failed',  # 재시도까지 실패한 channel 목록
+    'fallback',
+])
+
+
+class FanoutChannelFull(ChannelFull):
+    def __init__(self, report):
+        super(FanoutChannelFull, self).__init__('{} of {} channels over capacity in group {}'.format(
+            len(report.failed), report.member_count, report.group))
+        self.report = report
+
+
+# KEYS[1] : group key
+# ARGV[1] : channel key prefix           ARGV[2] : group member expiry cutoff (timestamp)
+# ARGV[3] : channel expiry (seconds)     ARGV[4] : channel capacity
+# ARGV[5] : packed message (non-local channel)
+# ARGV[6] : map header + packed "__asgi_channel__" (process-local channels)
+# ARGV[7] : packed message without map header (process-local channels)
+FANOUT_LUA = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], 0, ARGV[2])
+local channels = redis.call('ZRANGE', KEYS[1], 0, -1)
+local prefix = ARGV[1]
+local keys = {}
+local members = {}
+for _, channel in ipairs(channels) do
+    local bang = string.find(channel, '!', 1, true)
+    local key = prefix .. (bang and string.sub(channel, 1, bang) or channel)
+    if members[key] == nil then
+        table.insert(keys, key)
+        members[key] = {}
+    end
+    if bang then
+        table.insert(members[key], channel)
+    end
+end
+local capacity = tonumber(ARGV[4])
+local full = {}
+for _, key in ipairs(keys) do
+    local local_channels = members[key]
+    if redis.call('LLEN', key) < capacity then
+        if #local_channels > 0 then
+            redis.call('LPUSH', key, ARGV[6] .. cmsgpack.pack(local_channels) .. ARGV[7])
+        else
+            redis.call('LPUSH', key, ARGV[5])
+        end
+        redis.call('EXPIRE', key, ARGV[3])
+    elseif #local_channels > 0 then
+        for _, channel in ipairs(local_channels) do
+            table.insert(full, channel)
+        end
+    else
+        table.insert(full, string.sub(key, #prefix + 1))
+    end
+end
+return {#channels, full}
+"""
+FANOUT_LUA_SHA = hashlib.sha1(FANOUT_LUA.encode('utf-8')).hexdigest()
+
+
+def _map_header(size):
+    if size < 16:
+        return bytes([0x80 | size])
+    if size < 0x10000:
+        return b'\xde' + size.to_bytes(2, 'big')
+    return b'\xdf' + size.to_bytes(4, 'big')
+
+
+def pack_message(message):
+    """
+    :return: (non-local channel용 메세지, process-local channel용 head, process-local channel용 body)
+    """
+    packed = msgpack.packb(message, use_bin_type=True)
+    body = packed[len(_map_header(len(message))):]
+    local_head = _map_header(len(message) + 1) + msgpack.packb('__asgi_channel__', use_bin_type=True)
+    return packed, local_head, body
+
+
+def can_use_script(channel_layer):
+    return (RedisChannelLayer is not None
+            and isinstance(channel_layer, RedisChannelLayer)
+            and channel_layer.ring_size == 1
+            and not channel_layer.crypter
+            and not channel_layer.channel_capacity)
+
+
+async def _eval_fanout(connection, keys, args):
+    try:
+        return await connection.evalsha(FANOUT_LUA_SHA, keys=keys, args=args)
+    except Exception as e:
+        if 'NOSCRIPT' not in str(e):
+            raise
+        return await connection.eval(FANOUT_LUA, keys=keys, args=args)
+
+
+async def _send_with_retry(channel_layer, channel, message, retry_count):
+    for i in range(retry_count):
+        try:
+            with metrics.layer_call('send'):
+                await channel_layer.send(channel, dict(message))
+            return True
+        except ChannelFull:
+            if i == retry_count - 1:
+                return False
+            await asyncio.sleep(0.2 * (2 ** i))  # exponential delay
+    return False
+
+
+async def fanout_group_send(channel_layer, group, message, retry_count=RETRY_COUNT, raise_on_full=True):
+    """
+    :param group: group name
+    :param message: data to send (in dict)
+    :return: FanoutReport
+    :raises: FanoutChannelFull (raise_on_full=True 이고 재시도까지 실패한 channel이 있는 경우)
+    """
+    assert channel_layer.valid_group_name(group), 'Group name not valid'
+    if not can_use_script(channel_layer):
+        with metrics.layer_call('group_send'):
+            await channel_layer.group_send(group, message)
+        return FanoutReport(group, None, [], [], True)
+
+    packed, local_head, body = pack_message(message)
+    args = [channel_layer.prefix, int(time.time()) - channel_layer.group_expiry, int(channel_layer.expiry),
+            channel_layer.capacity, packed, local_head, body]
+    with metrics.layer_call('fanout'):
+        async with channel_layer.connection(0) as connection:
+            member_count, full = await _eval_fanout(connection, [channel_layer._group_key(group)], args)
+    retried = [channel.decode('utf8') if isinstance(channel, bytes) else channel for channel in full]
+
+    failed = []
+    if retried:
+        results = await asyncio.gather(*[_send_with_retry(channel_layer, channel, message, retry_count)
+                                         for channel in retried])
+        failed = [channel for channel, ok in zip(retried, results) if not ok]
+        if failed:
+            metrics.registry.counter('chat_fanout_failed_channels_total',
+                                     'Channels that did not receive a group message').inc(len(failed))
+    report = FanoutReport(group, member_count, retried, failed, False)
+    if failed and raise_on_full:
+        raise FanoutChannelFull(report)
+    return report
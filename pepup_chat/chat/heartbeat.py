@@ -0,0 +1,218 @@
+# -*- encoding: utf-8 -*-
+import asyncio
+import functools
+import json
+import math
+import time
+
+from django.conf import settings
+
+from chat import metrics
+
+"""
+ping / pong heartbeat를 consumer 앞단에서 처리합니다.
+
+접속의 대부분은 heartbeat만 보내는 idle 접속이므로, heartbeat는 receive()(rate limit / metrics / ORM)까지 가지 않습니다.
+- HeartbeatMixin.websocket_receive
+    {"type": "ping", "identifier": ...} 이면 바로 pong을 보내고, {"type": "pong", ...} 이면 무시합니다.
+    frame은 미리 만들어 둔 문자열을 사용합니다. (identifier만 json.dumps, 최근 identifier는 cache)
+- idle timeout : process(event loop)마다 하나의 TimerWheel이 TICK초마다 만료된 slot의 접속만 확인합니다.
+    - 접속마다 task / timer를 만들지 않고, frame을 받을 때는 마지막 수신 시각만 기록합니다.
+    - IDLE_TIMEOUT초 동안 받은 frame이 없으면 server ping(PING_FRAME)을 보내고,
+      그 뒤 PING_GRACE초 안에도 받은 frame이 없으면 IDLE_CLOSE_CODE로 접속을 닫습니다.
+    - IDLE_TIMEOUT이 0이면 idle 접속을 확인하지 않습니다.
+
+settings 예시:
+    CHAT_HEARTBEAT = {
+        'IDLE_TIMEOUT': 60,
+        'PING_GRACE': 10,
+        'TICK': 1.0,
+    }
+"""
+
+DEFAULT_IDLE_TIMEOUT = 60
+DEFAULT_PING_GRACE = 10
+DEFAULT_TICK = 1.0
+IDLE_CLOSE_CODE = 4408
+
+PING_FRAME = '{"type": "ping", "identifier": "server"}'
+PONG_FRAME = '{"type": "pong"}'
+
+# heartbeat frame은 짧으므로, 이보다 긴 frame은 json.loads 하지 않고 receive()로 넘깁니다.
+MAX_HEARTBEAT_LENGTH = 256
+
+
+def get_heartbeat_config():
+    return getattr(settings, 'CHAT_HEARTBEAT', {})
+
+
+@functools.lru_cache(maxsize=1024)
+def ping_frame(identifier):
+    return '{"type": "ping", "identifier": ' + json.dumps(identifier) + '}'
+
+
+@functools.lru_cache(maxsize=1024)
+def pong_frame(identifier=None):
+    if identifier is None:
+        return PONG_FRAME
+    return '{"type": "pong", "identifier": ' + json.dumps(identifier) + '}'
+
+
+def heartbeat_reply(text_data):
+    """
+    :return: (heartbeat frame 여부, 보낼 frame or None)
+    """
+    if len(text_data) > MAX_HEARTBEAT_LENGTH or ('"ping"' not in text_data and '"pong"' not in text_data):
+        return False, None
+    try:
+        data = json.loads(text_data)
+    except ValueError:
+        return False, None
+    if not isinstance(data, dict):
+        return False, None
+    frame_type = data.get('type')
+    if frame_type == 'ping':
+        identifier = data.get('identifier')
+        try:
+            return True, pong_frame(identifier)
+        except TypeError:  # unhashable identifier
+            return True, '{"type": "pong", "identifier": ' + json.dumps(identifier) + '}'
+    if frame_type == 'pong':
+        return True, None
+    return False, None
+
+
+class TimerWheel(object):
+    """
+    tick index -> 접속 set. 접속은 하나의 slot에만 들어 있고, frame을 받아도 slot을 옮기지 않습니다.
+    slot이 만료되면 마지막 수신 시각을 보고 다시 넣거나(ping / close) 합니다.
+    """
+
+    def __init__(self, idle_timeout, ping_grace, tick, clock=time.monotonic):
+        self.idle_timeout = idle_timeout
+        self.ping_grace = ping_grace
+        self.tick = tick
+        self.clock = clock
+        self._slots = {}
+        self._loop = None
+        self._handle = None
+        self._connections = metrics.registry.gauge('chat_heartbeat_connections',
+                                                   'Connections watched by the heartbeat timer wheel')
+        self._pings = metrics.registry.counter('chat_heartbeat_idle_pings_total', 'Server pings sent to idle connections')
+        self._closes = metrics.registry.counter('chat_heartbeat_idle_closes_total',
+                                                'Connections closed by the heartbeat idle timeout')
+
+    def __len__(self):
+        return sum(len(slot) for slot in self._slots.values())
+
+    def register(self, consumer):
+        consumer.heartbeat_seen_at = self.clock()
+        consumer.heartbeat_pinged = False
+        self._bind_loop()
+        self._schedule(consumer, consumer.heartbeat_seen_at + self.idle_timeout)
+        self._connections.inc()
+
+    def unregister(self, consumer):
+        index = getattr(consumer, 'heartbeat_slot', None)
+        if index is None:
+            return
+        consumer.heartbeat_slot = None
+        slot = self._slots.get(index)
+        if slot is not None:
+            slot.discard(consumer)
+            if not slot:
+                del self._slots[index]
+        self._connections.dec()
+
+    def touch(self, consumer):
+        consumer.heartbeat_seen_at = self.clock()
+
+    def _bind_loop(self):
+        loop = asyncio.get_event_loop()
+        if loop is not self._loop:
+            # 이전 loop의 접속은 더 이상 처리할 수 없습니다. (test 마다 새 loop)
+            if self._handle is not None:
+                self._handle.cancel()
+            self._loop, self._handle = loop, None
+            self._slots.clear()
+            self._connections.set(0)
+
+    def _schedule(self, consumer, deadline):
+        index = int(math.ceil(deadline / self.tick))
+        self._slots.setdefault(index, set()).add(consumer)
+        consumer.heartbeat_slot = index
+        if self._handle is None:
+            self._handle = self._loop.call_later(self.tick, self._run)
+
+    def _run(self):
+        self._handle = None
+        now = self.clock()
+        current = int(now / self.tick)
+        for index in sorted(index for index in self._slots if index <= current):
+            for consumer in self._slots.pop(index):
+                consumer.heartbeat_slot = None
+                self._expire(consumer, now)
+        if self._slots and self._handle is None:
+            self._handle = self._loop.call_later(self.tick, self._run)
+
+    def _expire(self, consumer, now):
+        if now - consumer.heartbeat_seen_at < self.idle_timeout:
+            consumer.heartbeat_pinged = False
+            self._schedule(consumer, consumer.heartbeat_seen_at + self.idle_timeout)
+        elif not consumer.heartbeat_pinged:
+            consumer.heartbeat_pinged = True
+            self._pings.inc()
+            self._loop.create_task(consumer.send(text_data=PING_FRAME))
+            self._schedule(consumer, now + self.ping_grace)
+        else:
+            self._connections.dec()
+            self._closes.inc()
+            self._loop.create_task(consumer.close(code=IDLE_CLOSE_CODE))
+
+
+_wheel = None
+
+
+def get_timer_wheel():
+    """
+    :return: TimerWheel (IDLE_TIMEOUT이 0이면 None)
+    """
+    global _wheel
+    config = get_heartbeat_config()
+    idle_timeout = config.get('IDLE_TIMEOUT', DEFAULT_IDLE_TIMEOUT)
+    if not idle_timeout:
+        return None
+    if _wheel is None:
+        _wheel = TimerWheel(idle_timeout, config.get('PING_GRACE', DEFAULT_PING_GRACE),
+                            config.get('TICK', DEFAULT_TICK))
+    return _wheel
+
+
+class HeartbeatMixin(object):
+    """
+    AsyncWebsocketConsumer 앞에 둡니다. (class ChatConsumer(HeartbeatMixin, AsyncWebsocketConsumer))
+    """
+    heartbeat_wheel = None
+
+    async def accept(self, subprotocol=None):
+        await super(HeartbeatMixin, self).accept(subprotocol)
+        self.heartbeat_wheel = get_timer_wheel()
+        if self.heartbeat_wheel is not None:
+            self.heartbeat_wheel.register(self)
+
+    async def websocket_receive(self, message):
+        if self.heartbeat_wheel is not None:
+            self.heartbeat_wheel.touch(self)
+        text_data = message.get('text')
+        if text_data is not None:
+            is_heartbeat, reply = heartbeat_reply(text_data)
+            if is_heartbeat:
+                if reply is not None:
+                    await self.send(text_data=reply)
+                return
+        await super(HeartbeatMixin, self).websocket_receive(message)
+
+    async def websocket_disconnect(self, message):
+        if self.heartbeat_wheel is not None:
+            self.heartbeat_wheel.unregister(self)
+        await super(HeartbeatMixin, self).websocket_disconnect(message)
@@ -0,0 +1,26 @@
+# -*- encoding: utf-8 -*-
+from chat.archive import ArchiveStore
+from chat.models import ChatMessage
+
+DEFAULT_FETCH_SIZE = 30
+
+
+def fetch_room_history(room_id, before_id=None, limit=DEFAULT_FETCH_SIZE, include_archive=True,
+                       with_template=True, with_extras=True):
+    """
+    방의 메세지를 최신순으로 가져옵니다.
+    hot table(ChatMessage)에서 부족한 만큼은 archive segment에서 이어서 읽습니다.
+    :param before_id: 이 id보다 오래된 메세지만 가져옵니다. (cursor)
+    :param with_template, with_extras: ChatMessageQuerySet.for_read 참고
+    :return: list of ChatMessage (id 내림차순)
+    """
+    queryset = (ChatMessage.objects.for_read(with_template=with_template, with_extras=with_extras)
+                .filter(room_id=room_id))
+    if before_id is not None:
+        queryset = queryset.filter(id__lt=before_id)
+    messages = list(queryset.order_by('-id')[:limit])
+    if include_archive and len(messages) < limit:
+        # cursor가 hot 범위를 지났으므로 archive로 넘어갑니다.
+        cursor = messages[-1].id if messages else before_id
+        messages += ArchiveStore().read_room_messages(room_id, before_id=cursor, limit=limit - len(messages))
+    return messages
@@ -0,0 +1,395 @@
+# -*- encoding: utf-8 -*-
+import atexit
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter, namedtuple
+
+from django.apps import apps
+from django.conf import settings
+from django.db import migrations, models
+from django.db.migrations.writer import MigrationWriter
+
+"""
+ChatMessage 등 chat table의 index를 점검하기 위한 도구입니다.
+
+1. runtime query capture
+    settings.CHAT_QUERY_CAPTURE['ENABLED'] 가 True이면, 실행되는 SQL의 WHERE/ORDER BY column을 pattern 단위로 세어
+    CHAT_QUERY_CAPTURE['PATH'] (JSON) 에 누적합니다. (SAMPLE_RATE 비율만 기록)
+2. audit (manage.py audit_chat_indexes)
+    선언된 index(model Meta)와 실제 DB index(introspection)를 capture된 pattern과 비교해서
+    - 중복 index (같은 column 조합, 또는 다른 index의 prefix)
+    - 사용되지 않는 index (leading column이 어떤 pattern에도 등장하지 않음)
+    - hot pattern에 필요한데 없는 composite index
+    를 보고하고, 이를 반영하는 migration을 생성합니다.
+    - migration은 DB 변경(RunSQL)과 model state 변경(AlterField / RemoveIndex / AlterIndexTogether)을
+      SeparateDatabaseAndState로 함께 기록하고, index 추가는 AddIndex로 기록합니다.
+      (state가 models.py와 어긋나지 않도록, 안내된 models.py 변경도 함께 반영해야 합니다)
+"""
+
+QueryPattern = namedtuple('QueryPattern', ['table', 'eq_columns', 'range_columns', 'order_columns'])
+IndexInfo = namedtuple('IndexInfo', ['name', 'table', 'columns', 'unique', 'primary_key', 'source'])
+
+_COLUMN_RE = r'"?(?P<table>\w+)"?\."?(?P<column>\w+)"?'
+_EQ_RE = re.compile(_COLUMN_RE + r'\s*(?:=|IN\s*\(|IS\s)', re.IGNORECASE)
+_RANGE_RE = re.compile(_COLUMN_RE + r'\s*(?:<|>|<=|>=|BETWEEN\s)', re.IGNORECASE)
+_ORDER_RE = re.compile(_COLUMN_RE + r'(?:\s+(?:ASC|DESC))?', re.IGNORECASE)
+_CLAUSE_END_RE = re.compile(r'\s(?:ORDER BY|LIMIT|GROUP BY|OFFSET|FOR UPDATE)\s', re.IGNORECASE)
+
+
+#
+# Query capture
+#
+def parse_query_pattern(sql):
+    """
+    Django가 만든 SQL에서 (table, eq columns, range columns, order columns)를 뽑아냅니다.
+    완전한 SQL parser가 아니므로, 알 수 없는 형태는 None을 반환합니다.
+    """
+    upper = sql.upper()
+    if not upper.startswith(('SELECT', 'UPDATE', 'DELETE')):
+        return None
+    where_at = upper.find(' WHERE ')
+    order_at = upper.find(' ORDER BY ')
+    if where_at < 0 and order_at < 0:
+        return None
+
+    tables = Counter()
+    eq_columns, range_columns, order_columns = set(), set(), []
+    if where_at >= 0:
+        where = sql[where_at + 7:]
+        end = _CLAUSE_END_RE.search(where)
+        if end:
+            where = where[:end.start()]
+        for match in _EQ_RE.finditer(where):
+            tables[match.group('table')] += 1
+            eq_columns.add(match.group('column'))
+        for match in _RANGE_RE.finditer(where):
+            tables[match.group('table')] += 1
+            range_columns.add(match.group('column'))
+    if order_at >= 0:
+        order = sql[order_at + 10:]
+        end = _CLAUSE_END_RE.search(' ' + order)
+        if end:
+            order = order[:max(0, end.start() - 1)]
+        for match in _ORDER_RE.finditer(order):
+            tables[match.group('table')] += 1
+            order_columns.append(match.group('column'))
+    if not tables:
+        return None
+    return QueryPattern(table=tables.most_common(1)[0][0],
+                        eq_columns=tuple(sorted(eq_columns)),
+                        range_columns=tuple(sorted(range_columns - eq_columns)),
+                        order_columns=tuple(order_columns))
+
+
+def pattern_key(pattern):
+    return '{}|eq:{}|range:{}|order:{}'.format(pattern.table, ','.join(pattern.eq_columns),
+                                               ','.join(pattern.range_columns), ','.join(pattern.order_columns))
+
+
+def parse_pattern_key(key):
+    table, eq, rng, order = key.split('|')
+
+    def _columns(part):
+        value = part.split(':', 1)[1]
+        return tuple(value.split(',')) if value else ()
+
+    return QueryPattern(table, _columns(eq), _columns(rng), _columns(order))
+
+
+class QueryPatternRecorder(object):
+    """
+    connection.execute_wrapper 로 설치되는 recorder입니다.
+    pattern별 실행 횟수를 메모리에 모았다가 flush_interval마다 파일에 합쳐 씁니다.
+    """
+
+    def __init__(self, path, sample_rate=1.0, flush_interval=30, tables=None):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.flush_interval = flush_interval
+        self.tables = tables
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+
+    def __call__(self, execute, sql, params, many, context):
+        if self.sample_rate >= 1 or random.random() < self.sample_rate:
+            pattern = parse_query_pattern(sql)
+            if pattern is not None and (self.tables is None or pattern.table in self.tables):
+                with self._lock:
+                    self.counts[pattern_key(pattern)] += 1
+                if time.time() - self._last_flush > self.flush_interval:
+                    self.flush()
+        return execute(sql, params, many, context)
+
+    def flush(self):
+        with self._lock:
+            counts, self.counts = self.counts, Counter()
+            self._last_flush = time.time()
+        if not counts:
+            return
+        merged = Counter(load_captured_patterns(self.path))
+        merged.update(counts)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(merged), f, indent=1, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+
+_recorder = None
+
+
+def get_capture_config():
+    return getattr(settings, 'CHAT_QUERY_CAPTURE', {})
+
+
+def install_query_capture(sender, connection, **kwargs):
+    """
+    connection_created receiver. CHAT_QUERY_CAPTURE['ENABLED'] 일 때 recorder를 연결합니다.
+    """
+    global _recorder
+    config = get_capture_config()
+    if not config.get('ENABLED', False):
+        return
+    if _recorder is None:
+        tables = set(model._meta.db_table for model in apps.get_app_config('chat').get_models())
+        _recorder = QueryPatternRecorder(path=config['PATH'],
+                                         sample_rate=config.get('SAMPLE_RATE', 1.0),
+                                         flush_interval=config.get('FLUSH_INTERVAL', 30),
+                                         tables=tables)
+        atexit.register(_recorder.flush)
+    if _recorder not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_recorder)
+
+
+def load_captured_patterns(path):
+    """
+    :return: dict of pattern_key -> count
+    """
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+#
+# Audit
+#
+def get_declared_indexes(model):
+    """
+    model Meta 기준으로 선언된 index 목록입니다. (DB에 실제로 만들어지지 않는 중복 선언도 포함)
+    """
+    meta = model._meta
+    table = meta.db_table
+    indexes = []
+    for field in meta.local_concrete_fields:
+        if field.primary_key:
+            continue
+        if field.unique:
+            indexes.append(IndexInfo('{}.{} (unique)'.format(model.__name__, field.name), table,
+                                     (field.column,), True, False, 'declared'))
+        if field.db_index:
+            indexes.append(IndexInfo('{}.{} (db_index)'.format(model.__name__, field.name), table,
+                                     (field.column,), False, False, 'declared'))
+    for unique, field_sets in ((True, meta.unique_together), (False, meta.index_together)):
+        for field_names in field_sets:
+            columns = tuple(meta.get_field(name).column for name in field_names)
+            kind = 'unique_together' if unique else 'index_together'
+            indexes.append(IndexInfo('{}.{} {}'.format(model.__name__, kind, field_names), table,
+                                     columns, unique, False, 'declared'))
+    for index in meta.indexes:
+        columns = tuple(meta.get_field(name.lstrip('-')).column for name in index.fields)
+        indexes.append(IndexInfo(index.name, table, columns, False, False, 'declared'))
+    return indexes
+
+
+def get_database_indexes(connection, model):
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, table)
+    indexes = []
+    for name, info in constraints.items():
+        if not info['columns'] or not (info['index'] or info['unique'] or info['primary_key']):
+            continue
+        indexes.append(IndexInfo(name, table, tuple(info['columns']), bool(info['unique']),
+                                 bool(info['primary_key']), 'database'))
+    return indexes
+
+
+def find_redundant_indexes(indexes):
+    """
+    :return: list of (redundant IndexInfo, covering IndexInfo, reason)
+    - 같은 column 조합의 index가 둘 이상이면, unique/primary가 아닌 쪽이 중복입니다.
+    - unique가 아닌 index의 column이 다른 index column의 prefix이면 중복입니다.
+    """
+    redundant = []
+    for index in indexes:
+        if index.primary_key or index.unique:
+            continue
+        for other in indexes:
+            if other is index:
+                continue
+            if other.columns == index.columns:
+                # 완전히 같은 경우, 한쪽만 중복으로 보고합니다.
+                if other.unique or other.primary_key or indexes.index(other) < indexes.index(index):
+                    redundant.append((index, other, 'duplicate'))
+                    break
+            elif other.columns[:len(index.columns)] == index.columns:
+                redundant.append((index, other, 'prefix'))
+                break
+    return redundant
+
+
+def _pattern_columns(pattern):
+    return set(pattern.eq_columns) | set(pattern.range_columns) | set(pattern.order_columns)
+
+
+def find_unused_indexes(indexes, patterns):
+    """
+    leading column이 capture된 어떤 pattern에도 쓰이지 않은 index 목록입니다.
+    """
+    used = set()
+    for pattern in patterns:
+        used |= _pattern_columns(pattern)
+    return [index for index in indexes
+            if not index.primary_key and not index.unique and index.columns[0] not in used]
+
+
+def recommend_indexes(indexes, weighted_patterns, min_count=1):
+    """
+    hot pattern마다 (equality columns + range/order column) composite index를 제안합니다.
+    이미 같은 prefix를 가진 index가 있으면 제안하지 않습니다.
+    :param weighted_patterns: list of (QueryPattern, count)
+    :return: list of (table, columns, count)
+    """
+    recommended = {}
+    for pattern, count in sorted(weighted_patterns, key=lambda item: -item[1]):
+        if count < min_count or not pattern.eq_columns:
+            continue
+        columns = tuple(pattern.eq_columns)
+        tail = pattern.range_columns[:1] or pattern.order_columns[:1]
+        if tail and tail[0] not in columns:
+            columns += tuple(tail)
+        if len(columns) < 2:
+            continue
+        covered = any(index.table == pattern.table and index.columns[:len(columns)] == columns
+                      for index in indexes)
+        key = (pattern.table, columns)
+        if not covered:
+            recommended[key] = recommended.get(key, 0) + count
+    return [(table, columns, count) for (table, columns), count in recommended.items()]
+
+
+def make_index_name(table, columns):
+    # Meta.indexes에 그대로 옮길 수 있도록 30자 이내로 만듭니다. (models.E034)
+    digest = hashlib.md5('{}:{}'.format(table, ','.join(columns)).encode('utf-8')).hexdigest()[:6]
+    return '{}_{}_{}'.format(table[:10], '_'.join(column[:6] for column in columns)[:12], digest)
+
+
+def build_index_sql(connection, drops, creates):
+    """
+    :param drops: list of IndexInfo (database index)
+    :param creates: list of (table, columns)
+    :return: (forward sql list, reverse sql list)
+    """
+    qn = connection.ops.quote_name
+    delete_template = connection.SchemaEditorClass.sql_delete_index
+
+    def create_sql(name, table, columns):
+        return 'CREATE INDEX {} ON {} ({})'.format(qn(name), qn(table), ', '.join(qn(column) for column in columns))
+
+    def delete_sql(name, table):
+        return delete_template % {'name': qn(name), 'table': qn(table)}
+
+    forward, reverse = [], []
+    for index in drops:
+        forward.append(delete_sql(index.name, index.table))
+        reverse.append(create_sql(index.name, index.table, index.columns))
+    for table, columns in creates:
+        name = make_index_name(table, columns)
+        forward.append(create_sql(name, table, columns))
+        reverse.append(delete_sql(name, table))
+    reverse.reverse()
+    return forward, reverse
+
+
+def _get_state_model(state_apps, table):
+    for model in state_apps.get_app_config('chat').get_models():
+        if model._meta.db_table == table:
+            return model
+    return None
+
+
+def _field_names(meta, columns):
+    by_column = {field.column: field.name for field in meta.local_concrete_fields}
+    return [by_column[column] for column in columns]
+
+
+def _drop_state_operations(meta, index):
+    """
+    database index를 만든 model state 선언을 찾아, 그 선언을 없애는 state operation을 만듭니다.
+    :return: (list of operations, models.py 변경 안내) - 선언이 없는 index(DB에만 있는 index)이면 ([], None)
+    """
+    for declared in meta.indexes:
+        if tuple(meta.get_field(name.lstrip('-')).column for name in declared.fields) == index.columns:
+            return ([migrations.RemoveIndex(model_name=meta.model_name, name=declared.name)],
+                    '{}.Meta.indexes: remove {!r}'.format(meta.object_name, declared.name))
+    if len(index.columns) == 1:
+        for field in meta.local_concrete_fields:
+            if field.column == index.columns[0] and field.db_index and not field.unique:
+                name, path, args, kwargs = field.deconstruct()
+                kwargs['db_index'] = False
+                return ([migrations.AlterField(model_name=meta.model_name, name=field.name,
+                                               field=field.__class__(*args, **kwargs))],
+                        '{}.{}: set db_index=False'.format(meta.object_name, field.name))
+    field_names = tuple(_field_names(meta, index.columns))
+    index_together = set(tuple(names) for names in meta.index_together)
+    if field_names in index_together:
+        index_together.discard(field_names)
+        return ([migrations.AlterIndexTogether(name=meta.model_name, index_together=index_together)],
+                '{}.Meta.index_together: remove {!r}'.format(meta.object_name, field_names))
+    return [], None
+
+
+def build_index_operations(connection, state_apps, drops, creates):
+    """
+    :param state_apps: 새 migration이 의존하는 시점의 model state (MigrationLoader.project_state().apps)
+    :param drops: list of IndexInfo (database index)
+    :param creates: list of (table, columns)
+    :return: (list of migration operations, list of models.py 변경 안내)
+    """
+    operations, notes = [], []
+    for index in drops:
+        [sql], [reverse_sql] = build_index_sql(connection, [index], [])
+        run_sql = migrations.RunSQL(sql, reverse_sql=reverse_sql)
+        model = _get_state_model(state_apps, index.table)
+        state_operations, note = _drop_state_operations(model._meta, index) if model else ([], None)
+        if state_operations:
+            operations.append(migrations.SeparateDatabaseAndState(database_operations=[run_sql],
+                                                                  state_operations=state_operations))
+            notes.append(note)
+        else:
+            operations.append(run_sql)
+    for table, columns in creates:
+        model = _get_state_model(state_apps, table)
+        name = make_index_name(table, columns)
+        fields = _field_names(model._meta, columns)
+        operations.append(migrations.AddIndex(model_name=model._meta.model_name,
+                                              index=models.Index(fields=fields, name=name)))
+        notes.append('{}.Meta.indexes: add models.Index(fields={!r}, name={!r})'.format(
+            model._meta.object_name, fields, name))
+    return operations, notes
+
+
+def render_migration(operations, dependency, name):
+    """
+    :return: migration file 내용 (MigrationWriter)
+    """
+    migration = migrations.Migration(name, 'chat')
+    migration.dependencies = [('chat', dependency)]
+    migration.operations = operations
+    return MigrationWriter(migration).as_string()
@@ -0,0 +1,307 @@
+# -*- encoding: utf-8 -*-
+import atexit
+import fcntl
+import json
+import logging
+import os
+import shutil
+import socket
+import threading
+import uuid
+
+from django.conf import settings
+from django.db import InterfaceError, OperationalError, close_old_connections, transaction
+from django.db.models import Case, DateTimeField, Value, When
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from chat import metrics
+from chat.models import ChatMessage
+from chat.search import get_search_backend, is_search_enabled
+from core.fields import dumps
+
+"""
+메세지 write-behind 저장 모듈입니다. (settings.CHAT_JOURNAL['ENABLED'])
+
+save_message(tmpl) :
+    - 사용 안 함 : tmpl.save() 와 같습니다. (INSERT 후 반환)
+    - 사용      : 메세지를 local journal 파일에 append(+fsync)하고, 저장되지 않은 ChatMessage를 바로 반환합니다.
+                  (id가 없으므로 client는 token으로 메세지를 구분합니다)
+    - 현재 save_message를 호출하는 곳은 ChatMessageUserDataSerializer.convert 뿐입니다.
+      consumer(receive)는 아직 메세지를 저장하지 않으므로, websocket으로 받은 메세지는 journal을 거치지 않습니다.
+journal :
+    {ROOT}/{host}-{pid}/{seq:012d}.log  : JSON lines, process마다 디렉토리 하나 (.lock 을 flock으로 잡고 있음)
+    - background flusher가 FLUSH_INTERVAL마다 현재 segment를 닫고, 닫힌 segment를 bulk_create 한 뒤 지웁니다.
+    - token unique 제약 + ignore_conflicts 이므로 같은 entry를 두 번 flush해도 메세지는 하나만 생깁니다.
+    - 시작할 때(AppConfig.ready -> install), lock이 풀린(= process가 죽은) 디렉토리의 segment를 모두 replay합니다.
+    - 저장할 수 없는 entry(지워진 방 등)는 {ROOT}/dead-letter/ 로 옮기고 나머지 entry는 계속 저장합니다.
+      (DB 연결 오류는 다음 flush에서 다시 시도합니다. dead-letter 파일을 journal 디렉토리로 옮기면 다시 replay됩니다)
+
+settings 예시:
+    CHAT_JOURNAL = {
+        'ENABLED': False,
+        'ROOT': '/var/lib/pepup_chat/journal',
+        'FLUSH_INTERVAL': 0.5,
+        'BATCH_SIZE': 500,
+        'FSYNC': True,
+    }
+"""
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FLUSH_INTERVAL = 0.5
+DEFAULT_BATCH_SIZE = 500
+DEAD_LETTER_DIRECTORY = 'dead-letter'
+
+# 다음 flush에서 다시 시도할 오류 (그 외의 오류는 entry 자체의 문제로 보고 dead-letter로 옮깁니다)
+TRANSIENT_ERRORS = (OperationalError, InterfaceError)
+
+
+def get_journal_config():
+    return getattr(settings, 'CHAT_JOURNAL', {})
+
+
+def _segment_paths(directory):
+    return sorted(os.path.join(directory, filename) for filename in os.listdir(directory)
+                  if filename.endswith('.log'))
+
+
+def _read_segment(path):
+    """
+    마지막 줄이 반쯤 쓰인 경우(crash)는 버립니다. (fsync 전에 죽었으므로 client에게 저장을 약속하지 않은 entry)
+    """
+    entries = []
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                logger.warning('skip broken journal line in %s', path)
+    return entries
+
+
+def _to_message(entry):
+    entry = dict(entry)
+    entry['created_at'] = parse_datetime(entry['created_at'])
+    entry['token'] = uuid.UUID(entry['token'])
+    return ChatMessage(**entry)
+
+
+def flush_entries(entries, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    journal entry를 DB에 저장합니다. 이미 저장된 entry(token)는 건너뜁니다.
+    :return: 저장을 시도한 entry 수
+    """
+    for start in range(0, len(entries), batch_size):
+        chat_msgs = [_to_message(entry) for entry in entries[start:start + batch_size]]
+        # bulk_create는 auto_now_add(pre_save)로 chat_msg.created_at을 덮어쓰므로, journal의 시각을 먼저 꺼내 둡니다.
+        created_at = {chat_msg.token: chat_msg.created_at for chat_msg in chat_msgs}
+        with metrics.stage_timer('journal_flush'), transaction.atomic():
+            ChatMessage.objects.bulk_create(chat_msgs, ignore_conflicts=True)
+            ChatMessage.objects.filter(token__in=list(created_at)).update(
+                created_at=Case(*[When(token=token, then=Value(value)) for token, value in created_at.items()],
+                                output_field=DateTimeField()))
+            if is_search_enabled():
+                ids = dict(ChatMessage.objects.filter(token__in=[chat_msg.token for chat_msg in chat_msgs])
+                           .values_list('token', 'id'))
+                for chat_msg in chat_msgs:
+                    chat_msg.id = ids.get(chat_msg.token)
+                indexed = [chat_msg for chat_msg in chat_msgs if chat_msg.id is not None]
+                # bulk_create는 post_save signal을 보내지 않으므로 직접 index합니다.
+                transaction.on_commit(lambda: get_search_backend().index_messages(indexed))
+    return len(entries)
+
+
+def write_dead_letter(root, path, entries):
+    directory = os.path.join(root, DEAD_LETTER_DIRECTORY)
+    os.makedirs(directory, exist_ok=True)
+    name = '{}-{}'.format(os.path.basename(os.path.dirname(path)), os.path.basename(path))
+    with open(os.path.join(directory, name), 'ab') as f:
+        for entry in entries:
+            f.write((dumps(entry) + '\n').encode('utf-8'))
+        f.flush()
+        os.fsync(f.fileno())
+    metrics.registry.counter('chat_journal_dead_letter_total',
+                             'Journal entries moved to the dead-letter directory').inc(len(entries))
+
+
+def flush_segment(root, path, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    segment 하나를 저장하고 지웁니다. 저장할 수 없는 entry는 dead-letter로 옮깁니다.
+    :return: entry 수
+    :raises: TRANSIENT_ERRORS (segment는 남겨두고 다음에 다시 시도합니다)
+    """
+    entries = _read_segment(path)
+    try:
+        flush_entries(entries, batch_size=batch_size)
+    except TRANSIENT_ERRORS:
+        raise
+    except Exception:
+        logger.exception('journal segment %s failed; retrying entries one by one', path)
+        dead = []
+        for entry in entries:
+            try:
+                flush_entries([entry])
+            except TRANSIENT_ERRORS:
+                raise
+            except Exception:
+                dead.append(entry)
+        if dead:
+            write_dead_letter(root, path, dead)
+            logger.error('moved %s journal entries from %s to %s', len(dead), path, DEAD_LETTER_DIRECTORY)
+    os.remove(path)
+    return len(entries)
+
+
+class MessageJournal(object):
+
+    def __init__(self, root=None, fsync=None):
+        config = get_journal_config()
+        self.root = root or config.get('ROOT', os.path.join(settings.BASE_DIR, '../../chat_journal'))
+        self.fsync = config.get('FSYNC', True) if fsync is None else fsync
+        self.directory = os.path.join(self.root, '{}-{}'.format(socket.gethostname(), os.getpid()))
+        self._lock = threading.Lock()
+        self._lock_file = None
+        self._file = None
+        self._seq = 0
+        self._pending = 0
+        self._flusher = None
+        self._stopped = threading.Event()
+
+    #
+    # writer
+    #
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock_file = open(os.path.join(self.directory, '.lock'), 'w')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        existing = _segment_paths(self.directory)
+        if existing:
+            self._seq = int(os.path.basename(existing[-1]).split('.')[0])
+        self._rotate()
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+        self._seq += 1
+        self._file = open(os.path.join(self.directory, '{:012d}.log'.format(self._seq)), 'ab')
+
+    def append(self, message_kwargs):
+        line = (dumps(message_kwargs) + '\n').encode('utf-8')
+        with metrics.stage_timer('journal_append'), self._lock:
+            self._file.write(line)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._pending += 1
+
+    #
+    # flusher
+    #
+    def flush(self):
+        """
+        현재 segment를 닫고, 닫힌 segment를 모두 DB에 저장한 뒤 지웁니다.
+        """
+        with self._lock:
+            if self._pending:
+                self._rotate()
+                self._pending = 0
+            current = self._file.name
+        batch_size = get_journal_config().get('BATCH_SIZE', DEFAULT_BATCH_SIZE)
+        for path in _segment_paths(self.directory):
+            if path == current:
+                continue
+            flush_segment(self.root, path, batch_size=batch_size)
+
+    def recover(self):
+        """
+        lock이 풀린 다른 journal 디렉토리(= 죽은 process)의 segment를 replay합니다.
+        """
+        batch_size = get_journal_config().get('BATCH_SIZE', DEFAULT_BATCH_SIZE)
+        for name in os.listdir(self.root):
+            directory = os.path.join(self.root, name)
+            if directory == self.directory or name == DEAD_LETTER_DIRECTORY or not os.path.isdir(directory):
+                continue
+            with open(os.path.join(directory, '.lock'), 'w') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # 살아있는 process의 journal
+                replayed = 0
+                for path in _segment_paths(directory):
+                    replayed += flush_segment(self.root, path, batch_size=batch_size)
+                logger.info('replayed %s journal entries from %s', replayed, directory)
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def _run(self):
+        interval = get_journal_config().get('FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL)
+        recovered = False
+        while True:
+            try:
+                if not recovered:
+                    self.recover()  # 시작하자마자 (첫 interval을 기다리지 않고) replay합니다.
+                    recovered = True
+                self.flush()
+            except Exception:
+                logger.exception('journal flush failed; will retry')
+            finally:
+                close_old_connections()
+            if self._stopped.wait(interval):
+                return
+
+    def start(self):
+        if self._file is None:
+            self.open()
+        self._flusher = threading.Thread(target=self._run, name='chat-journal-flusher', daemon=True)
+        self._flusher.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+def get_journal():
+    """
+    :return: MessageJournal (사용하지 않으면 None). 처음 호출될 때 journal을 열고 flusher를 시작합니다.
+    """
+    global _journal
+    if not get_journal_config().get('ENABLED', False):
+        return None
+    if _journal is None:
+        with _journal_lock:
+            if _journal is None:
+                journal = MessageJournal()
+                journal.start()
+                atexit.register(journal.stop)
+                _journal = journal
+    return _journal
+
+
+def install():
+    """
+    AppConfig.ready 에서 호출합니다. 사용하면 journal을 열고 flusher를 시작하여, 죽은 process의 journal을 바로 replay합니다.
+    (첫 save_message를 기다리지 않습니다)
+    """
+    get_journal()
+
+
+def save_message(tmpl):
+    """
+    MessageTmplBase.save() 대신 사용합니다.
+    :return: ChatMessage (write-behind이면 아직 저장되지 않아 pk가 없습니다)
+    :raises: serializers.ValidationError
+    """
+    journal = get_journal()
+    if journal is None:
+        return tmpl.save()
+    message_kwargs = tmpl.to_message_kwargs()
+    message_kwargs.setdefault('token', uuid.uuid4())
+    message_kwargs['created_at'] = tmpl.created_at or timezone.now()
+    journal.append(message_kwargs)
+    return ChatMessage(**message_kwargs)
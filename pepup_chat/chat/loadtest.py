@@ -0,0 +1,173 @@
+# -*- encoding: utf-8 -*-
+import asyncio
+import json
+import time
+from collections import namedtuple
+
+from channels.testing import WebsocketCommunicator
+
+from chat.models import ChatRoom
+from core.utils import percentile
+
+"""
+WebSocket chat 경로 load test harness 입니다. (manage.py chat_loadtest)
+
+ASGI application을 같은 process 안에서 WebsocketCommunicator로 띄우고,
+여러 방에 나누어 접속한 client들이 메세지를 보내고 받는 과정을 측정합니다.
+    - connect rate        : 초당 접속 완료 수, 접속 latency
+    - message throughput  : 초당 전송/수신 frame 수
+    - fan-out latency     : 송신 시각부터 같은 방의 각 client가 받기까지의 시간
+ChatConsumer는 DB에 없는 방의 접속을 거절하므로, create_load_test_rooms로 만든 방 id에 접속합니다.
+"""
+
+LoadTestConfig = namedtuple('LoadTestConfig', [
+    'clients',  # 전체 client 수
+    'room_size',  # 방 하나에 접속하는 client 수
+    'messages_per_client',
+    'send_interval',  # client별 메세지 전송 간격 (초)
+    'connect_concurrency',  # 동시에 진행하는 connect 수
+    'drain_timeout',  # 전송이 끝난 뒤 남은 frame을 기다리는 시간 (초)
+    'path_template',  # ex) '/ws/chat/{room}/' ({room} : ChatRoom id)
+])
+
+DEFAULT_CONFIG = LoadTestConfig(clients=1000, room_size=10, messages_per_client=10, send_interval=0.1,
+                                connect_concurrency=200, drain_timeout=10.0,
+                                path_template='/ws/chat/{room}/')
+
+
+def _summary(values, unit_scale=1000.0):
+    values = sorted(value * unit_scale for value in values)
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': values[-1],
+    }
+
+
+def create_load_test_rooms(config, owner_id):
+    """
+    :return: list of ChatRoom id (client room_size명마다 방 하나)
+    """
+    room_count = (config.clients + config.room_size - 1) // config.room_size
+    return [ChatRoom.objects.create(owner_id=owner_id).id for _ in range(room_count)]
+
+
+def delete_load_test_rooms(room_ids):
+    ChatRoom.objects.filter(id__in=room_ids).delete()
+
+
+class _Client(object):
+    def __init__(self, application, client_id, room, path):
+        self.client_id = client_id
+        self.room = room
+        self.communicator = WebsocketCommunicator(application, path)
+        self.latencies = []
+        self.received = 0
+        self.connected = False
+        self._receiver = None
+
+    async def connect(self):
+        self.connected, _ = await self.communicator.connect()
+        if self.connected:
+            self._receiver = asyncio.ensure_future(self._receive_loop())
+        return self.connected
+
+    async def _receive_loop(self):
+        while True:
+            try:
+                frame = await self.communicator.receive_from(timeout=3600)
+            except asyncio.TimeoutError:
+                continue
+            now = time.perf_counter()
+            try:
+                payload = json.loads(json.loads(frame)['message'])
+                self.latencies.append(now - payload['sent_at'])
+            except (ValueError, KeyError, TypeError):
+                pass
+            self.received += 1
+
+    async def send_messages(self, count, interval):
+        for seq in range(count):
+            message = json.dumps({'sent_at': time.perf_counter(), 'client': self.client_id, 'seq': seq})
+            await self.communicator.send_to(text_data=json.dumps({'message': message}))
+            if interval:
+                await asyncio.sleep(interval)
+
+    async def close(self):
+        if self._receiver is not None:
+            self._receiver.cancel()
+        await self.communicator.disconnect()
+
+
+async def run_load_test(application, room_ids, config=DEFAULT_CONFIG, progress=None):
+    """
+    :param room_ids: create_load_test_rooms 의 결과
+    :return: dict report
+    """
+    clients = [_Client(application, client_id, room_ids[client_id // config.room_size],
+                       config.path_template.format(room=room_ids[client_id // config.room_size]))
+               for client_id in range(config.clients)]
+    # 1. connect
+    semaphore = asyncio.Semaphore(config.connect_concurrency)
+    connect_latencies = []
+    failed_connects = 0
+
+    async def connect(client):
+        nonlocal failed_connects
+        async with semaphore:
+            started = time.perf_counter()
+            if await client.connect():
+                connect_latencies.append(time.perf_counter() - started)
+            else:
+                failed_connects += 1
+
+    connect_started = time.perf_counter()
+    await asyncio.gather(*[connect(client) for client in clients])
+    connect_elapsed = time.perf_counter() - connect_started
+    if progress:
+        progress('connected {} clients in {:.2f}s'.format(len(connect_latencies), connect_elapsed))
+
+    # 2. send (접속에 실패한 client는 제외합니다)
+    connected = [client for client in clients if client.connected]
+    room_sizes = {}
+    for client in connected:
+        room_sizes[client.room] = room_sizes.get(client.room, 0) + 1
+    send_started = time.perf_counter()
+    await asyncio.gather(*[client.send_messages(config.messages_per_client, config.send_interval)
+                           for client in connected])
+    send_elapsed = time.perf_counter() - send_started
+    sent = len(connected) * config.messages_per_client
+    expected = sum(size * size * config.messages_per_client for size in room_sizes.values())
+    if progress:
+        progress('sent {} messages in {:.2f}s; waiting for fan-out'.format(sent, send_elapsed))
+
+    # 3. drain
+    deadline = time.perf_counter() + config.drain_timeout
+    while time.perf_counter() < deadline and sum(client.received for client in clients) < expected:
+        await asyncio.sleep(0.05)
+    deliver_elapsed = time.perf_counter() - send_started
+    delivered = sum(client.received for client in clients)
+
+    await asyncio.gather(*[client.close() for client in clients], return_exceptions=True)
+
+    latencies = []
+    for client in clients:
+        latencies.extend(client.latencies)
+    return {
+        'config': config._asdict(),
+        'connect': dict(_summary(connect_latencies), failed=failed_connects,
+                        rate_per_sec=len(connect_latencies) / connect_elapsed if connect_elapsed else None),
+        'messages': {
+            'sent': sent,
+            'expected_frames': expected,
+            'delivered_frames': delivered,
+            'lost_frames': max(0, expected - delivered),
+            'send_rate_per_sec': sent / send_elapsed if send_elapsed else None,
+            'delivery_rate_per_sec': delivered / deliver_elapsed if deliver_elapsed else None,
+        },
+        'fanout_latency_ms': _summary(latencies),
+    }
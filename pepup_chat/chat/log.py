@@ -0,0 +1,169 @@
+# -*- encoding: utf-8 -*-
+import atexit
+import json
+import logging
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+
+from django.conf import settings
+
+"""
+채팅 경로용 structured logging 입니다.
+
+- ChatLoggerAdapter : 모든 line에 room / user / conn field를 붙입니다.
+- 방 단위 verbosity : settings.CHAT_LOG['ROOM_LEVELS'] 또는 set_room_level(room_id, 'DEBUG')
+- sampling         : WARNING 미만 level은 CHAT_LOG['SAMPLE_RATES'] 비율만 기록합니다. (ROOM_LEVELS로 지정한 방은 제외)
+- non-blocking     : 'chat' logger의 handler들은 QueueListener(background thread)로 옮겨지고,
+                     event loop에서는 bounded queue에 넣기만 합니다. queue가 가득 차면 버립니다.
+
+settings 예시:
+    CHAT_LOG = {
+        'LEVEL': 'INFO',
+        'ROOM_LEVELS': {123: 'DEBUG'},
+        'SAMPLE_RATES': {'DEBUG': 0.01, 'INFO': 1.0},
+        'QUEUE_SIZE': 10000,
+    }
+"""
+
+LOGGER_NAME = 'chat'
+
+_room_levels = {}  # runtime override : room_id(str) -> level(int)
+
+
+def get_log_config():
+    return getattr(settings, 'CHAT_LOG', {})
+
+
+def _to_level(level):
+    if isinstance(level, int):
+        return level
+    return logging.getLevelName(level.upper())
+
+
+def set_room_level(room_id, level):
+    """
+    이 process에서 특정 방의 log level을 바꿉니다. (디버깅용, level=None이면 해제)
+    """
+    if level is None:
+        _room_levels.pop(str(room_id), None)
+    else:
+        _room_levels[str(room_id)] = _to_level(level)
+
+
+def get_room_level(room_id):
+    """
+    :return: (level, overridden)
+    """
+    room_key = str(room_id)
+    if room_key in _room_levels:
+        return _room_levels[room_key], True
+    room_levels = get_log_config().get('ROOM_LEVELS', {})
+    for key, level in room_levels.items():
+        if str(key) == room_key:
+            return _to_level(level), True
+    return _to_level(get_log_config().get('LEVEL', 'INFO')), False
+
+
+class ChatLoggerAdapter(logging.LoggerAdapter):
+    """
+    log record를 만들기 전에 방 level과 sampling을 먼저 확인하므로, 버려질 line의 비용은 거의 없습니다.
+    """
+
+    def __init__(self, logger, room_id=None, user_id=None, conn=None):
+        super(ChatLoggerAdapter, self).__init__(logger, {'room': room_id, 'user': user_id, 'conn': conn})
+
+    def bind(self, **fields):
+        self.extra = dict(self.extra, **fields)
+        return self
+
+    def isEnabledFor(self, level):
+        room_level, overridden = get_room_level(self.extra.get('room'))
+        if level < room_level:
+            return False
+        if level < logging.WARNING and not overridden:
+            sample_rate = get_log_config().get('SAMPLE_RATES', {}).get(logging.getLevelName(level), 1.0)
+            if sample_rate < 1.0 and random.random() >= sample_rate:
+                return False
+        return self.logger.isEnabledFor(level)
+
+    def process(self, msg, kwargs):
+        fields = kwargs.pop('fields', None)
+        extra = dict(self.extra)
+        if fields:
+            extra['fields'] = fields
+        kwargs['extra'] = extra
+        return msg, kwargs
+
+
+def get_chat_logger(room_id=None, user_id=None, conn=None, name=LOGGER_NAME):
+    return ChatLoggerAdapter(logging.getLogger(name), room_id=room_id, user_id=user_id, conn=conn)
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    한 줄짜리 JSON으로 출력합니다.
+        {"ts": ..., "level": "INFO", "logger": "chat.consumers", "event": "connect", "room": "1", "user": 3, ...}
+    """
+
+    def format(self, record):
+        line = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'event': record.getMessage(),
+        }
+        for key in ('room', 'user', 'conn'):
+            value = getattr(record, key, None)
+            if value is not None:
+                line[key] = value
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line.update(fields)
+        if record.exc_info:
+            line['exc'] = self.formatException(record.exc_info)
+        return json.dumps(line, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    queue가 가득 차면 block하지 않고 버립니다. (event loop를 멈추지 않기 위함)
+    """
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+
+_listener = None
+
+
+def setup_queue_logging():
+    """
+    'chat' logger에 설정된 handler(LOGGING 설정)를 background thread의 QueueListener로 옮깁니다.
+    AppConfig.ready 에서 한 번 호출됩니다.
+    """
+    global _listener
+    if _listener is not None:
+        return
+    logger = logging.getLogger(LOGGER_NAME)
+    handlers = [handler for handler in logger.handlers if not isinstance(handler, QueueHandler)]
+    if not handlers:
+        return
+    log_queue = queue.Queue(maxsize=get_log_config().get('QUEUE_SIZE', 10000))
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(DroppingQueueHandler(log_queue))
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_queue_logging)
+
+
+def stop_queue_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,32 @@
+# -*- encoding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.archive import ArchiveStore, archive_messages
+
+
+class Command(BaseCommand):
+    help = ('오래된 ChatMessage를 압축 JSONL segment로 옮깁니다. '
+            '중단되더라도 다시 실행하면 마지막 batch부터 이어서 진행합니다.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, help='기본값 : CHAT_ARCHIVE["MAX_AGE_DAYS"]')
+        parser.add_argument('--batch-size', type=int, help='기본값 : CHAT_ARCHIVE["BATCH_SIZE"]')
+        parser.add_argument('--max-batches', type=int, help='이번 실행에서 처리할 최대 batch 수')
+        parser.add_argument('--root', help='archive 경로 (기본값 : CHAT_ARCHIVE["ROOT"])')
+
+    def handle(self, *args, **options):
+        store = ArchiveStore(root=options['root'])
+
+        def progress(batch_count, archived_count, last_id):
+            self.stdout.write('batch {}: archived {} messages (last_id={})'.format(
+                batch_count, archived_count, last_id))
+
+        try:
+            archived_count = archive_messages(store=store,
+                                              max_age_days=options['older_than_days'],
+                                              batch_size=options['batch_size'],
+                                              max_batches=options['max_batches'],
+                                              progress=progress)
+        except BlockingIOError:
+            raise CommandError('Another archive job is running on "{}"'.format(store.root))
+        self.stdout.write(self.style.SUCCESS('Archived {} messages'.format(archived_count)))
@@ -0,0 +1,128 @@
+# -*- encoding: utf-8 -*-
+import os
+import time
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.migrations.executor import MigrationExecutor
+
+from chat import index_audit
+
+
+class Command(BaseCommand):
+    help = ('chat table의 index를 capture된 query pattern과 비교하여 중복/미사용 index를 보고하고, '
+            '필요한 composite index로 교체하는 migration을 생성합니다.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+        parser.add_argument('--patterns', help='capture 파일 경로 (기본값 : CHAT_QUERY_CAPTURE["PATH"])')
+        parser.add_argument('--min-count', type=int, default=100,
+                            help='composite index를 제안할 최소 pattern 실행 횟수')
+        parser.add_argument('--drop-unused', action='store_true',
+                            help='미사용 index도 drop 대상에 포함합니다. (capture 기간이 충분할 때만 사용하세요)')
+        parser.add_argument('--emit-migration', action='store_true',
+                            help='chat/migrations 에 migration을 생성합니다. (DB가 최신 migration까지 적용되어 있어야 합니다)')
+        parser.add_argument('--benchmark-inserts', type=int, default=0,
+                            help='N건 INSERT 처리량을 변경 전/후로 측정합니다. (transaction 안에서 측정 후 rollback)')
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        models = list(apps.get_app_config('chat').get_models())
+        patterns_path = options['patterns'] or index_audit.get_capture_config().get('PATH')
+        captured = index_audit.load_captured_patterns(patterns_path)
+        weighted_patterns = [(index_audit.parse_pattern_key(key), count) for key, count in captured.items()]
+        patterns = [pattern for pattern, count in weighted_patterns]
+        if not captured:
+            self.stdout.write(self.style.WARNING('No captured query patterns; unused-index analysis is skipped.'))
+
+        drops = []
+        creates = []
+        for model in models:
+            table = model._meta.db_table
+            declared = index_audit.get_declared_indexes(model)
+            database = index_audit.get_database_indexes(connection, model)
+            table_patterns = [pattern for pattern in patterns if pattern.table == table]
+            table_weighted = [(pattern, count) for pattern, count in weighted_patterns if pattern.table == table]
+            self.stdout.write(self.style.MIGRATE_HEADING('{} ({})'.format(model.__name__, table)))
+
+            for index, covering, reason in index_audit.find_redundant_indexes(declared):
+                self.stdout.write('  [declared] {} is redundant ({} of {})'.format(index.name, reason, covering.name))
+            for index, covering, reason in index_audit.find_redundant_indexes(database):
+                self.stdout.write('  [database] {} {} is redundant ({} of {})'.format(
+                    index.name, index.columns, reason, covering.name))
+                drops.append(index)
+            if captured:
+                for index in index_audit.find_unused_indexes(database, table_patterns):
+                    self.stdout.write('  [database] {} {} is unused'.format(index.name, index.columns))
+                    if options['drop_unused'] and index not in drops:
+                        drops.append(index)
+            for table_name, columns, count in index_audit.recommend_indexes(
+                    database, table_weighted, min_count=options['min_count']):
+                self.stdout.write('  [recommend] composite index {} (pattern count={})'.format(columns, count))
+                creates.append((table_name, columns))
+
+        forward, reverse = index_audit.build_index_sql(connection, drops, creates)
+        if not forward:
+            self.stdout.write(self.style.SUCCESS('Nothing to change.'))
+            return
+        self.stdout.write(self.style.MIGRATE_HEADING('Proposed SQL'))
+        for sql in forward:
+            self.stdout.write('  ' + sql)
+
+        if options['benchmark_inserts']:
+            self._benchmark(connection, forward, options['benchmark_inserts'])
+        if options['emit_migration']:
+            self._emit_migration(connection, drops, creates)
+
+    def _benchmark(self, connection, forward, count):
+        if not connection.features.can_rollback_ddl:
+            raise CommandError('--benchmark-inserts needs transactional DDL ({} has none)'.format(connection.vendor))
+        from chat.models import ChatMessage, ChatRoom
+
+        room = ChatRoom.objects.using(connection.alias).order_by('id').first()
+        if room is None:
+            raise CommandError('--benchmark-inserts needs at least one ChatRoom')
+
+        def run():
+            started = time.perf_counter()
+            for i in range(count):
+                # 메세지 1건 = INSERT 1회 (실제 전송 경로와 동일)
+                ChatMessage.objects.using(connection.alias).bulk_create([ChatMessage(
+                    message_type=1, room_id=room.id, text='index audit benchmark {}'.format(i),
+                    code='chat$chat', version=1)])
+            return count / (time.perf_counter() - started)
+
+        with transaction.atomic(using=connection.alias):
+            before = run()
+            with connection.cursor() as cursor:
+                for sql in forward:
+                    cursor.execute(sql)
+            after = run()
+            transaction.set_rollback(True, using=connection.alias)
+        self.stdout.write(self.style.MIGRATE_HEADING('Insert throughput ({} rows, rolled back)'.format(count)))
+        self.stdout.write('  before: {:.0f} rows/s'.format(before))
+        self.stdout.write('  after : {:.0f} rows/s ({:+.1f}%)'.format(after, (after / before - 1) * 100))
+
+    def _emit_migration(self, connection, drops, creates):
+        executor = MigrationExecutor(connection)
+        loader = executor.loader
+        if executor.migration_plan(loader.graph.leaf_nodes()):
+            # 적용되지 않은 migration이 지울 index를 이 migration이 한 번 더 지우지 않도록 합니다.
+            raise CommandError('Apply pending migrations before --emit-migration '
+                               '(the audit must see the database as the latest migration leaves it)')
+        leaf_nodes = loader.graph.leaf_nodes('chat')
+        if not leaf_nodes:
+            raise CommandError('chat app has no migrations')
+        dependency = leaf_nodes[0][1]
+        name = '{:04d}_audit_chat_indexes'.format(int(dependency.split('_')[0]) + 1)
+        state_apps = loader.project_state(leaf_nodes[0]).apps
+        operations, notes = index_audit.build_index_operations(connection, state_apps, drops, creates)
+        path = os.path.join(apps.get_app_config('chat').path, 'migrations', name + '.py')
+        with open(path, 'w') as f:
+            f.write(index_audit.render_migration(operations, dependency, name))
+        self.stdout.write(self.style.SUCCESS('Wrote {}'.format(path)))
+        if notes:
+            self.stdout.write(self.style.MIGRATE_HEADING('Update chat/models.py to match the migration state'))
+            for note in notes:
+                self.stdout.write('  ' + note)
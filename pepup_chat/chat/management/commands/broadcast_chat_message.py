@@ -0,0 +1,52 @@
+# -*- encoding: utf-8 -*-
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.broadcast import BroadcastError, broadcast_template
+from chat.message_models import TextChatMessageTmpl
+from chat.models import ChatRoom
+from chat.profile_models import ChatSource
+
+
+class Command(BaseCommand):
+    help = ('같은 text 메세지를 여러 방에 보냅니다. (공지 등) '
+            '실패하면 출력된 --broadcast-id, --resume-after 로 다시 실행하여 이어서 보낼 수 있습니다.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--text', required=True)
+        parser.add_argument('--source-user-id', type=int, required=True, help='보내는 사용자(bot 계정) id')
+        parser.add_argument('--room-ids', help='쉼표로 구분한 방 id (지정하지 않으면 active한 모든 방)')
+        parser.add_argument('--broadcast-id', type=uuid.UUID, help='이어서 진행할 broadcast id')
+        parser.add_argument('--resume-after', type=int, help='이 방 id까지는 건너뜁니다.')
+        parser.add_argument('--chunk-size', type=int, help='기본값 : CHAT_BROADCAST["CHUNK_SIZE"]')
+        parser.add_argument('--concurrency', type=int, help='기본값 : CHAT_BROADCAST["CONCURRENCY"]')
+
+    def handle(self, *args, **options):
+        try:
+            user = get_user_model().objects.get(id=options['source_user_id'])
+        except get_user_model().DoesNotExist:
+            raise CommandError('User {} does not exist'.format(options['source_user_id']))
+        rooms = ChatRoom.objects.filter(active=True)
+        if options['room_ids']:
+            rooms = rooms.filter(id__in=[int(room_id) for room_id in options['room_ids'].split(',')])
+        broadcast_id = options['broadcast_id'] or uuid.uuid4()
+        self.stdout.write('broadcast id: {}'.format(broadcast_id))
+
+        def progress(room_count, last_room_id):
+            self.stdout.write('sent to {} rooms (last_room_id={})'.format(room_count, last_room_id))
+
+        tmpl = TextChatMessageTmpl(source=ChatSource(user=user), text=options['text'])
+        try:
+            result = broadcast_template(tmpl, rooms,
+                                        broadcast_id=broadcast_id,
+                                        resume_after=options['resume_after'],
+                                        chunk_size=options['chunk_size'],
+                                        concurrency=options['concurrency'],
+                                        progress=progress)
+        except BroadcastError as e:
+            raise CommandError('{}\nresume with: --broadcast-id {} --resume-after {}'.format(
+                e, e.broadcast_id, e.last_room_id))
+        self.stdout.write(self.style.SUCCESS('Broadcast {} sent to {} rooms'.format(
+            result.broadcast_id, result.room_count)))
@@ -0,0 +1,31 @@
+# -*- encoding: utf-8 -*-
+import json
+
+from django.core.management.base import BaseCommand
+
+from chat.benchmarks import run_benchmarks
+
+
+class Command(BaseCommand):
+    help = 'serializer / template / delivery microbenchmark를 실행하고 결과를 JSON으로 저장합니다.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', help='결과 JSON 경로')
+        parser.add_argument('--filter', dest='name_filter', help='이름에 이 문자열이 포함된 benchmark만 실행합니다.')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--number', type=int, help='repeat당 호출 횟수 (기본값 : 자동)')
+
+    def handle(self, *args, **options):
+        def progress(name, result):
+            if 'median_us' in result:
+                self.stdout.write('{:<32} {:>12.1f} us (min {:.1f}, x{})'.format(
+                    name, result['median_us'], result['min_us'], result['number']))
+            else:
+                self.stdout.write('{:<32} {}'.format(name, result.get('skipped') or result.get('error')))
+
+        report = run_benchmarks(name_filter=options['name_filter'], repeat=options['repeat'],
+                                number=options['number'], progress=progress)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(self.style.SUCCESS('Wrote {}'.format(options['output'])))
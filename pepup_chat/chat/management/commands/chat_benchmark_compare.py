@@ -0,0 +1,32 @@
+# -*- encoding: utf-8 -*-
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.benchmarks import compare_results
+
+
+class Command(BaseCommand):
+    help = '두 chat_benchmark 결과를 비교합니다. threshold 이상 느려진 항목이 있으면 실패합니다.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('base')
+        parser.add_argument('new')
+        parser.add_argument('--threshold', type=float, default=0.1, help='허용 비율 (0.1 = 10%% 느려짐까지 허용)')
+
+    def handle(self, *args, **options):
+        with open(options['base']) as f:
+            base = json.load(f)
+        with open(options['new']) as f:
+            new = json.load(f)
+        regressions = []
+        for name, base_us, new_us, ratio, regressed in compare_results(base, new, options['threshold']):
+            line = '{:<32} {:>10.1f} -> {:>10.1f} us ({:+.1f}%)'.format(name, base_us, new_us, (ratio - 1) * 100)
+            if regressed:
+                regressions.append(name)
+                line = self.style.ERROR(line + '  REGRESSION')
+            self.stdout.write(line)
+        if regressions:
+            raise CommandError('{} benchmark(s) regressed beyond {:.0%}: {}'.format(
+                len(regressions), options['threshold'], ', '.join(regressions)))
+        self.stdout.write(self.style.SUCCESS('No regressions'))
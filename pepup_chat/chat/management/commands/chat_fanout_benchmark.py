@@ -0,0 +1,97 @@
+# -*- encoding: utf-8 -*-
+import asyncio
+import json
+import statistics
+import time
+
+from channels.exceptions import ChannelFull
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.fanout import can_use_script, fanout_group_send
+
+try:
+    from channels_redis.core import RedisChannelLayer
+except ImportError:
+    RedisChannelLayer = None
+
+
+async def _per_channel_send(layer, group, message):
+    """
+    기존 send_to_group(immediately=True) 방식 : member 조회 후 channel마다 send.
+    """
+    async with layer.connection(layer.consistent_hash(group)) as connection:
+        channels = [channel.decode('utf8') for channel in await connection.zrange(layer._group_key(group), 0, -1)]
+    for channel in channels:
+        try:
+            await layer.send(channel, dict(message))
+        except ChannelFull:
+            pass
+
+
+async def _layer_group_send(layer, group, message):
+    await layer.group_send(group, message)
+
+
+async def _fanout_send(layer, group, message):
+    await fanout_group_send(layer, group, message, raise_on_full=False)
+
+
+METHODS = (
+    ('per_channel_send', _per_channel_send),
+    ('layer_group_send', _layer_group_send),
+    ('fanout_lua', _fanout_send),
+)
+
+
+class Command(BaseCommand):
+    help = ('group member 수(10/100/1000)별로 group 전송 방식의 latency를 비교합니다. '
+            '(Redis가 필요합니다. 측정에 사용한 key는 끝난 뒤 모두 지웁니다)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--redis-host', default='127.0.0.1:6379', help='host:port')
+        parser.add_argument('--members', default='10,100,1000', help='쉼표로 구분한 group member 수')
+        parser.add_argument('--processes', type=int, default=4,
+                            help='member channel을 나누어 가질 가상의 server process 수')
+        parser.add_argument('--repeat', type=int, default=50)
+        parser.add_argument('--json', dest='json_path', help='결과를 JSON 파일로 저장합니다.')
+
+    def handle(self, *args, **options):
+        if RedisChannelLayer is None:
+            raise CommandError('channels_redis is not installed')
+        host, port = options['redis_host'].split(':')
+        sizes = [int(size) for size in options['members'].split(',')]
+        results = asyncio.get_event_loop().run_until_complete(
+            self._run(host, int(port), sizes, options['processes'], options['repeat']))
+        self.stdout.write(json.dumps(results, indent=2))
+        if options['json_path']:
+            with open(options['json_path'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+    async def _run(self, host, port, sizes, processes, repeat):
+        layer = RedisChannelLayer(hosts=[(host, port)], prefix='asgi-fanout-benchmark:',
+                                  capacity=repeat * len(METHODS) + 10)
+        assert can_use_script(layer)
+        message = {'type': 'chat.payload', 'text': json.dumps({'type': 'messages', 'messages': [{'text': 'x' * 200}]})}
+        results = {}
+        try:
+            for size in sizes:
+                group = 'benchmark-{}'.format(size)
+                for i in range(size):
+                    await layer.group_add(group, 'specific.proc{}!{}'.format(i % processes, i))
+                results[size] = {}
+                for name, method in METHODS:
+                    timings = []
+                    for _ in range(repeat):
+                        started = time.perf_counter()
+                        await method(layer, group, message)
+                        timings.append((time.perf_counter() - started) * 1000)
+                    results[size][name] = {'median_ms': statistics.median(timings), 'max_ms': max(timings)}
+                    self.stdout.write('members={} {}: median {:.3f} ms'.format(
+                        size, name, results[size][name]['median_ms']))
+                    await layer.flush()
+                    for i in range(size):
+                        await layer.group_add(group, 'specific.proc{}!{}'.format(i % processes, i))
+        finally:
+            await layer.flush()
+            await layer.close_pools()
+        return results
@@ -0,0 +1,93 @@
+# -*- encoding: utf-8 -*-
+import asyncio
+import json
+
+from channels.layers import channel_layers
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from django.utils.module_loading import import_string
+
+from chat.loadtest import (DEFAULT_CONFIG, LoadTestConfig, create_load_test_rooms, delete_load_test_rooms,
+                           run_load_test)
+
+
+class Command(BaseCommand):
+    help = ('ASGI application을 process 안에서 띄워 WebSocket chat 경로의 부하를 측정합니다. '
+            '--max-fanout-p99-ms 등을 지정하면 기준을 넘을 때 실패(exit code 1)합니다.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=DEFAULT_CONFIG.clients)
+        parser.add_argument('--room-size', type=int, default=DEFAULT_CONFIG.room_size)
+        parser.add_argument('--messages', type=int, default=DEFAULT_CONFIG.messages_per_client,
+                            help='client 하나가 보내는 메세지 수')
+        parser.add_argument('--send-interval', type=float, default=DEFAULT_CONFIG.send_interval)
+        parser.add_argument('--connect-concurrency', type=int, default=DEFAULT_CONFIG.connect_concurrency)
+        parser.add_argument('--drain-timeout', type=float, default=DEFAULT_CONFIG.drain_timeout)
+        parser.add_argument('--path-template', default=DEFAULT_CONFIG.path_template)
+        parser.add_argument('--owner-id', type=int, help='load test 방의 owner (기본값 : 첫 번째 user)')
+        parser.add_argument('--application', default='pepup_chat.settings.routing.application')
+        parser.add_argument('--layer', choices=('memory', 'redis'), default='memory')
+        parser.add_argument('--redis-host', default='127.0.0.1:6379', help='--layer redis 일 때 사용 (host:port)')
+        parser.add_argument('--rate-limit', action='store_true',
+                            help='CHAT_RATE_LIMIT을 그대로 적용합니다. (기본값 : 끄고 처리량만 측정)')
+        parser.add_argument('--json', dest='json_path', help='결과를 JSON 파일로 저장합니다.')
+        parser.add_argument('--max-fanout-p99-ms', type=float)
+        parser.add_argument('--min-connect-rate', type=float)
+        parser.add_argument('--max-lost-frames', type=int)
+
+    def handle(self, *args, **options):
+        config = LoadTestConfig(clients=options['clients'],
+                                room_size=options['room_size'],
+                                messages_per_client=options['messages'],
+                                send_interval=options['send_interval'],
+                                connect_concurrency=options['connect_concurrency'],
+                                drain_timeout=options['drain_timeout'],
+                                path_template=options['path_template'])
+        if options['layer'] == 'memory':
+            layer = {'BACKEND': 'channels.layers.InMemoryChannelLayer', 'CONFIG': {'capacity': 10000}}
+        else:
+            host, port = options['redis_host'].split(':')
+            layer = {'BACKEND': 'channels_redis.core.RedisChannelLayer',
+                     'CONFIG': {'hosts': [(host, int(port))], 'capacity': 10000}}
+
+        owner_id = options['owner_id']
+        if owner_id is None:
+            owner_id = get_user_model().objects.order_by('id').values_list('id', flat=True).first()
+            if owner_id is None:
+                raise CommandError('load test rooms need an owner; create a user or pass --owner-id')
+
+        room_ids = create_load_test_rooms(config, owner_id)
+        try:
+            # 기본 text policy(초당 5건)보다 빠르게 보내므로, 켜 두면 처리량이 아니라 throttling을 측정하게 됩니다.
+            rate_limit = dict(getattr(settings, 'CHAT_RATE_LIMIT', {}), ENABLED=options['rate_limit'])
+            with override_settings(CHANNEL_LAYERS={'default': layer}, CHAT_RATE_LIMIT=rate_limit):
+                channel_layers.backends = {}  # drop the layer built from the previous settings
+                application = import_string(options['application'])
+                report = asyncio.get_event_loop().run_until_complete(
+                    run_load_test(application, room_ids, config, progress=self.stdout.write))
+            channel_layers.backends = {}
+        finally:
+            delete_load_test_rooms(room_ids)
+
+        self.stdout.write(json.dumps(report, indent=2))
+        if options['json_path']:
+            with open(options['json_path'], 'w') as f:
+                json.dump(report, f, indent=2)
+        self._check_thresholds(report, options)
+
+    def _check_thresholds(self, report, options):
+        failures = []
+        p99 = report['fanout_latency_ms'].get('p99')
+        if options['max_fanout_p99_ms'] is not None and (p99 is None or p99 > options['max_fanout_p99_ms']):
+            failures.append('fan-out p99 {} ms > {} ms'.format(p99, options['max_fanout_p99_ms']))
+        rate = report['connect']['rate_per_sec']
+        if options['min_connect_rate'] is not None and (rate is None or rate < options['min_connect_rate']):
+            failures.append('connect rate {} /s < {} /s'.format(rate, options['min_connect_rate']))
+        lost = report['messages']['lost_frames']
+        if options['max_lost_frames'] is not None and lost > options['max_lost_frames']:
+            failures.append('lost frames {} > {}'.format(lost, options['max_lost_frames']))
+        if failures:
+            raise CommandError('Load test thresholds failed: ' + '; '.join(failures))
+        self.stdout.write(self.style.SUCCESS('Load test passed'))
@@ -0,0 +1,88 @@
+# -*- encoding: utf-8 -*-
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.search.backends import MAX_ROWID, SQLiteFTS5Backend, build_fts5_match, get_audience, get_audiences
+from chat.search.tokenizer import tokenize
+from core.utils import percentile
+
+_WORDS = (
+    '안녕하세요', '채팅방에서', '상품', '배송', '언제', '도착하나요', '사이즈', '교환', '환불', '가능한가요',
+    '감사합니다', '사진', '보내주세요', '가격', '할인', '쿠폰', '주문', '취소', '확인', '부탁드립니다',
+    '판매자님', '구매', '문의', '답변', '기다릴게요', '네고', '택배', '직거래', 'pepup', 'nike', 'size', 'ok',
+)
+_QUERIES = ('배송', '환불', '교환 가능', '사진', '채팅', '쿠폰 할인', 'nik', '도착', '판매자', '감사')
+
+
+def _sql(sql):
+    return sql.format(table=SQLiteFTS5Backend.table_name).replace('%s', '?')
+
+
+class Command(BaseCommand):
+    help = 'SQLite FTS5 검색 index의 latency를 측정합니다. (django DB를 사용하지 않는 독립 fixture)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000000)
+        parser.add_argument('--rooms', type=int, default=20000)
+        parser.add_argument('--users', type=int, default=5000)
+        parser.add_argument('--queries', type=int, default=500)
+        parser.add_argument('--page-size', type=int, default=20)
+        parser.add_argument('--path', help='fixture sqlite 파일 경로. 이미 존재하면 재사용합니다.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rnd = random.Random(options['seed'])
+        path = options['path'] or os.path.join(tempfile.gettempdir(), 'chat_search_benchmark.sqlite3')
+        conn = sqlite3.connect(path)
+        conn.execute(_sql(SQLiteFTS5Backend.CREATE_SQL))
+        count = conn.execute(_sql('SELECT count(*) FROM {table}')).fetchone()[0]
+        if count < options['messages']:
+            self._build_fixture(conn, rnd, count, options)
+
+        room_ids = list(range(1, options['rooms'] + 1))
+        room_timings = []
+        user_timings = []
+        for i in range(options['queries']):
+            query = rnd.choice(_QUERIES)
+            user_id = rnd.randint(1, options['users'])
+            # room-scoped : 방 1개, user-scoped : 사용자가 참여한 방 20개
+            room_timings.append(self._timed_search(conn, query, [rnd.choice(room_ids)], user_id,
+                                                   options['page_size']))
+            user_timings.append(self._timed_search(conn, query, rnd.sample(room_ids, 20), user_id,
+                                                   options['page_size']))
+        conn.close()
+
+        self.stdout.write('fixture: {} ({} messages)'.format(path, max(count, options['messages'])))
+        for name, timings in (('room-scoped', room_timings), ('user-scoped', user_timings)):
+            timings.sort()
+            self.stdout.write('{:<12} p50={:.2f}ms p95={:.2f}ms p99={:.2f}ms max={:.2f}ms'.format(
+                name, percentile(timings, 50), percentile(timings, 95), percentile(timings, 99), timings[-1]))
+
+    def _build_fixture(self, conn, rnd, start, options):
+        insert_sql = _sql(SQLiteFTS5Backend.INSERT_SQL)
+        batch = []
+        started = time.time()
+        for message_id in range(start + 1, options['messages'] + 1):
+            text = ' '.join(rnd.choice(_WORDS) for _ in range(rnd.randint(2, 8)))
+            target_user_id = rnd.randint(1, options['users']) if rnd.random() < 0.05 else None
+            batch.append((message_id, ' '.join(tokenize(text)), str(rnd.randint(1, options['rooms'])),
+                          get_audience(target_user_id)))
+            if len(batch) >= 10000:
+                conn.executemany(insert_sql, batch)
+                conn.commit()
+                batch = []
+        if batch:
+            conn.executemany(insert_sql, batch)
+            conn.commit()
+        self.stdout.write('built fixture in {:.1f}s'.format(time.time() - started))
+
+    def _timed_search(self, conn, query, room_ids, user_id, limit):
+        match = build_fts5_match(query, room_ids, get_audiences(user_id))
+        started = time.perf_counter()
+        conn.execute(_sql(SQLiteFTS5Backend.SEARCH_SQL), (match, MAX_ROWID, limit)).fetchall()
+        return (time.perf_counter() - started) * 1000
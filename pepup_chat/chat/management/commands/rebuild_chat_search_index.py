@@ -0,0 +1,20 @@
+# -*- encoding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from chat.models import ChatMessage
+from chat.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'ChatMessage 검색 index를 처음부터 다시 만듭니다.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--room', type=int, help='특정 room만 다시 index합니다.')
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        queryset = ChatMessage.objects.order_by('id')
+        if options['room']:
+            queryset = queryset.filter(room_id=options['room'])
+        get_search_backend().rebuild(queryset, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS('Rebuilt search index ({} messages)'.format(queryset.count())))
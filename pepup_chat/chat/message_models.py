@@ -1,10 +1,19 @@
 # -*- encoding: utf-8 -*-
-from collections import Mapping
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from types import MappingProxyType
 from uuid import UUID
 
+import six
+from django.conf import settings
+from rest_framework.serializers import ValidationError
+
+from chat import metrics
 from chat.models import ChatMessage
 from chat.profile_models import ChatSource
 from chat.serializers import ChatMessageWriteSerializer
+from core.aws.fields import URLResolvableUUID
 
 
 #
@@ -18,6 +27,7 @@ class Serializable(Mapping):
         serializer = ChatMessageWriteSerializer(data=tmpl)  # tmpl is valid (dict-like object)
     이 클래스를 상속받는 경우, Meta.fields 를 구현하여야 합니다.
     """
+    __slots__ = ()
 
     class Meta:
         fields = ()
@@ -30,21 +40,115 @@ class Serializable(Mapping):
         if isinstance(initial_attr, Serializable):
             attr = dict(initial_attr)
         elif isinstance(initial_attr, list):
-            attr = list(map(lambda x: dict(x) if isinstance(x, Serializable) else x))
+            attr = [dict(x) if isinstance(x, Serializable) else x for x in initial_attr]
         else:
             attr = initial_attr
         return attr
 
     def __iter__(self):
-        for field in self._get_valid_fields():
-            yield field
+        for field in self.Meta.fields:
+            if hasattr(self, field):
+                yield field
 
     def __len__(self):
-        return len(self._get_valid_fields())
+        return sum(1 for _ in self)
 
     # show only valid fields
     def _get_valid_fields(self):
-        return [field for field in self.Meta.fields if hasattr(self, field)]
+        return list(self)
+
+
+#
+# Lightweight validation (DRF serializer 없이 ChatMessage kwargs를 만들 때 사용)
+# - ChatMessageWriteSerializer와 같은 규칙을 field 단위 함수로 옮긴 것입니다.
+# - FK는 pk만 확인합니다. (존재 여부는 INSERT 시 DB가 확인하므로, field마다 SELECT하지 않습니다)
+#
+def _validate_char(value):
+    if value is None:
+        raise ValueError('This field may not be null.')
+    if isinstance(value, six.string_types):
+        return value
+    if isinstance(value, bool) or not isinstance(value, six.integer_types + (float,)):
+        raise ValueError('Not a valid string.')
+    return six.text_type(value)
+
+
+def _validate_int(value):
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, six.integer_types):
+        raise ValueError('A valid integer is required.')
+    return value
+
+
+def _validate_pk(value):
+    if value is None:
+        return None
+    return _validate_int(getattr(value, 'pk', value))
+
+
+def _validate_bool(value):
+    if not isinstance(value, bool):
+        raise ValueError('Must be a valid boolean.')
+    return value
+
+
+def _validate_json(value):
+    if value is not None and not isinstance(value, (dict, list)):
+        raise ValueError('Value must be valid JSON.')
+    return value
+
+
+def _validate_uuid(value):
+    if value is None or isinstance(value, URLResolvableUUID):
+        return value
+    if isinstance(value, UUID):
+        return URLResolvableUUID(int=value.int)
+    try:
+        if isinstance(value, six.integer_types):
+            return URLResolvableUUID(int=value)
+        return URLResolvableUUID(hex=value)
+    except (TypeError, ValueError):
+        raise ValueError('Must be a valid UUID.')
+
+
+_MESSAGE_TYPES = dict(ChatMessage.MESSAGE_TYPES)
+
+
+def _validate_message_type(value):
+    if _validate_int(value) not in _MESSAGE_TYPES:
+        raise ValueError('"{}" is not a valid choice.'.format(value))
+    return value
+
+
+# field name -> (validator, ChatMessage kwarg name or None(model field가 아님))
+_FIELD_SPECS = {
+    'message_type': (_validate_message_type, 'message_type'),
+    'room': (_validate_pk, 'room_id'),
+    'text': (_validate_char, 'text'),
+    'code': (_validate_char, 'code'),
+    'image_key': (_validate_uuid, None),  # content_url로 변환합니다. (to_message_kwargs 참고)
+    'content_url': (_validate_char, 'content_url'),
+    'lottie_emoji_key': (_validate_char, 'lottie_emoji_key'),
+    'caption': (_validate_char, 'caption'),
+    'uri': (_validate_char, 'uri'),
+    'version': (_validate_int, 'version'),
+    'source_type': (_validate_int, None),
+    'source_user': (_validate_pk, 'source_user_id'),
+    'source_bot_key': (_validate_char, None),
+    'template': (_validate_json, 'template'),
+    'target_user': (_validate_pk, 'target_user_id'),
+    'is_hidden': (_validate_bool, 'is_hidden'),
+    'token': (_validate_uuid, 'token'),
+    'postback_parent': (_validate_pk, None),
+    'postback_value': (_validate_char, None),
+    'extras': (_validate_json, 'extras'),
+    'object_id': (_validate_int, 'object_id'),
+    'client_handler_version': (_validate_int, 'client_handler_version'),
+    'target_handler_version': (_validate_int, 'target_handler_version'),
+}
+_REQUIRED_FIELDS = ('message_type', 'room')
+_DEFAULT_MESSAGE_KWARGS = {'version': 1, 'is_hidden': False}  # ChatMessageWriteSerializer의 default와 동일
 
 
 class MessageTmplBase(Serializable):
@@ -54,6 +158,16 @@ class MessageTmplBase(Serializable):
     또는 on-the-fly 로 JSON-serialized message를 생성할 수 있습니다.
     """
 
+    # __dict__ 대신 slot을 사용합니다. (bot flow에서 tmpl을 수천 개씩 만들기 때문)
+    # - 값을 설정하지 않은 slot은 hasattr()이 False이므로, "설정한 field만 저장" 하는 기존 동작과 같습니다.
+    # - message_type, template 등 subclass/mixin에서 property로 구현하는 field는 slot에 넣지 않습니다.
+    __slots__ = (
+        'source', '_handler_name', 'action_code', 'created_at',
+        'room', 'target_user', 'postback_parent', 'client_handler_version', 'target_handler_version',
+        'text', 'image_key', 'content_url', 'lottie_emoji_key', 'caption', 'uri',
+        'is_hidden', 'token', 'postback_value', 'extras', 'object_id',
+    )
+
     class Meta:
         fields = ChatMessageWriteSerializer.Meta.fields
 
@@ -176,16 +290,47 @@ class MessageTmplBase(Serializable):
     #
     # impl
     #
+    def to_message_kwargs(self, required=_REQUIRED_FIELDS):
+        """
+        Meta.fields를 한 번만 순회하며 검증하고, ChatMessage(**kwargs)에 바로 넘길 수 있는 dict를 만듭니다.
+        (ChatMessageWriteSerializer를 거치지 않습니다.)
+        :param required: 값이 있어야 하는 field. (ex: broadcast는 room을 나중에 채우므로 제외합니다)
+        :raises: serializers.ValidationError
+        """
+        kwargs = dict(_DEFAULT_MESSAGE_KWARGS)
+        errors = {}
+        image_key = None
+        for field in self.Meta.fields:
+            try:
+                value = getattr(self, field)
+            except AttributeError:
+                continue
+            validator, kwarg_name = _FIELD_SPECS[field]
+            try:
+                value = validator(value)
+            except ValueError as e:
+                errors[field] = [six.text_type(e)]
+                continue
+            if field == 'image_key':
+                image_key = value
+            elif kwarg_name is not None:
+                kwargs[kwarg_name] = value
+        for field in required:
+            if kwargs.get(_FIELD_SPECS[field][1]) is None and field not in errors:
+                errors[field] = ['This field is required.']
+        if errors:
+            raise ValidationError(errors)
+        if image_key is not None and not kwargs.get('content_url'):
+            kwargs['content_url'] = image_key.url
+        return kwargs
+
     def save(self):
         """
         ChatMessage에 저장합니다.
         :return: ChatMessage object
         :raises: serializers.ValidationError
         """
-        serializer = ChatMessageWriteSerializer(data=self)
-        serializer.is_valid(raise_exception=True)
-        instance = serializer.create(serializer.validated_data)
-        return instance
+        return ChatMessage.objects.create(**self.to_message_kwargs())
 
     def update(self, chat_msg):
         """
@@ -194,25 +339,25 @@ class MessageTmplBase(Serializable):
         :return: ChatMessage object
         :raises: serializers.ValidationError
         """
-        serializer = ChatMessageWriteSerializer(chat_msg, data=self)
-        serializer.is_valid(raise_exception=True)
-        instance = serializer.update(chat_msg, serializer.validated_data)
-        return instance
+        for attr, value in self.to_message_kwargs().items():
+            setattr(chat_msg, attr, value)
+        chat_msg.save()
+        return chat_msg
 
     def fake(self):
         """
         save하지 않은 ChatMessage 객체를 만듭니다.
         :return: ChatMessage object (doesn't have pk value)
         """
-        serializer = ChatMessageWriteSerializer(data=self)
-        serializer.is_valid(raise_exception=True)
-        instance = ChatMessage(**serializer.validated_data)
+        instance = ChatMessage(**self.to_message_kwargs())
         if self.created_at:
-            instance.created_at = self.created_at  # serializer doesn't write created_at, so set it manually
+            instance.created_at = self.created_at  # created_at is auto_now_add, so set it manually
         return instance
 
 
 class TextMessageMixin(object):
+    __slots__ = ()
+
     @property
     def message_type(self):
         return 1
@@ -222,7 +367,7 @@ class TextMessageMixin(object):
 
 
 class ImageMessageMixin(object):
-    image_key = None
+    __slots__ = ()
 
     @property
     def message_type(self):
@@ -236,6 +381,8 @@ class ImageMessageMixin(object):
 # Basic Messages Implementations
 #
 class TextChatMessageTmpl(MessageTmplBase, TextMessageMixin):
+    __slots__ = ()
+
     def __init__(self, source, text, action_code=None):
         super(TextChatMessageTmpl, self).__init__(source)
         self.text = text
@@ -244,16 +391,17 @@ class TextChatMessageTmpl(MessageTmplBase, TextMessageMixin):
 
 
 class ImageChatMessageTmpl(MessageTmplBase, ImageMessageMixin):
+    __slots__ = ()
+
     def __init__(self, source,
                  image_key=None,
                  content_url=None,
                  caption=''):
         super(ImageChatMessageTmpl, self).__init__(source)
         assert image_key or content_url, 'ImageChatMessageTmpl error. image_key and content_url are both None'
-        if image_key:
-            if isinstance(image_key, UUID):
-                image_key = str(image_key)
-            self.image_key = image_key
+        if isinstance(image_key, UUID):
+            image_key = str(image_key)
+        self.image_key = image_key  # (previously defaulted to None by ImageMessageMixin)
         if content_url:
             self.content_url = content_url
         self.extras = {'caption': caption}  # this line was mistake; DEPRECATED
@@ -261,6 +409,8 @@ class ImageChatMessageTmpl(MessageTmplBase, ImageMessageMixin):
 
 
 class LottieEmojiChatMessageTmpl(MessageTmplBase):
+    __slots__ = ()
+
     @property
     def message_type(self):
         return 8
@@ -278,6 +428,7 @@ class UserPostbackChatMessageTmpl(MessageTmplBase):
      * REVIEW ME : 특수한 케이스를 특수하게 handling하는 건데, Tmpl 정의에 맞게 올바르게 구현한걸까?
      * (refac in progress... sad...)
     """
+    __slots__ = ()
 
     @property
     def message_type(self):
@@ -296,16 +447,118 @@ class UserPostbackChatMessageTmpl(MessageTmplBase):
         self.action_code = action_code
 
 
+#
+# Template rendering cache
+# - 같은 메뉴(buttons/carousel/header)를 여러 사용자에게 보낼 때, 입력값이 같으면 렌더링한 template(dict)을 재사용합니다.
+# - key는 template 종류와 입력값(immutable action 객체 포함)의 tuple입니다. (같은 내용이면 같은 key)
+# - 반환된 dict는 여러 메세지가 공유하므로 수정하면 안 됩니다. 수정이 필요하면 copy.deepcopy 하세요.
+#
+class TemplateRenderCache(object):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_render(self, key, render):
+        try:
+            hash(key)
+        except TypeError:
+            # hash할 수 없는 입력(ex: immutable이 아닌 custom action)은 cache하지 않습니다.
+            return render()
+        with self._lock:
+            rendered = self._entries.get(key)
+            if rendered is not None:
+                self._entries.move_to_end(key)
+        if rendered is not None:
+            metrics.registry.counter('chat_template_cache_total', 'Template render cache lookups',
+                                     result='hit').inc()
+            return rendered
+        metrics.registry.counter('chat_template_cache_total', 'Template render cache lookups',
+                                 result='miss').inc()
+        rendered = render()
+        with self._lock:
+            self._entries[key] = rendered
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return rendered
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+template_cache = TemplateRenderCache(getattr(settings, 'CHAT_TEMPLATE_CACHE', {}).get('MAX_SIZE', 1024))
+
+
+def _freeze(value):
+    """
+    params(dict/list)를 hash 가능한 tuple로 바꿉니다. (cache key 용)
+    """
+    if isinstance(value, Mapping):
+        return dict, tuple(sorted(((key, _freeze(item)) for key, item in value.items()),
+                                  key=lambda pair: str(pair[0])))
+    if isinstance(value, (list, tuple)):
+        return list, tuple(_freeze(item) for item in value)
+    return value
+
+
+class ImmutableAction(object):
+    """
+    생성 후 값을 바꿀 수 없는 action/column 객체. 같은 값이면 ==, hash가 같으므로 template cache key로 쓸 수 있고,
+    to_serializable() 결과도 한 번만 만듭니다. (반환된 dict는 공유되므로 수정하면 안 됩니다)
+    """
+    __slots__ = ('_key', '_serializable')
+
+    def _init_fields(self, **fields):
+        for name, value in fields.items():
+            object.__setattr__(self, name, value)
+        object.__setattr__(self, '_key', (self.__class__.__name__,) + tuple(
+            _freeze(getattr(self, name)) for name in self.__slots__))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('{} is immutable'.format(self.__class__.__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError('{} is immutable'.format(self.__class__.__name__))
+
+    def __eq__(self, other):
+        return isinstance(other, ImmutableAction) and self._key == other._key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__,
+                               ', '.join('{}={!r}'.format(name, getattr(self, name)) for name in self.__slots__))
+
+    def to_serializable(self):
+        try:
+            return self._serializable
+        except AttributeError:
+            serializable = self._render()
+            object.__setattr__(self, '_serializable', serializable)
+            return serializable
+
+    def _render(self):
+        raise NotImplementedError
+
+
 #
 # Action models
 #
-class UriAction(object):
+class UriAction(ImmutableAction):
+    __slots__ = ('label', 'uri', 'is_hidden')
+
     def __init__(self, label, uri, is_hidden=False):
-        self.label = label
-        self.uri = uri
-        self.is_hidden = is_hidden
+        self._init_fields(label=label, uri=uri, is_hidden=is_hidden)
 
-    def to_serializable(self):
+    def _render(self):
         return {
             'type': 'uri',
             'label': self.label,
@@ -314,18 +567,17 @@ class UriAction(object):
         }
 
 
-class PostbackAction(object):
+class PostbackAction(ImmutableAction):
+    __slots__ = ('message_code', 'label', 'params', 'is_hidden')
+
     def __init__(self, message_code, label, params=None, is_hidden=False):
-        if params is None:
-            params = {}
-        self.message_code = message_code
-        self.label = label
-        self.params = params
-        self.is_hidden = is_hidden
+        # params는 read-only view로 보관합니다. (생성 시 한 번만 복사)
+        self._init_fields(message_code=message_code, label=label,
+                          params=MappingProxyType(dict(params or {})), is_hidden=is_hidden)
 
-    def to_serializable(self):
+    def _render(self):
         # param에 항상 label을 같이 전송한다.
-        new_params = self.params.copy()
+        new_params = dict(self.params)
         new_params['label'] = self.label
         return {
             'type': 'postback',
@@ -339,12 +591,13 @@ class PostbackAction(object):
 #
 # Template messages
 #
-class CarouselColumn(object):
+class CarouselColumn(ImmutableAction):
+    __slots__ = ('thumbnail_image_url', 'actions')
+
     def __init__(self, thumbnail_image_url, actions):
-        self.thumbnail_image_url = thumbnail_image_url
-        self.actions = actions
+        self._init_fields(thumbnail_image_url=thumbnail_image_url, actions=tuple(actions))
 
-    def to_serializable(self):
+    def _render(self):
         return {
             'thumbnail_image_url': self.thumbnail_image_url,
             'actions': [action.to_serializable() for action in self.actions],
@@ -352,6 +605,8 @@ class CarouselColumn(object):
 
 
 class CarouselMessageTmplBase(MessageTmplBase):
+    __slots__ = ()
+
     @property
     def message_type(self):
         return 3
@@ -361,13 +616,16 @@ class CarouselMessageTmplBase(MessageTmplBase):
 
     @property
     def template(self):
-        return {
+        columns = tuple(self.get_columns())
+        return template_cache.get_or_render(('carousel', columns), lambda: {
             'type': 'carousel',
-            'columns': [col.to_serializable() for col in self.get_columns()]
-        }
+            'columns': [col.to_serializable() for col in columns]
+        })
 
 
 class ButtonsMessageTmpl(MessageTmplBase):
+    __slots__ = ('actions', 'thumbnail_image_url')
+
     def __init__(self, source, action_code, actions, text='', thumbnail_image_url=None):
         super(ButtonsMessageTmpl, self).__init__(source=source, action_code=action_code)
         self.text = text
@@ -380,16 +638,19 @@ class ButtonsMessageTmpl(MessageTmplBase):
 
     @property
     def template(self):
-        return {
+        actions = tuple(self.actions)
+        return template_cache.get_or_render(('buttons', self.text, self.thumbnail_image_url, actions), lambda: {
             'type': 'buttons',
             'text': self.text,
             'thumbnail_image_url': self.thumbnail_image_url,
-            'actions': [action.to_serializable() for action in self.actions]
-        }
+            'actions': [action.to_serializable() for action in actions]
+        })
 
 
 
 class HeaderMessageTmpl(MessageTmplBase):
+    __slots__ = ()
+
     def __init__(self, source, action_code, text=''):
         super(HeaderMessageTmpl, self).__init__(source=source, action_code=action_code)
         self.text = text
@@ -400,7 +661,7 @@ class HeaderMessageTmpl(MessageTmplBase):
 
     @property
     def template(self):
-        return {
+        return template_cache.get_or_render(('header', self.text), lambda: {
             'type': 'header',
             'text': self.text,
-        }
+        })
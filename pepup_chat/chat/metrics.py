@@ -0,0 +1,320 @@
+# -*- encoding: utf-8 -*-
+import asyncio
+import bisect
+import contextvars
+import functools
+import hmac
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+"""
+채팅 hot path 계측(instrumentation) 모듈입니다.
+
+- stage_timer(stage) : 단계별 소요 시간 histogram (auth, convert, save, serialize, group_send, socket_send, ...)
+- count_queries()     : inbound 메세지 1건당 실행된 DB query 수
+- layer_call(op)      : channel layer round-trip 횟수 및 latency
+export :
+- Prometheus text format : GET /metrics/ (pepup_chat.urls)
+    EXPORT_ENDPOINT가 True일 때만 열리고(기본값 False), 아래 중 하나에 해당하는 요청만 허용합니다. (그 외 403)
+    - staff user
+    - REMOTE_ADDR이 SCRAPE_ALLOWED_IPS 안에 있는 경우
+    - "Authorization: Bearer <SCRAPE_TOKEN>" header
+- 주기적인 log line     : settings.CHAT_METRICS['LOG_INTERVAL'] (초, 0이면 사용 안 함)
+
+settings 예시:
+    CHAT_METRICS = {
+        'EXPORT_ENDPOINT': True,
+        'SCRAPE_ALLOWED_IPS': ['127.0.0.1'],
+        'SCRAPE_TOKEN': 'prometheus-secret',
+        'LOG_INTERVAL': 60,
+    }
+"""
+
+logger = logging.getLogger(__name__)
+
+# milliseconds
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+def get_metrics_config():
+    return getattr(settings, 'CHAT_METRICS', {})
+
+
+def is_scrape_allowed(request, config=None):
+    config = get_metrics_config() if config is None else config
+    user = getattr(request, 'user', None)
+    # accounts.User에는 is_staff field가 없습니다.
+    if user is not None and user.is_active and getattr(user, 'is_staff', False):
+        return True
+    if request.META.get('REMOTE_ADDR') in config.get('SCRAPE_ALLOWED_IPS', ()):
+        return True
+    token = config.get('SCRAPE_TOKEN')
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    return bool(token) and hmac.compare_digest(authorization.encode(), ('Bearer ' + token).encode())
+
+
+class Histogram(object):
+    """
+    고정 bucket histogram. observe는 bisect + lock 한 번이므로 hot path에서 사용해도 부담이 적습니다.
+    """
+
+    def __init__(self, name, labels, buckets):
+        self.name = name
+        self.labels = labels
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 마지막 칸은 +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum
+
+    def quantile(self, q):
+        """
+        bucket 상한값 기준의 근사 quantile입니다. (log line 용)
+        """
+        counts, _ = self.snapshot()
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        cumulative = 0
+        for index, count in enumerate(counts):
+            cumulative += count
+            if cumulative >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return float('inf')
+
+
+class Counter(object):
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Gauge(Counter):
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels)
+    if extra:
+        items.append(extra)
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, value) for key, value in items) + '}'
+
+
+_PROMETHEUS_TYPES = {Histogram: 'histogram', Counter: 'counter', Gauge: 'gauge'}
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self._metrics = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def _get(self, metric_class, name, labels, help_text, **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = metric_class(name, key[1], **kwargs)
+                    self._metrics[key] = metric
+                    self._help.setdefault(name, (help_text, metric_class))
+        return metric
+
+    def histogram(self, name, help_text='', buckets=LATENCY_BUCKETS, **labels):
+        return self._get(Histogram, name, labels, help_text, buckets=buckets)
+
+    def counter(self, name, help_text='', **labels):
+        return self._get(Counter, name, labels, help_text)
+
+    def gauge(self, name, help_text='', **labels):
+        return self._get(Gauge, name, labels, help_text)
+
+    def collect(self):
+        # 다른 thread(executor 등)가 _get으로 새 metric을 추가하는 중에도 순회할 수 있도록 lock 안에서 복사합니다.
+        with self._lock:
+            items = list(self._metrics.items())
+        return sorted(items, key=lambda item: item[0])
+
+    def render_prometheus(self):
+        lines = []
+        last_name = None
+        for (name, _), metric in self.collect():
+            if name != last_name:
+                help_text, metric_class = self._help[name]
+                lines.append('# HELP {} {}'.format(name, help_text))
+                lines.append('# TYPE {} {}'.format(name, _PROMETHEUS_TYPES[metric_class]))
+                last_name = name
+            if isinstance(metric, Histogram):
+                counts, total_sum = metric.snapshot()
+                cumulative = 0
+                for bound, count in zip(list(metric.buckets) + ['+Inf'], counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(name, _format_labels(metric.labels, ('le', bound)),
+                                                         cumulative))
+                lines.append('{}_sum{} {}'.format(name, _format_labels(metric.labels), total_sum))
+                lines.append('{}_count{} {}'.format(name, _format_labels(metric.labels), cumulative))
+            else:
+                lines.append('{}{} {}'.format(name, _format_labels(metric.labels), metric.value))
+        return '\n'.join(lines) + '\n'
+
+    def summary_line(self):
+        """
+        log line 용 요약. histogram은 count/p50/p99(ms), counter는 값만 출력합니다.
+        """
+        parts = []
+        for (name, labels), metric in self.collect():
+            label = ','.join('{}={}'.format(key, value) for key, value in labels)
+            key = '{}[{}]'.format(name, label) if label else name
+            if isinstance(metric, Histogram):
+                counts, _ = metric.snapshot()
+                parts.append('{} n={} p50={} p99={}'.format(key, sum(counts), metric.quantile(0.5),
+                                                            metric.quantile(0.99)))
+            else:
+                parts.append('{}={}'.format(key, metric.value))
+        return '; '.join(parts)
+
+
+registry = MetricsRegistry()
+
+
+#
+# stage timers
+#
+def observe_stage(stage, elapsed_ms):
+    registry.histogram('chat_stage_latency_ms', 'Latency of chat hot-path stages in milliseconds',
+                       stage=stage).observe(elapsed_ms)
+
+
+@contextmanager
+def stage_timer(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, (time.perf_counter() - started) * 1000)
+
+
+def timed_stage(stage):
+    """
+    stage_timer의 decorator 버전입니다. (sync/async 함수 모두 지원)
+    """
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_inner(*args, **kwargs):
+                with stage_timer(stage):
+                    return await func(*args, **kwargs)
+            return async_inner
+
+        @functools.wraps(func)
+        def inner(*args, **kwargs):
+            with stage_timer(stage):
+                return func(*args, **kwargs)
+        return inner
+    return decorator
+
+
+#
+# DB query count
+# - consumer의 ORM 호출은 database_sync_to_async 로 다른 thread에서 실행되므로,
+#   thread-local이 아닌 contextvar에 counter를 두고 모든 connection에 execute_wrapper를 설치합니다.
+#
+_query_counter = contextvars.ContextVar('chat_query_counter', default=None)
+
+
+class QueryCounter(object):
+    __slots__ = ('count',)
+
+    def __init__(self):
+        self.count = 0
+
+
+def _count_query(execute, sql, params, many, context):
+    counter = _query_counter.get()
+    if counter is not None:
+        counter.count += 1
+    return execute(sql, params, many, context)
+
+
+def install_query_counter(sender, connection, **kwargs):
+    """
+    connection_created receiver.
+    """
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+@contextmanager
+def count_queries(kind='inbound_message'):
+    counter = QueryCounter()
+    token = _query_counter.set(counter)
+    try:
+        yield counter
+    finally:
+        _query_counter.reset(token)
+        registry.histogram('chat_db_queries', 'DB queries executed per unit of work', buckets=COUNT_BUCKETS,
+                           kind=kind).observe(counter.count)
+
+
+#
+# channel layer round-trips
+#
+@contextmanager
+def layer_call(op):
+    registry.counter('chat_channel_layer_roundtrips_total', 'Channel layer round-trips', op=op).inc()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.histogram('chat_channel_layer_latency_ms', 'Channel layer call latency in milliseconds',
+                           op=op).observe((time.perf_counter() - started) * 1000)
+
+
+#
+# periodic log line
+#
+_log_thread = None
+
+
+def start_periodic_log():
+    global _log_thread
+    interval = get_metrics_config().get('LOG_INTERVAL', 0)
+    if not interval or _log_thread is not None:
+        return
+
+    def run():
+        while True:
+            time.sleep(interval)
+            logger.info('chat metrics: %s', registry.summary_line())
+
+    _log_thread = threading.Thread(target=run, name='chat-metrics-log', daemon=True)
+    _log_thread.start()
@@ -0,0 +1,81 @@
+# -*- encoding: utf-8 -*-
+import json
+
+from django.db import migrations
+
+from core.fields import dumps, sanitize
+
+"""
+ChatMessage.template / extras, ChatRoomTagValue.json_value 를 core.fields.FastJSONField 로 바꾸면서
+기존 row를 fast decoder(orjson 등)로도 읽을 수 있게 정리합니다. (저장 형식은 그대로 TEXT column의 JSON)
+- NaN / Infinity (json 모듈만 읽을 수 있음) -> null
+- 빈 문자열, 깨진 JSON -> null (nullable) 또는 {}
+"""
+
+BATCH_SIZE = 1000
+
+COLUMNS = (
+    # (table, column, nullable)
+    ('chat_chatmessage', 'template', False),
+    ('chat_chatmessage', 'extras', False),
+    ('chat_chatroomtagvalue', 'json_value', True),
+)
+
+UNCHANGED = object()
+
+
+def _reject_constant(name):
+    raise ValueError(name)
+
+
+def _normalize(text, nullable):
+    if text is None:
+        return UNCHANGED if nullable else '{}'
+    try:
+        json.loads(text, parse_constant=_reject_constant)
+        return UNCHANGED
+    except ValueError:
+        pass
+    try:
+        return dumps(sanitize(json.loads(text)))
+    except ValueError:
+        return None if nullable else '{}'
+
+
+def normalize_json_columns(apps, schema_editor):
+    connection = schema_editor.connection
+    table_names = connection.introspection.table_names()
+    quote_name = connection.ops.quote_name
+    for table, column, nullable in COLUMNS:
+        if table not in table_names:
+            continue
+        select_sql = 'SELECT id, {column} FROM {table} WHERE id > %s ORDER BY id LIMIT %s'.format(
+            column=quote_name(column), table=quote_name(table))
+        update_sql = 'UPDATE {table} SET {column} = %s WHERE id = %s'.format(
+            column=quote_name(column), table=quote_name(table))
+        last_id = 0
+        while True:
+            with connection.cursor() as cursor:
+                cursor.execute(select_sql, [last_id, BATCH_SIZE])
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                updates = []
+                for row_id, text in rows:
+                    value = _normalize(text, nullable)
+                    if value is not UNCHANGED:
+                        updates.append([value, row_id])
+                if updates:
+                    cursor.executemany(update_sql, updates)
+            last_id = rows[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_json_columns, migrations.RunPython.noop),
+    ]
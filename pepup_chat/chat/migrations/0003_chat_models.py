@@ -0,0 +1,96 @@
+# Generated by Django 3.0.3 on 2026-10-19 15:22
+
+import core.fields
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+
+"""
+0001_initial 이후 model에 추가된 field / model을 migration 기록에 반영합니다. (audit_chat_indexes 이전의 index 구성)
+
+table을 이미 만든 DB(다른 서비스에서 생성)는 "manage.py migrate chat --fake-initial" 로 이 migration을 fake 처리하고,
+0004의 index 변경만 실행합니다.
+"""
+
+
+class Migration(migrations.Migration):
+
+    # --fake-initial : 아래 table / column이 이미 있으면 fake 처리합니다.
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0002_normalize_json_columns'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='active',
+            field=models.BooleanField(default=True, help_text='웹소켓 채팅이 가능할 경우 True'),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.CreateModel(
+            name='ChatMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message_type', models.IntegerField(choices=[(1, 'text'), (2, 'image'), (3, 'template'), (4, 'audio'), (5, 'video'), (6, 'postback'), (7, 'instant_command'), (8, 'lottie_emoji')], db_index=True)),
+                ('text', models.TextField()),
+                ('code', models.CharField(db_index=True, max_length=100)),
+                ('image', models.ImageField(blank=True, null=True, upload_to='')),
+                ('content_url', models.CharField(blank=True, max_length=300)),
+                ('lottie_emoji_key', models.CharField(blank=True, max_length=30)),
+                ('caption', models.CharField(blank=True, max_length=30)),
+                ('uri', models.CharField(blank=True, max_length=300)),
+                ('version', models.IntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('template', core.fields.FastJSONField(default=dict)),
+                ('is_hidden', models.BooleanField(default=True)),
+                ('token', models.UUIDField(db_index=True, default=uuid.uuid4, unique=True)),
+                ('extras', core.fields.FastJSONField(default=dict)),
+                ('object_id', models.PositiveIntegerField(blank=True, db_index=True, null=True)),
+                ('invalidated', models.BooleanField(default=False)),
+                ('client_handler_version', models.IntegerField(blank=True, db_index=True, null=True)),
+                ('target_handler_version', models.IntegerField(blank=True, db_index=True, null=True)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='chat.ChatRoom')),
+                ('source_user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='chat_messages', to=settings.AUTH_USER_MODEL)),
+                ('target_user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='targeted_chat_messages', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ChatRoomTagValue',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(db_index=True, max_length=200)),
+                ('value_type', models.IntegerField(choices=[(1, 'int'), (2, 'string'), (3, 'json')], db_index=True)),
+                ('int_value', models.IntegerField(blank=True, db_index=True, null=True)),
+                ('string_value', models.CharField(blank=True, db_index=True, max_length=200)),
+                ('json_value', core.fields.FastJSONField(default=dict, null=True)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tag_values', to='chat.ChatRoom')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_room_tag_values', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'index_together': {('room', 'user', 'key')},
+            },
+        ),
+        migrations.CreateModel(
+            name='ChatRoomParticipant',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('role', models.CharField(blank=True, db_index=True, max_length=100)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='participants', to='chat.ChatRoom')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_room_participants', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('room', 'user')},
+                'index_together': {('room', 'user')},
+            },
+        ),
+    ]
@@ -0,0 +1,84 @@
+# Generated by Django 3.0.3 on 2026-10-19 15:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+"""
+manage.py audit_chat_indexes 결과로 ChatMessage의 단일 column index를 정리하고 (room, id) index를 추가합니다.
+ChatRoomParticipant의 index_together는 unique_together와 같은 column이므로 제거합니다.
+"""
+
+
+def drop_participant_index_together(apps, schema_editor):
+    # Django 3.0의 AlterIndexTogether는 같은 column의 unique index까지 찾아 실패하므로, unique가 아닌 index만 지웁니다.
+    model = apps.get_model('chat', 'ChatRoomParticipant')
+    columns = [model._meta.get_field(name).column for name in ('room', 'user')]
+    for name in schema_editor._constraint_names(model, columns, index=True, unique=False):
+        schema_editor.execute(schema_editor._delete_index_sql(model, name))
+
+
+def create_participant_index_together(apps, schema_editor):
+    model = apps.get_model('chat', 'ChatRoomParticipant')
+    fields = [model._meta.get_field(name) for name in ('room', 'user')]
+    schema_editor.execute(schema_editor._create_index_sql(model, fields, suffix='_idx'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_chat_models'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='client_handler_version',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='code',
+            field=models.CharField(max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='message_type',
+            field=models.IntegerField(choices=[(1, 'text'), (2, 'image'), (3, 'template'), (4, 'audio'), (5, 'video'), (6, 'postback'), (7, 'instant_command'), (8, 'lottie_emoji')]),
+        ),
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='object_id',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='room',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='chat.ChatRoom'),
+        ),
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='target_handler_version',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='token',
+            field=models.UUIDField(default=uuid.uuid4, unique=True),
+        ),
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterIndexTogether(
+                    name='chatroomparticipant',
+                    index_together=set(),
+                ),
+            ],
+            database_operations=[
+                migrations.RunPython(drop_participant_index_together, create_participant_index_together),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['room', 'id'], name='chat_msg_room_id_idx'),
+        ),
+    ]
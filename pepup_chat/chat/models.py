@@ -1,16 +1,23 @@
 from django.db import models
 # Create your models here.
 from django.conf import settings
-import jsonfield
 import six
 import uuid
 
+from core.fields import FastJSONField
+
 
 class ChatRoom(models.Model):
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='chat_rooms', on_delete=models.CASCADE)
     active = models.BooleanField(default=True, help_text='웹소켓 채팅이 가능할 경우 True')
     created_at = models.DateTimeField(auto_now_add=True)
 
+    def get_role_dict(self):
+        """
+        :return: dict user_id -> role (ChatRoomParticipant.role). ChatUserSerializer.get_role 에서 사용합니다.
+        """
+        return dict(self.participants.values_list('user_id', 'role'))
+
 
 class ChatRoomTagValue(models.Model):
     """
@@ -27,7 +34,7 @@ class ChatRoomTagValue(models.Model):
     value_type = models.IntegerField(choices=VALUE_TYPES, db_index=True)
     int_value = models.IntegerField(blank=True, null=True, db_index=True)
     string_value = models.CharField(max_length=200, blank=True, db_index=True)
-    json_value = jsonfield.JSONField(default=dict, null=True)
+    json_value = FastJSONField(default=dict, null=True)
 
     def __repr__(self):
         return '"{}":"{}"'.format(self.key, self.value)
@@ -48,7 +55,28 @@ class ChatRoomTagValue(models.Model):
         )
 
 
+class ChatMessageQuerySet(models.QuerySet):
+    # ChatMessageReadSerializer가 읽지 않거나, 필요할 때만 읽는 무거운 column
+    HEAVY_FIELDS = ('template', 'extras')
+
+    def for_read(self, with_template=True, with_extras=True):
+        """
+        ChatMessageReadSerializer(many=True)로 serialize할 메세지를 가져올 때 사용합니다.
+        - serializer는 FK를 읽지 않습니다. source user는 ChatMessageListSerializer가 user card로 한 번에 가져오고,
+          target_user는 target message를 deliver할 때만 읽으므로 join하지 않습니다.
+        - with_template / with_extras=False 이면 해당 column을 defer하고, serializer도 그 field를 건너뜁니다.
+          (deferred field를 읽어 row마다 query가 생기지 않도록)
+        """
+        queryset = self
+        deferred = [field for field, needed in zip(self.HEAVY_FIELDS, (with_template, with_extras)) if not needed]
+        if deferred:
+            queryset = queryset.defer(*deferred)
+        return queryset
+
+
 class ChatMessage(models.Model):
+    objects = ChatMessageQuerySet.as_manager()
+
     # normal fields
     MESSAGE_TYPES = (
         # DON'T CHANGE THOSE STRINGS!! (used with "get_message_type_display")
@@ -61,10 +89,11 @@ class ChatMessage(models.Model):
         (7, 'instant_command'),
         (8, 'lottie_emoji'),
     )
-    message_type = models.IntegerField(choices=MESSAGE_TYPES, db_index=True)
-    room = models.ForeignKey(ChatRoom, related_name='messages', on_delete=models.CASCADE)
+    message_type = models.IntegerField(choices=MESSAGE_TYPES)
+    # (room, id) composite index가 room_id 단독 index를 대신합니다. (Meta.indexes 참고)
+    room = models.ForeignKey(ChatRoom, related_name='messages', on_delete=models.CASCADE, db_index=False)
     text = models.TextField()
-    code = models.CharField(max_length=100, db_index=True)
+    code = models.CharField(max_length=100)
     image = models.ImageField(blank=True, null=True)
     content_url = models.CharField(max_length=300, blank=True)
     lottie_emoji_key = models.CharField(max_length=30, blank=True)
@@ -76,7 +105,7 @@ class ChatMessage(models.Model):
     source_user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='chat_messages', blank=True, null=True, on_delete=models.CASCADE)
 
     # template data fields
-    template = jsonfield.JSONField(default=dict)
+    template = FastJSONField(default=dict)
 
     # target fields
     target_user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='targeted_chat_messages',
@@ -84,21 +113,21 @@ class ChatMessage(models.Model):
     is_hidden = models.BooleanField(default=True)
 
     # action & postback fields
-    token = models.UUIDField(unique=True, db_index=True, default=uuid.uuid4)
+    token = models.UUIDField(unique=True, default=uuid.uuid4)
     # postback_parent = models.ForeignKey('self', related_name='postback_children', blank=True, null=True)
     # postback_value = models.CharField(max_length=100, blank=True, db_index=True)  # DEPRECATED?
-    extras = jsonfield.JSONField(default=dict)
+    extras = FastJSONField(default=dict)
 
     # generic foreign key field
-    object_id = models.PositiveIntegerField(blank=True, null=True, db_index=True)
+    object_id = models.PositiveIntegerField(blank=True, null=True)
 
     # invalidated
     invalidated = models.BooleanField(default=False)
 
     # client_handler_version : 메세지를 생성한 client의 버전 (bot 및 user 메세지 모두 포함)
-    client_handler_version = models.IntegerField(blank=True, null=True, db_index=True)
+    client_handler_version = models.IntegerField(blank=True, null=True)
     # target_handler_version : 특정 버전 handler를 사용하는 client에게만 메세지를 보낼 경우 사용
-    target_handler_version = models.IntegerField(blank=True, null=True, db_index=True)
+    target_handler_version = models.IntegerField(blank=True, null=True)
 
     @property
     def handler_name(self):
@@ -129,6 +158,14 @@ class ChatMessage(models.Model):
             }
         return None
 
+    class Meta:
+        # manage.py audit_chat_indexes 결과를 반영한 index 구성입니다.
+        # - message_type, code, object_id, handler_version 등 선택도가 낮은 단일 column index는 제거했습니다.
+        # - hot query : 방 메세지 fetch (room_id = ? AND id < ? ORDER BY id DESC)
+        indexes = [
+            models.Index(fields=['room', 'id'], name='chat_msg_room_id_idx'),
+        ]
+
 
 class ChatRoomParticipant(models.Model):
     """
@@ -142,6 +179,3 @@ class ChatRoomParticipant(models.Model):
         unique_together = (
             ('room', 'user'),
         )
-        index_together = (
-            ('room', 'user'),
-        )
@@ -0,0 +1,354 @@
+# -*- encoding: utf-8 -*-
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+
+from chat import metrics
+
+try:
+    from channels_redis.core import RedisChannelLayer
+except ImportError:  # channels_redis가 없는 환경 (InMemoryChannelLayer 등)
+    RedisChannelLayer = None
+
+"""
+ChatConsumer.receive 의 rate limit(token bucket) 입니다. (settings.CHAT_RATE_LIMIT)
+
+- 범위(scope) : 'connection'(접속 하나), 'user'(사용자, 모든 worker 합산), 'room'(방, 모든 worker 합산)
+- 정책(policy) : frame 종류('text', 'postback', 'status')마다 scope별 (초당 token 수, 최대 token 수)
+- connection bucket은 process 안에서만 관리합니다.
+- user / room bucket은 channel layer의 Redis에서 Lua script로 관리하되, 메세지마다 round-trip 하지 않습니다.
+    - lease : Redis에서 token을 LEASE_SECONDS 분량만큼 한 번에 받아 두고, 다 쓸 때까지 local에서 차감합니다.
+    - 거절 : Redis가 거절하면 다음 token이 생길 때까지(retry_after) local에서 바로 거절합니다.
+    - local pre-check : 같은 정책의 local bucket이 비어 있으면 Redis에 묻지 않고 거절합니다.
+      (이 worker에서 보낸 양만으로도 한도를 넘은 경우이므로 Redis도 거절합니다)
+    - Redis가 없거나 오류가 나면 local bucket만으로 판단합니다. (fail-open 대신 worker 단위 제한)
+- 모든 scope가 허용한 경우에만 token을 차감합니다. (room에서 거절된 frame이 user / connection token을 쓰지 않습니다)
+    - Redis에서 받은 lease는 차감 전까지 worker에 남아 다음 frame에서 사용합니다.
+- 거절된 frame은 처리하지 않고, send_toast / send_error 로 알려줍니다. (send_utils.ConsumerReplyChannel 참고)
+  연속으로 CLOSE_AFTER_REJECTIONS번 거절되면 접속을 끊습니다.
+
+settings 예시:
+    CHAT_RATE_LIMIT = {
+        'ENABLED': True,
+        'POLICIES': {
+            'text': {'connection': (5, 10), 'user': (5, 20), 'room': (50, 200)},
+            ...
+        },
+        'LEASE_SECONDS': 1.0,
+        'CLOSE_AFTER_REJECTIONS': 50,
+        'KEY_PREFIX': 'chat:ratelimit',
+    }
+"""
+
+logger = logging.getLogger(__name__)
+
+CONNECTION = 'connection'
+USER = 'user'
+ROOM = 'room'
+SHARED_SCOPES = (USER, ROOM)
+
+TEXT = 'text'
+POSTBACK = 'postback'
+STATUS = 'status'
+
+# (tokens per second, burst)
+DEFAULT_POLICIES = {
+    TEXT: {CONNECTION: (5, 10), USER: (5, 20), ROOM: (50, 200)},
+    POSTBACK: {CONNECTION: (2, 5), USER: (2, 10), ROOM: (20, 100)},
+    STATUS: {CONNECTION: (10, 20), USER: (10, 40), ROOM: (100, 300)},
+}
+DEFAULT_LEASE_SECONDS = 1.0
+DEFAULT_CLOSE_AFTER_REJECTIONS = 50
+DEFAULT_KEY_PREFIX = 'chat:ratelimit'
+MAX_SHARED_BUCKETS = 100000
+
+Policy = namedtuple('Policy', ['rate', 'burst'])
+Decision = namedtuple('Decision', ['allowed', 'scope', 'retry_after'])
+ALLOWED = Decision(True, None, 0.0)
+
+
+def get_rate_limit_config():
+    return getattr(settings, 'CHAT_RATE_LIMIT', {})
+
+
+def get_policies(frame_type):
+    """
+    :return: dict scope -> Policy (정책이 없는 scope는 제한하지 않습니다)
+    """
+    policies = get_rate_limit_config().get('POLICIES', DEFAULT_POLICIES)
+    return {scope: Policy(*policy) for scope, policy in policies.get(frame_type, {}).items()}
+
+
+def classify_frame(data):
+    """
+    ChatConsumer.receive 가 받은 frame(json)의 종류
+    """
+    if data.get('type') in ('status', 'status_update', 'typing'):
+        return STATUS
+    message = data.get('message')
+    if isinstance(message, dict) and (message.get('postback_value') is not None or message.get('code')):
+        return POSTBACK
+    return TEXT
+
+
+class TokenBucket(object):
+    __slots__ = ('rate', 'burst', 'tokens', 'updated_at')
+
+    def __init__(self, policy, now=None):
+        self.rate = float(policy.rate)
+        self.burst = float(policy.burst)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic() if now is None else now
+
+    def _refill(self, now):
+        if now > self.updated_at:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+    def peek(self, now):
+        self._refill(now)
+        return self.tokens >= 1
+
+    def take(self, now):
+        self._refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def retry_after(self, now):
+        self._refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate) if self.rate else float('inf')
+
+
+#
+# Redis (shared buckets)
+#
+# KEYS[i] : bucket key
+# ARGV[1] : now (ms)
+# ARGV[2 + 3(i-1)] : rate (tokens/sec)   ARGV[3 + 3(i-1)] : burst   ARGV[4 + 3(i-1)] : 요청 token 수 (lease)
+# return : {granted_1, wait_ms_1, granted_2, wait_ms_2, ...}
+TOKEN_BUCKET_LUA = """
+local now = tonumber(ARGV[1])
+local result = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[3 * i - 1])
+    local burst = tonumber(ARGV[3 * i])
+    local requested = tonumber(ARGV[3 * i + 1])
+    local state = redis.call('HMGET', key, 't', 'ts')
+    local tokens = tonumber(state[1])
+    local ts = tonumber(state[2])
+    if tokens == nil or ts == nil then
+        tokens = burst
+        ts = now
+    end
+    if now > ts then
+        tokens = math.min(burst, tokens + (now - ts) * rate / 1000)
+        ts = now
+    end
+    local granted = math.min(requested, math.floor(tokens))
+    tokens = tokens - granted
+    redis.call('HMSET', key, 't', tostring(tokens), 'ts', tostring(ts))
+    redis.call('PEXPIRE', key, math.ceil(burst * 1000 / rate) + 1000)
+    local wait = 0
+    if granted == 0 then
+        wait = math.ceil((1 - tokens) * 1000 / rate)
+    end
+    table.insert(result, granted)
+    table.insert(result, wait)
+end
+return result
+"""
+TOKEN_BUCKET_LUA_SHA = hashlib.sha1(TOKEN_BUCKET_LUA.encode('utf8')).hexdigest()
+
+
+async def _eval_token_buckets(connection, keys, args):
+    try:
+        return await connection.evalsha(TOKEN_BUCKET_LUA_SHA, keys=keys, args=args)
+    except Exception as e:
+        if 'NOSCRIPT' not in str(e):
+            raise
+        return await connection.eval(TOKEN_BUCKET_LUA, keys=keys, args=args)
+
+
+class SharedBucket(object):
+    """
+    Redis bucket 하나에 대한 worker 쪽 상태 (lease, 거절 cache, local pre-check bucket)
+    """
+    __slots__ = ('key', 'policy', 'leased', 'lease_expires_at', 'blocked_until', 'local')
+
+    def __init__(self, key, policy):
+        self.key = key
+        self.policy = policy
+        self.leased = 0
+        self.lease_expires_at = 0.0
+        self.blocked_until = 0.0
+        self.local = TokenBucket(policy)
+
+    def lease_size(self):
+        lease_seconds = get_rate_limit_config().get('LEASE_SECONDS', DEFAULT_LEASE_SECONDS)
+        return int(max(1, min(self.policy.burst, self.policy.rate * lease_seconds)))
+
+    def check_local(self, now):
+        """
+        token을 차감하지 않고 확인합니다.
+        :return: True(허용) / False(거절) / None(Redis에 물어봐야 함)
+        """
+        if now < self.blocked_until or not self.local.peek(now):
+            return False
+        if self.leased > 0 and now < self.lease_expires_at:
+            return True
+        return None
+
+    def apply_grant(self, now, granted, wait_ms):
+        if granted > 0:
+            lease_seconds = get_rate_limit_config().get('LEASE_SECONDS', DEFAULT_LEASE_SECONDS)
+            self.leased = granted
+            self.lease_expires_at = now + lease_seconds
+            return True
+        self.leased = 0
+        self.blocked_until = now + wait_ms / 1000.0
+        return False
+
+    def consume(self, now):
+        """
+        모든 scope가 허용한 뒤 token 하나를 차감합니다. (lease가 없으면 local bucket만)
+        """
+        self.leased = max(0, self.leased - 1)
+        self.local.take(now)
+
+    def retry_after(self, now):
+        return max(self.blocked_until - now, self.local.retry_after(now), 0.0)
+
+
+class SharedBuckets(object):
+    """
+    worker 안의 모든 접속이 공유하는 SharedBucket (LRU)
+    """
+
+    def __init__(self, max_entries=MAX_SHARED_BUCKETS):
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_entries = max_entries
+
+    def get(self, key, policy):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None or bucket.policy != policy:
+                bucket = self._buckets[key] = SharedBucket(key, policy)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_entries:
+                self._buckets.popitem(last=False)
+            return bucket
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+shared_buckets = SharedBuckets()
+
+
+def _count(scope, frame_type, result):
+    metrics.registry.counter('chat_ratelimit_total', 'Rate limit decisions for inbound frames',
+                             scope=scope, type=frame_type, result=result).inc()
+
+
+class RateLimiter(object):
+    """
+    접속(consumer) 하나의 rate limiter.
+    """
+
+    def __init__(self, channel_layer, user_id, room_id, connection_buckets=None):
+        self.channel_layer = channel_layer
+        self.user_id = user_id
+        self.room_id = room_id
+        # frame type -> TokenBucket (한 접속에서 여러 방을 구독하면 방마다 만든 RateLimiter가 공유합니다)
+        self.connection_buckets = {} if connection_buckets is None else connection_buckets
+        self.rejections = 0
+
+    def _use_redis(self):
+        return RedisChannelLayer is not None and isinstance(self.channel_layer, RedisChannelLayer)
+
+    def _shared_key(self, scope, frame_type):
+        prefix = get_rate_limit_config().get('KEY_PREFIX', DEFAULT_KEY_PREFIX)
+        ident = self.user_id if scope == USER else self.room_id
+        return '{}:{}:{}:{}'.format(prefix, frame_type, scope, ident)
+
+    async def _ask_redis(self, buckets, now):
+        args = [int(time.time() * 1000)]
+        for bucket in buckets:
+            args.extend([bucket.policy.rate, bucket.policy.burst, bucket.lease_size()])
+        with metrics.layer_call('ratelimit'):
+            async with self.channel_layer.connection(0) as connection:
+                result = await _eval_token_buckets(connection, [bucket.key for bucket in buckets], args)
+        return [bucket.apply_grant(now, int(result[2 * i]), int(result[2 * i + 1]))
+                for i, bucket in enumerate(buckets)]
+
+    async def check(self, frame_type):
+        """
+        frame 하나를 처리해도 되는지 확인하고 token을 차감합니다.
+        :return: Decision
+        """
+        if not get_rate_limit_config().get('ENABLED', True):
+            return ALLOWED
+        policies = get_policies(frame_type)
+        now = time.monotonic()
+
+        connection_bucket = None
+        connection_policy = policies.get(CONNECTION)
+        if connection_policy is not None:
+            connection_bucket = self.connection_buckets.get(frame_type)
+            if connection_bucket is None:
+                connection_bucket = self.connection_buckets[frame_type] = TokenBucket(connection_policy, now)
+            if not connection_bucket.peek(now):
+                return self._reject(CONNECTION, frame_type, connection_bucket.retry_after(now))
+
+        shared = []
+        pending = []
+        for scope in SHARED_SCOPES:
+            if scope not in policies or (scope == USER and self.user_id is None):
+                continue
+            bucket = shared_buckets.get(self._shared_key(scope, frame_type), policies[scope])
+            allowed = bucket.check_local(now)
+            if allowed is False:
+                return self._reject(scope, frame_type, bucket.retry_after(now))
+            shared.append(bucket)
+            if allowed is None:
+                pending.append((scope, bucket))
+
+        if pending:
+            buckets = [bucket for _, bucket in pending]
+            if self._use_redis():
+                try:
+                    results = await self._ask_redis(buckets, now)
+                except Exception:
+                    logger.warning('rate limit check failed; using local buckets only', exc_info=True)
+                    results = [bucket.local.peek(now) for bucket in buckets]
+            else:
+                results = [bucket.local.peek(now) for bucket in buckets]
+            for (scope, bucket), allowed in zip(pending, results):
+                if not allowed:
+                    return self._reject(scope, frame_type, bucket.retry_after(now))
+
+        if connection_bucket is not None:
+            connection_bucket.take(now)
+        for bucket in shared:
+            bucket.consume(now)
+        self.rejections = 0
+        _count('all', frame_type, 'allowed')
+        return ALLOWED
+
+    def _reject(self, scope, frame_type, retry_after):
+        self.rejections += 1
+        _count(scope, frame_type, 'rejected')
+        return Decision(False, scope, retry_after)
+
+    def should_close(self):
+        return self.rejections >= get_rate_limit_config().get('CLOSE_AFTER_REJECTIONS',
+                                                              DEFAULT_CLOSE_AFTER_REJECTIONS)
+
@@ -0,0 +1,227 @@
+# -*- encoding: utf-8 -*-
+import json
+import time
+import uuid
+from collections import namedtuple
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+
+"""
+방 상태(room_states)를 version과 함께 저장하고, 바뀐 부분(JSON patch)만 보내기 위한 모듈입니다.
+
+- 방 전체 상태(target_user 없음)와 사용자별 상태(target_user)를 따로 저장합니다.
+    - send_room_states를 호출하는 process와 snapshot을 보내는 consumer process가 같은 version을 봐야 하므로,
+      CACHE는 모든 worker가 공유하는 cache여야 합니다. (LocMemCache / DummyCache 이면 ImproperlyConfigured)
+- update(room_id, user_id, state)
+    - 저장된 상태와 같으면 None (보내지 않습니다)
+    - 다르면 version을 1 올려 저장하고, 보낼 frame을 돌려줍니다.
+        {"type": "room_states_patch", "base_version": n, "version": n + 1, "patch": [...]}
+        patch는 RFC 6902 형식의 add / remove / replace op 입니다. (list는 통째로 replace)
+        patch가 전체 상태보다 크면 snapshot frame을 보냅니다.
+- snapshot frame : {"type": "room_states", "room_states": {...}, "version": n}
+    - 접속(구독)할 때, 그리고 client가 {"type": "resync_room_states"}를 보냈을 때 reply channel로 보냅니다.
+- 사용자별 상태의 frame에는 "target_user": true 가 붙습니다. (version은 방 전체 상태와 따로 셉니다)
+- client는 자신의 version이 base_version과 다르면(중간 patch를 놓친 경우) resync를 요청해야 합니다.
+- 같은 상태 key의 update(읽고 version을 올려 저장)는 cache.add로 잡는 lock 안에서 하나씩 실행됩니다.
+  (두 worker가 같은 base_version의 patch를 보내지 않습니다)
+
+settings 예시:
+    CHAT_ROOM_STATE = {
+        'CACHE': 'chat_shared',
+        'TTL': 86400,
+        'LOCK_TIMEOUT': 2.0,
+    }
+"""
+
+DEFAULT_TTL = 86400
+DEFAULT_LOCK_TIMEOUT = 2.0
+LOCK_POLL_INTERVAL = 0.005
+PROCESS_LOCAL_CACHES = (LocMemCache, DummyCache)
+
+RoomStateUpdate = namedtuple('RoomStateUpdate', ['version', 'frame'])
+
+
+def get_room_state_config():
+    return getattr(settings, 'CHAT_ROOM_STATE', {})
+
+
+class RoomStateLockTimeout(Exception):
+    pass
+
+
+def get_state_cache():
+    alias = get_room_state_config().get('CACHE', 'default')
+    cache = caches[alias]
+    if isinstance(cache, PROCESS_LOCAL_CACHES):
+        raise ImproperlyConfigured(
+            "CHAT_ROOM_STATE['CACHE'] ({!r}) is a process-local cache; room state versions must be shared by "
+            "every chat worker (use a Redis, Memcached or database cache)".format(alias))
+    return cache
+
+
+def check_room_state_cache(app_configs=None, **kwargs):
+    """
+    system check (AppConfig.ready 에서 등록) : 잘못된 CACHE 설정을 worker가 뜨기 전에 알립니다.
+    """
+    from django.core import checks
+    try:
+        get_state_cache()
+    except ImproperlyConfigured as e:
+        return [checks.Error(str(e), id='chat.E001')]
+    return []
+
+
+def _cache_key(room_id, user_id):
+    return 'chat:room-state:{}:{}'.format(room_id, 'all' if user_id is None else user_id)
+
+
+#
+# JSON patch
+#
+def _escape(key):
+    return str(key).replace('~', '~0').replace('/', '~1')
+
+
+def make_patch(old, new, path=''):
+    """
+    old -> new 로 바꾸는 JSON patch(op list). dict는 key 단위로 비교하고, 그 외의 값은 통째로 replace 합니다.
+    """
+    if not (isinstance(old, dict) and isinstance(new, dict)):
+        return [] if old == new else [{'op': 'replace', 'path': path, 'value': new}]
+    patch = []
+    for key in old:
+        if key not in new:
+            patch.append({'op': 'remove', 'path': '{}/{}'.format(path, _escape(key))})
+    for key, value in new.items():
+        child = '{}/{}'.format(path, _escape(key))
+        if key not in old:
+            patch.append({'op': 'add', 'path': child, 'value': value})
+        else:
+            patch.extend(make_patch(old[key], value, child))
+    return patch
+
+
+def _unescape(token):
+    return token.replace('~1', '/').replace('~0', '~')
+
+
+def apply_patch(state, patch):
+    """
+    make_patch가 만든 patch를 적용한 새 상태를 돌려줍니다. (client 구현 참고 및 test 용)
+    """
+    state = json.loads(json.dumps(state))
+    for op in patch:
+        if op['path'] == '':
+            state = op['value']
+            continue
+        tokens = [_unescape(token) for token in op['path'].split('/')[1:]]
+        parent = state
+        for token in tokens[:-1]:
+            parent = parent[token]
+        if op['op'] == 'remove':
+            del parent[tokens[-1]]
+        else:
+            parent[tokens[-1]] = op['value']
+    return state
+
+
+#
+# store
+#
+def snapshot_frame(version, state):
+    return {'type': 'room_states', 'room_states': state, 'version': version}
+
+
+@contextmanager
+def _state_lock(cache, key):
+    """
+    cache.add는 key가 없을 때만 저장하므로(atomic) lock으로 사용합니다. 잡은 process가 죽어도 LOCK_TIMEOUT 뒤에 풀립니다.
+    """
+    lock_timeout = get_room_state_config().get('LOCK_TIMEOUT', DEFAULT_LOCK_TIMEOUT)
+    lock_key = key + ':lock'
+    owner = uuid.uuid4().hex
+    deadline = time.monotonic() + lock_timeout
+    while not cache.add(lock_key, owner, timeout=lock_timeout):
+        if time.monotonic() > deadline:
+            raise RoomStateLockTimeout(key)
+        time.sleep(LOCK_POLL_INTERVAL)
+    try:
+        yield
+    finally:
+        if cache.get(lock_key) == owner:
+            cache.delete(lock_key)
+
+
+class RoomStateStore(object):
+
+    def get(self, room_id, user_id=None):
+        """
+        :return: (version, state) or None
+        """
+        entry = get_state_cache().get(_cache_key(room_id, user_id))
+        return None if entry is None else (entry['version'], entry['state'])
+
+    def update(self, room_id, user_id, state):
+        """
+        :return: RoomStateUpdate (상태가 같으면 None)
+        """
+        state = json.loads(json.dumps(state))  # 저장된 값과 같은 형태(JSON)로 비교합니다.
+        cache = get_state_cache()
+        key = _cache_key(room_id, user_id)
+        with _state_lock(cache, key):
+            return self._update(cache, key, user_id, state)
+
+    def _update(self, cache, key, user_id, state):
+        entry = cache.get(key)
+        current = None if entry is None else (entry['version'], entry['state'])
+        if current is None:
+            version, frame = 1, snapshot_frame(1, state)
+        else:
+            base_version, old_state = current
+            if old_state == state:
+                return None
+            version = base_version + 1
+            patch = make_patch(old_state, state)
+            if len(json.dumps(patch)) < len(json.dumps(state)):
+                frame = {'type': 'room_states_patch', 'base_version': base_version, 'version': version,
+                         'patch': patch}
+            else:
+                frame = snapshot_frame(version, state)
+        if user_id is not None:
+            frame['target_user'] = True
+        cache.set(key, {'version': version, 'state': state}, timeout=get_room_state_config().get('TTL', DEFAULT_TTL))
+        return RoomStateUpdate(version, frame)
+
+    def snapshot_frames(self, room_id, user_id=None):
+        """
+        접속(resync)한 client에게 보낼 snapshot frame들 (방 전체, 사용자별 순서)
+        """
+        frames = []
+        user_ids = [None] if user_id is None else [None, user_id]
+        entries = get_state_cache().get_many([_cache_key(room_id, target) for target in user_ids])
+        for target in user_ids:
+            entry = entries.get(_cache_key(room_id, target))
+            if entry is not None:
+                frame = snapshot_frame(entry['version'], entry['state'])
+                if target is not None:
+                    frame['target_user'] = True
+                frames.append(frame)
+        return frames
+
+    def clear(self, room_id, user_id=None):
+        get_state_cache().delete(_cache_key(room_id, user_id))
+
+
+room_state_store = RoomStateStore()
+
+
+def get_snapshot_payloads(room_id, user_id=None):
+    """
+    :return: list of encoded snapshot frames (consumer에서 run_read로 호출합니다)
+    """
+    return [json.dumps(frame) for frame in room_state_store.snapshot_frames(room_id, user_id)]
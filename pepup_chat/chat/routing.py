@@ -2,5 +2,6 @@ from django.urls import path
 from . import consumers
 
 websocket_urlpatterns = [
+    path('ws/chat/', consumers.MultiplexChatConsumer),
     path('ws/chat/<str:room_name>/', consumers.ChatConsumer),
 ]
\ No newline at end of file
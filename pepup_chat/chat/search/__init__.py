@@ -0,0 +1,100 @@
+# -*- encoding: utf-8 -*-
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.db.models import Q
+from django.utils.module_loading import import_string
+
+"""
+채팅 메세지 검색 모듈입니다.
+
+- index는 ChatMessage 저장/삭제 시 signal로 갱신됩니다. (chat.search.signals)
+- backend는 settings.CHAT_SEARCH 로 교체할 수 있습니다.
+    CHAT_SEARCH = {
+        'BACKEND': 'chat.search.backends.SQLiteFTS5Backend',
+        'DATABASE': 'default',
+        'OPTIONS': {},
+    }
+    BACKEND를 지정하지 않으면 DATABASE의 vendor로 고릅니다. (VENDOR_BACKENDS, 없는 vendor이면 검색을 사용하지 않습니다)
+- LIKE '%...%' 검색은 사용하지 않습니다. (table이 커지면 full scan)
+"""
+
+VENDOR_BACKENDS = {
+    'sqlite': 'chat.search.backends.SQLiteFTS5Backend',
+    'postgresql': 'chat.search.backends.PostgresSearchBackend',
+}
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+SearchPage = namedtuple('SearchPage', ['messages', 'next_before'])
+
+_backend = None
+
+
+def get_search_config():
+    return getattr(settings, 'CHAT_SEARCH', {})
+
+
+def get_backend_path(config=None):
+    """
+    :return: backend class 경로 (지정하지 않았고 DATABASE의 vendor에 맞는 backend가 없으면 None)
+    """
+    config = get_search_config() if config is None else config
+    path = config.get('BACKEND')
+    if path is None:
+        path = VENDOR_BACKENDS.get(connections[config.get('DATABASE', 'default')].vendor)
+    return path
+
+
+def get_search_backend():
+    global _backend
+    if _backend is None:
+        config = get_search_config()
+        path = get_backend_path(config)
+        if path is None:
+            raise ImproperlyConfigured("No chat search backend for the {!r} database; set CHAT_SEARCH['BACKEND']"
+                                       .format(config.get('DATABASE', 'default')))
+        _backend = import_string(path)(using=config.get('DATABASE', 'default'), **config.get('OPTIONS', {}))
+    return _backend
+
+
+def is_search_enabled():
+    config = get_search_config()
+    return config.get('ENABLED', True) and get_backend_path(config) is not None
+
+
+def get_searchable_room_ids(user):
+    from chat.models import ChatRoom
+    return list(ChatRoom.objects.filter(Q(owner=user) | Q(participants__user=user))
+                .values_list('id', flat=True).distinct())
+
+
+def search_messages(query, room_ids, user_id=None, before_id=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    :return: SearchPage(messages=list of ChatMessage (최신순), next_before=다음 page cursor or None)
+    """
+    from chat.models import ChatMessage
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    message_ids = get_search_backend().search(query, room_ids, user_id=user_id,
+                                              before_id=before_id, limit=limit + 1)
+    next_before = None
+    if len(message_ids) > limit:
+        message_ids = message_ids[:limit]
+        next_before = message_ids[-1]
+    chat_msg_dict = ChatMessage.objects.for_read().filter(id__in=message_ids, invalidated=False).in_bulk()
+    messages = [chat_msg_dict[message_id] for message_id in message_ids if message_id in chat_msg_dict]
+    return SearchPage(messages=messages, next_before=next_before)
+
+
+def search_room_messages(room_id, query, user_id=None, before_id=None, limit=DEFAULT_PAGE_SIZE):
+    return search_messages(query, [room_id], user_id=user_id, before_id=before_id, limit=limit)
+
+
+def search_user_messages(user, query, before_id=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    user가 참여한(또는 소유한) 모든 방에서 검색합니다.
+    """
+    return search_messages(query, get_searchable_room_ids(user), user_id=user.id,
+                           before_id=before_id, limit=limit)
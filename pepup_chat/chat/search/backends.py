@@ -0,0 +1,234 @@
+# -*- encoding: utf-8 -*-
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+
+from chat.search.tokenizer import tokenize, tokenize_query
+
+AUDIENCE_ALL = 'all'
+
+
+def get_audience(target_user_id):
+    """
+    target_user가 있는 메세지는 해당 사용자에게만 검색되어야 합니다.
+    """
+    if target_user_id:
+        return 'u{}'.format(target_user_id)
+    return AUDIENCE_ALL
+
+
+def get_audiences(user_id):
+    if user_id is None:
+        return None  # no audience filter (ex: staff)
+    return [AUDIENCE_ALL, get_audience(user_id)]
+
+
+class BaseSearchBackend(object):
+    """
+    메세지 검색 index backend의 interface입니다.
+    settings.CHAT_SEARCH['BACKEND'] 에 구현 class의 경로를 지정합니다.
+    모든 search 결과는 message id 내림차순(최신순)이며, before_id로 keyset pagination 합니다.
+    """
+
+    vendor = None  # 사용할 수 있는 database vendor (connection.vendor)
+
+    def __init__(self, using='default', **options):
+        self.using = using
+        self.options = options
+
+    @property
+    def connection(self):
+        return connections[self.using]
+
+    def setup(self):
+        """
+        index 저장소(table 등)를 준비합니다. post_migrate 시점에 호출되며, 여러 번 호출해도 안전해야 합니다.
+        """
+        raise NotImplementedError
+
+    def index_messages(self, chat_msgs):
+        raise NotImplementedError
+
+    def remove_messages(self, message_ids):
+        raise NotImplementedError
+
+    def search(self, query, room_ids, user_id=None, before_id=None, limit=20):
+        """
+        :param room_ids: 검색 대상 room id list
+        :param user_id: 주어지면, 해당 사용자가 볼 수 있는 메세지만 검색합니다.
+        :return: list of message id
+        """
+        raise NotImplementedError
+
+    def rebuild(self, queryset, batch_size=2000):
+        """
+        queryset의 메세지를 전부 다시 index합니다. (초기 구축 / 복구용)
+        """
+        self.setup()
+        batch = []
+        for chat_msg in queryset.only('id', 'room_id', 'target_user_id', 'text').iterator(chunk_size=batch_size):
+            batch.append(chat_msg)
+            if len(batch) >= batch_size:
+                self.index_messages(batch)
+                batch = []
+        if batch:
+            self.index_messages(batch)
+
+
+class SQLiteFTS5Backend(BaseSearchBackend):
+    """
+    SQLite FTS5 virtual table을 inverted index로 사용합니다. (local 개발용)
+    - rowid = ChatMessage.id
+    - tokens : tokenizer.tokenize 결과 (n-gram, 공백 구분)
+    - room / audience : column filter로 범위를 좁힙니다.
+    """
+    vendor = 'sqlite'
+    table_name = 'chat_message_fts'
+
+    CREATE_SQL = ('CREATE VIRTUAL TABLE IF NOT EXISTS {table} '
+                  'USING fts5(tokens, room, audience, tokenize="unicode61 remove_diacritics 0")')
+    DELETE_SQL = 'DELETE FROM {table} WHERE rowid = %s'
+    INSERT_SQL = 'INSERT INTO {table}(rowid, tokens, room, audience) VALUES (%s, %s, %s, %s)'
+    SEARCH_SQL = ('SELECT rowid FROM {table} WHERE {table} MATCH %s AND rowid < %s '
+                  'ORDER BY rowid DESC LIMIT %s')
+
+    def _sql(self, sql):
+        return sql.format(table=self.table_name)
+
+    def setup(self):
+        if self.connection.vendor != 'sqlite':
+            raise ImproperlyConfigured('SQLiteFTS5Backend requires a sqlite database; got "{}"'.format(
+                self.connection.vendor))
+        with self.connection.cursor() as cursor:
+            cursor.execute(self._sql(self.CREATE_SQL))
+
+    def index_messages(self, chat_msgs):
+        rows = []
+        for chat_msg in chat_msgs:
+            tokens = tokenize(chat_msg.text)
+            if tokens:
+                rows.append((chat_msg.id, ' '.join(tokens), str(chat_msg.room_id),
+                             get_audience(chat_msg.target_user_id)))
+        with self.connection.cursor() as cursor:
+            # text가 비워진 경우에도 이전 index는 지워야 하므로, 전체 id를 먼저 삭제합니다.
+            cursor.executemany(self._sql(self.DELETE_SQL), [(chat_msg.id,) for chat_msg in chat_msgs])
+            if rows:
+                cursor.executemany(self._sql(self.INSERT_SQL), rows)
+
+    def remove_messages(self, message_ids):
+        with self.connection.cursor() as cursor:
+            cursor.executemany(self._sql(self.DELETE_SQL), [(message_id,) for message_id in message_ids])
+
+    def search(self, query, room_ids, user_id=None, before_id=None, limit=20):
+        match = build_fts5_match(query, room_ids, get_audiences(user_id))
+        if match is None:
+            return []
+        with self.connection.cursor() as cursor:
+            cursor.execute(self._sql(self.SEARCH_SQL), [match, before_id or MAX_ROWID, limit])
+            return [row[0] for row in cursor.fetchall()]
+
+
+MAX_ROWID = 2 ** 63 - 1
+
+
+def _fts5_or(values):
+    return '(' + ' OR '.join('"{}"'.format(value) for value in values) + ')'
+
+
+def build_fts5_match(query, room_ids, audiences=None):
+    """
+    FTS5 MATCH 표현식을 만듭니다. 검색할 term이 없으면 None을 반환합니다.
+        ex) tokens : ("채팅 팅방" AND "hel"*) AND room : ("1" OR "2") AND audience : ("all" OR "u5")
+    """
+    terms = tokenize_query(query)
+    if not terms or not room_ids:
+        return None
+    phrases = []
+    for tokens, prefix in terms:
+        phrase = '"{}"'.format(' '.join(tokens))
+        if prefix:
+            phrase += '*'
+        phrases.append(phrase)
+    match = 'tokens : (' + ' AND '.join(phrases) + ')'
+    match += ' AND room : ' + _fts5_or(room_ids)
+    if audiences:
+        match += ' AND audience : ' + _fts5_or(audiences)
+    return match
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """
+    PostgreSQL tsvector + GIN index를 inverted index로 사용합니다.
+    - 'simple' configuration을 사용하므로 형태소 분석 없이 tokenizer 결과(n-gram)가 그대로 lexeme이 됩니다.
+    - phrase 검색은 '<->' (followed-by) 연산자로 처리합니다.
+    """
+    vendor = 'postgresql'
+    table_name = 'chat_message_search'
+
+    CREATE_SQL = (
+        'CREATE TABLE IF NOT EXISTS {table} ('
+        ' message_id integer PRIMARY KEY,'
+        ' room_id integer NOT NULL,'
+        ' audience varchar(32) NOT NULL,'
+        ' tokens tsvector NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS {table}_tokens_idx ON {table} USING GIN (tokens)',
+        'CREATE INDEX IF NOT EXISTS {table}_room_idx ON {table} (room_id, message_id DESC)',
+    )
+    UPSERT_SQL = ("INSERT INTO {table} (message_id, room_id, audience, tokens) "
+                  "VALUES (%s, %s, %s, to_tsvector('simple', %s)) "
+                  "ON CONFLICT (message_id) DO UPDATE SET "
+                  "room_id = EXCLUDED.room_id, audience = EXCLUDED.audience, tokens = EXCLUDED.tokens")
+    DELETE_SQL = 'DELETE FROM {table} WHERE message_id = ANY(%s)'
+    SEARCH_SQL = ("SELECT message_id FROM {table} "
+                  "WHERE tokens @@ to_tsquery('simple', %s) AND room_id = ANY(%s) {audience_filter}"
+                  "AND message_id < %s ORDER BY message_id DESC LIMIT %s")
+
+    def _sql(self, sql, **kwargs):
+        return sql.format(table=self.table_name, **kwargs)
+
+    def setup(self):
+        if self.connection.vendor != 'postgresql':
+            raise ImproperlyConfigured('PostgresSearchBackend requires a postgresql database; got "{}"'.format(
+                self.connection.vendor))
+        with self.connection.cursor() as cursor:
+            for sql in self.CREATE_SQL:
+                cursor.execute(self._sql(sql))
+
+    def index_messages(self, chat_msgs):
+        removed = []
+        rows = []
+        for chat_msg in chat_msgs:
+            tokens = tokenize(chat_msg.text)
+            if tokens:
+                rows.append((chat_msg.id, chat_msg.room_id, get_audience(chat_msg.target_user_id), ' '.join(tokens)))
+            else:
+                removed.append(chat_msg.id)
+        with self.connection.cursor() as cursor:
+            if removed:
+                cursor.execute(self._sql(self.DELETE_SQL), [removed])
+            if rows:
+                cursor.executemany(self._sql(self.UPSERT_SQL), rows)
+
+    def remove_messages(self, message_ids):
+        with self.connection.cursor() as cursor:
+            cursor.execute(self._sql(self.DELETE_SQL), [list(message_ids)])
+
+    def search(self, query, room_ids, user_id=None, before_id=None, limit=20):
+        terms = tokenize_query(query)
+        if not terms or not room_ids:
+            return []
+        phrases = []
+        for tokens, prefix in terms:
+            phrase = ' <-> '.join(tokens)
+            if prefix:
+                phrase += ':*'
+            phrases.append('(' + phrase + ')')
+        params = [' & '.join(phrases), list(room_ids)]
+        audiences = get_audiences(user_id)
+        audience_filter = ''
+        if audiences:
+            audience_filter = 'AND audience = ANY(%s) '
+            params.append(audiences)
+        params += [before_id or MAX_ROWID, limit]
+        with self.connection.cursor() as cursor:
+            cursor.execute(self._sql(self.SEARCH_SQL, audience_filter=audience_filter), params)
+            return [row[0] for row in cursor.fetchall()]
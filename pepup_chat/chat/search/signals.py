@@ -0,0 +1,42 @@
+# -*- encoding: utf-8 -*-
+import logging
+
+from django.db import transaction
+
+from chat.search import get_search_backend, is_search_enabled
+
+logger = logging.getLogger(__name__)
+
+
+def index_chat_message(sender, instance, raw=False, **kwargs):
+    """
+    ChatMessage post_save receiver. 메세지 1건만 incremental하게 index합니다.
+    (transaction이 commit된 뒤에 index하여, rollback된 메세지가 검색되지 않도록 합니다.)
+    """
+    if raw or not is_search_enabled():
+        return
+    transaction.on_commit(lambda: get_search_backend().index_messages([instance]))
+
+
+def remove_chat_message(sender, instance, **kwargs):
+    if not is_search_enabled():
+        return
+    message_id = instance.id
+    transaction.on_commit(lambda: get_search_backend().remove_messages([message_id]))
+
+
+def setup_search_backend(sender, using='default', **kwargs):
+    """
+    post_migrate receiver. index 저장소를 준비합니다.
+    BACKEND가 database vendor와 맞지 않으면 migrate를 실패시키지 않고 건너뜁니다.
+    """
+    if not is_search_enabled():
+        return
+    backend = get_search_backend()
+    if backend.using != using:
+        return
+    if backend.vendor is not None and backend.connection.vendor != backend.vendor:
+        logger.warning('chat search backend %s does not support the %s database; skipping setup',
+                       type(backend).__name__, backend.connection.vendor)
+        return
+    backend.setup()
@@ -0,0 +1,71 @@
+# -*- encoding: utf-8 -*-
+import re
+import unicodedata
+
+"""
+검색 index용 tokenizer입니다.
+
+한글은 조사/어미가 어절에 붙어 있기 때문에("채팅방에서", "채팅방을") 공백 단위 token으로는 부분 검색이 되지 않습니다.
+따라서 한글 구간은 글자 단위 n-gram(기본 bigram)으로 쪼개어 index하고,
+검색어도 같은 방식으로 쪼갠 뒤 "연속된 n-gram"(phrase)으로 검색합니다.
+    - "채팅방에서" -> ["채팅", "팅방", "방에", "에서"]
+영문/숫자 구간은 소문자 단어 단위로 index합니다.
+"""
+
+NGRAM_SIZE = 2
+
+_TOKEN_RE = re.compile(r'[가-힣]+|[0-9a-z]+')
+
+
+def _is_hangul(run):
+    return '가' <= run[0] <= '힣'
+
+
+def _normalize(text):
+    # 호환 문자(전각 영문 등)를 정규화하고, 조합형 한글을 완성형으로 합칩니다.
+    return unicodedata.normalize('NFKC', text or '').lower()
+
+
+def _ngrams(run, n):
+    if len(run) <= n:
+        return [run]
+    return [run[i:i + n] for i in range(len(run) - n + 1)]
+
+
+def iter_runs(text):
+    """
+    (run, is_hangul) tuple을 순서대로 돌려줍니다.
+    """
+    for run in _TOKEN_RE.findall(_normalize(text)):
+        yield run, _is_hangul(run)
+
+
+def tokenize(text, n=NGRAM_SIZE):
+    """
+    index할 token list를 만듭니다.
+    :return: list of str (순서 유지; phrase 검색에 필요)
+    """
+    tokens = []
+    for run, is_hangul in iter_runs(text):
+        if is_hangul:
+            tokens.extend(_ngrams(run, n))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+def tokenize_query(query, n=NGRAM_SIZE):
+    """
+    검색어를 term 단위로 쪼갭니다.
+    :return: list of (tokens, prefix)
+        - tokens : 연속으로 일치해야 하는 token list (phrase)
+        - prefix : True이면 마지막 token을 prefix로 검색합니다.
+          (n보다 짧은 한글 검색어, 입력 중인 영문 단어 등)
+    """
+    terms = []
+    for run, is_hangul in iter_runs(query):
+        if is_hangul:
+            terms.append((_ngrams(run, n), len(run) < n))
+        else:
+            terms.append(([run], True))
+    return terms
@@ -0,0 +1,58 @@
+# -*- encoding: utf-8 -*-
+from django.db.models import Q
+from django.shortcuts import get_object_or_404
+from rest_framework import permissions, serializers
+from rest_framework.exceptions import PermissionDenied
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from chat.models import ChatRoom
+from chat.search import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, search_room_messages, search_user_messages
+from chat.serializers import ChatMessageReadSerializer
+
+
+class MessageSearchParamsSerializer(serializers.Serializer):
+    q = serializers.CharField(max_length=100)
+    before = serializers.IntegerField(required=False, allow_null=True, min_value=1)
+    page_size = serializers.IntegerField(required=False, default=DEFAULT_PAGE_SIZE,
+                                         min_value=1, max_value=MAX_PAGE_SIZE)
+
+
+class MessageSearchViewBase(APIView):
+    """
+    GET ?q=검색어&before=<message id>&page_size=20
+    response : {"results": [...messages], "next_before": <message id or null>}
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get_page(self, request, params):
+        raise NotImplementedError
+
+    def get(self, request, *args, **kwargs):
+        params_serializer = MessageSearchParamsSerializer(data=request.query_params)
+        params_serializer.is_valid(raise_exception=True)
+        page = self.get_page(request, params_serializer.validated_data)
+        return Response({
+            'results': ChatMessageReadSerializer(page.messages, many=True).data,
+            'next_before': page.next_before,
+        })
+
+
+class RoomMessageSearchView(MessageSearchViewBase):
+    def get_page(self, request, params):
+        user = request.user
+        is_staff = getattr(user, 'is_staff', False)  # accounts.User에는 is_staff field가 없습니다.
+        room = get_object_or_404(ChatRoom, id=self.kwargs['room_id'])
+        if not is_staff and not ChatRoom.objects.filter(
+                Q(owner=user) | Q(participants__user=user), id=room.id).exists():
+            raise PermissionDenied()
+        # staff는 target_user 메세지까지 모두 검색합니다.
+        user_id = None if is_staff else user.id
+        return search_room_messages(room.id, params['q'], user_id=user_id,
+                                    before_id=params.get('before'), limit=params['page_size'])
+
+
+class UserMessageSearchView(MessageSearchViewBase):
+    def get_page(self, request, params):
+        return search_user_messages(request.user, params['q'],
+                                    before_id=params.get('before'), limit=params['page_size'])
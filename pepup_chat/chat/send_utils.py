@@ -1,32 +1,86 @@
 # -*- encoding: utf-8 -*-
+import asyncio
 import json
+import threading
 import six
-import time
 
+from asgiref.sync import async_to_sync
+
+from chat import metrics
+from chat.fanout import fanout_group_send
+from chat.heartbeat import ping_frame, pong_frame
 from chat.models import ChatRoom
+from chat.room_state import room_state_store
 from chat.serializers import ChatMessageReadSerializer
 from core.decorators import lazy_property
 
 """
 채널 Group에 관한 Documentation!
 
-현재 3종류의 Group을 사용하여 메세지를 전달하고 있습니다.
+현재 2종류의 Group을 사용하여 메세지를 전달하고 있습니다.
     - "room-{}" : 방에 참여한 모든 client에게 전송하는 경우
     - "room-{}-user-{}" : 특정 사용자에게 전송하는 경우
-    - "room-{}-user-{}-handler-{}" : 특정 사용자에게, 특정 version으로 접속하였을 때에만 전송하는 경우
 
 아래는 참고사항입니다.
-- client가 접속하면, 사용자의 reply_channel이 3개의 Group에 동시에 추가됩니다. (ws_connect 함수 참고)
+- client가 접속하면, 사용자의 channel이 2개의 Group에 동시에 추가됩니다. (ChatConsumer.connect 참고)
+    - 접속한 client의 handler version은 scope['handler_version'] 에 저장됩니다. (query string "?handler_version=N")
 - target_user가 없는 message는 "room-{}"에 전송됩니다.
     - handler version 구분이 구현되어 있지 않으므로, handler version에 상관없이 보여줄 수 있는 메세지만 전송해 주세요.
-- target_user가 있고 target_handler_version이 없는 message는 "room-{}-user-{}"에 전송됩니다.
-- target_user가 있고 target_handler_version이 있는 message는 "room-{}-user-{}-handler-{}"에 전송됩니다.
+- target_user가 있는 message는 "room-{}-user-{}"에 전송됩니다.
+    - target_handler_version이 있으면 event에 "handler_version"을 담아 보내고,
+      consumer가 자신의 handler version과 다르면 버립니다. (matches_handler_version 참고)
+    - (예전에는 "room-{}-user-{}-handler-{}" group을 따로 두었으나, 접속마다 group 관리 비용이 늘어 제거했습니다)
+- group에 보내는 event에는 "room_id"(str)를 담습니다.
+    - 하나의 접속으로 여러 방을 구독하는 MultiplexChatConsumer("ws/chat/")가 어느 방의 frame인지 구분하는 데 사용합니다.
+      이 consumer는 client에게 tag_frame(room_id, payload) 형태로 보냅니다.
 """
 
-def get_group_names(room_id, user_id, handler_version):
+def get_group_names(room_id, user_id):
+    if user_id is None:
+        return ['room-{}'.format(room_id)]
     return ['room-{}'.format(room_id),
-            'room-{}-user-{}'.format(room_id, user_id),
-            'room-{}-user-{}-handler-{}'.format(room_id, user_id, handler_version)]
+            'room-{}-user-{}'.format(room_id, user_id)]
+
+
+def matches_handler_version(target_handler_version, handler_version):
+    """
+    target_handler_version이 지정된 frame을, handler_version으로 접속한 client에게 보내야 하는지 확인합니다.
+    """
+    return not target_handler_version or target_handler_version == handler_version
+
+
+def tag_frame(room_id, text):
+    """
+    이미 encode된 frame(JSON text)에 방 id를 붙입니다. (다시 parse하지 않습니다)
+    :return: '{"room": "<room_id>", "frame": <text>}'
+    """
+    return '{{"room":{},"frame":{}}}'.format(json.dumps(str(room_id)), text)
+
+
+class ConsumerReplyChannel(object):
+    """
+    MessageSender의 reply_channel 자리에 넣는 adapter 입니다. (channels 1의 reply_channel.send 와 같은 interface)
+    - {'text': payload} -> consumer.send(text_data=payload)  (room_id가 있으면 tag_frame으로 감싸서 보냅니다)
+    - {'close': True}   -> consumer.close()
+    event loop thread에서는 task로, 다른 thread(sync 코드)에서는 run_coroutine_threadsafe로 보냅니다.
+    """
+
+    def __init__(self, consumer, room_id=None, loop=None):
+        self.consumer = consumer
+        self.room_id = room_id
+        self.loop = loop or asyncio.get_event_loop()
+        self._loop_thread_id = threading.get_ident()
+
+    def send(self, message, immediately=False):
+        if message.get('close'):
+            coroutine = self.consumer.close()
+        elif self.room_id is not None:
+            coroutine = self.consumer.send(text_data=tag_frame(self.room_id, message['text']))
+        else:
+            coroutine = self.consumer.send(text_data=message['text'])
+        if threading.get_ident() == self._loop_thread_id:
+            return self.loop.create_task(coroutine)
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
 
 
 class DeliveryFailure(Exception):
@@ -37,70 +91,74 @@ def send_to_group(channel_layer, group, message, immediately):
     """
     channels.channel.Group.send 함수 및 asgi_redis.core.send_group 함수를 개선한 버전입니다.
     - immediately=True 일 때
-        - retry-send 기능이 추가되었습니다.
+        - group member 전체에 Redis round-trip 한 번으로 전송합니다. (chat.fanout 참고)
+        - 용량을 넘은 channel에는 retry-send 합니다.
         - n번의 시도 모두 실패한다면, ChannelFull exception을 발생시킵니다. (silently ignore하는 기존 구현과는 다름)
-    :param group: Group instance
+    - immediately=False 일 때 : channel_layer.group_send 로 보냅니다. (용량을 넘은 channel은 layer가 버립니다)
+    :param group: group name (ex: "room-1")
     :param message: data to send (in dict)
     :param immediately:
     """
-    retry_count = 3
     if immediately:
-        # re-implementation of asgi_redis.core.send_group
-        assert channel_layer.valid_group_name(group.name), "Group name not valid"
-        for channel in channel_layer.group_channels(group.name):
-            for i in range(retry_count):  # retry for 3 times, in blocking manner
-                try:
-                    channel_layer.send(channel, message)
-                    break
-                except channel_layer.ChannelFull:
-                    if i == retry_count - 1:
-                        raise  # re-raise ChannelFull
-                    time.sleep(0.2 * (2 ** i))  # exponential delay
-                    continue
+        async_to_sync(fanout_group_send)(channel_layer, group, message)
     else:
-        # # add to pending
-        # from channels.message import pending_message_store
-        # pending_message_store.append(group, message)
-        group.send(message)
+        with metrics.layer_call('group_send'):
+            async_to_sync(channel_layer.group_send)(group, message)
 
 
 class MessageSender(object):
     """
     Client에 메세지를 보낼 때 사용하는 함수들을 모아놓은 class입니다.
     """
-    def __init__(self, channel_layer, room_id, reply_channel, session_data=None):
+    def __init__(self, channel_layer, room_id, reply_channel, session_data=None, room=None, role_dict=None):
+        """
+        :param room, role_dict: 이미 읽어 둔 값이 있으면 넘겨주세요. (chat.context.ConnectionContext)
+                                없으면 처음 필요할 때 DB에서 읽습니다.
+        """
         self.channel_layer = channel_layer
         self.room_id = room_id
         self.reply_channel = reply_channel
         if not session_data:
             session_data = {}
         self.session_data = session_data
+        self.role_dict = role_dict
+        if room is not None:
+            self._cache_room = room
 
     @lazy_property
     def room(self):
         return ChatRoom.objects.get(id=self.room_id)
 
+    def set_room(self, room, role_dict):
+        self._cache_room = room
+        self.role_dict = role_dict
+
+    def get_role_dict(self):
+        if self.role_dict is None:
+            return self.room.get_role_dict()
+        return self.role_dict
+
     #
     # Delivery functions
     #
+    @metrics.timed_stage('group_send')
     def _send_payload_to_group(self, payload, immediately):
-        group = Group('room-{}'.format(self.room_id), channel_layer=self.channel_layer)
         send_to_group(channel_layer=self.channel_layer,
-                      group=group,
-                      message={'text': payload},
+                      group='room-{}'.format(self.room_id),
+                      message={'type': 'chat.payload', 'text': payload, 'room_id': str(self.room_id)},
                       immediately=immediately)
 
-    def _send_payload_to_user(self, payload, target_user, target_handler_version, immediately):
+    @metrics.timed_stage('group_send')
+    def _send_payload_to_user(self, payload, target_user_id, target_handler_version, immediately):
+        message = {'type': 'chat.payload', 'text': payload, 'room_id': str(self.room_id)}
         if target_handler_version:
-            group = Group('room-{}-user-{}-handler-{}'.format(self.room_id, target_user.id, target_handler_version),
-                          channel_layer=self.channel_layer)
-        else:
-            group = Group('room-{}-user-{}'.format(self.room_id, target_user.id), channel_layer=self.channel_layer)
+            message['handler_version'] = target_handler_version  # consumer에서 걸러냅니다.
         send_to_group(channel_layer=self.channel_layer,
-                      group=group,
-                      message={'text': payload},
+                      group='room-{}-user-{}'.format(self.room_id, target_user_id),
+                      message=message,
                       immediately=immediately)
 
+    @metrics.timed_stage('socket_send')
     def _send_payload_to_reply_channel(self, payload, immediately):
         self.reply_channel.send({'text': payload}, immediately=immediately)
 
@@ -109,33 +167,36 @@ class MessageSender(object):
         # - fetch의 경우, user 단위가 아닌 session 단위로 메세지를 전송해야 합니다.
         #   따라서 reply_channel에 직접 메세지를 전송합니다.
         context = self.session_data.copy()
-        context['role_dict'] = self.room.get_role_dict()
-        payload = json.dumps({
-            "type": "messages",
-            "messages": ChatMessageReadSerializer(chat_msgs, context=context, many=True).data,
-        })
+        context['role_dict'] = self.get_role_dict()
+        with metrics.stage_timer('serialize'):
+            payload = json.dumps({
+                "type": "messages",
+                "messages": ChatMessageReadSerializer(chat_msgs, context=context, many=True).data,
+            })
         self._send_payload_to_reply_channel(payload, immediately=False)
 
     def deliver_messages(self, chat_msgs, immediately=False):
         context = self.session_data.copy()
-        context['role_dict'] = self.room.get_role_dict()
-        broadcast_messages = list(filter(lambda msg: not msg.target_user, chat_msgs))
-        target_messages = list(filter(lambda msg: msg.target_user, chat_msgs))
+        context['role_dict'] = self.get_role_dict()
+        broadcast_messages = list(filter(lambda msg: not msg.target_user_id, chat_msgs))
+        target_messages = list(filter(lambda msg: msg.target_user_id, chat_msgs))
         # broadcast message : send to room
         if broadcast_messages:
-            payload = json.dumps({
-                "type": "messages",
-                "messages": ChatMessageReadSerializer(broadcast_messages, context=context, many=True).data,
-            })
+            with metrics.stage_timer('serialize'):
+                payload = json.dumps({
+                    "type": "messages",
+                    "messages": ChatMessageReadSerializer(broadcast_messages, context=context, many=True).data,
+                })
             self._send_payload_to_group(payload, immediately=immediately)
         # target message : send to (room-user)
         for message in target_messages:
-            payload = json.dumps({
-                "type": "messages",
-                "messages": [ChatMessageReadSerializer(message, context=context).data],
-            })
+            with metrics.stage_timer('serialize'):
+                payload = json.dumps({
+                    "type": "messages",
+                    "messages": [ChatMessageReadSerializer(message, context=context).data],
+                })
             self._send_payload_to_user(payload=payload,
-                                       target_user=message.target_user,
+                                       target_user_id=message.target_user_id,
                                        target_handler_version=message.target_handler_version,
                                        immediately=immediately)
 
@@ -143,12 +204,17 @@ class MessageSender(object):
         self.deliver_messages([chat_msg], immediately=immediately)
 
     def send_room_states(self, room_states, target_user, immediately=False):
-        payload = json.dumps({
-            "type": "room_states",
-            "room_states": room_states,
-        })
-        if target_user is not None:
-            self._send_payload_to_user(payload, target_user=target_user,
+        """
+        이전에 보낸 상태와 같으면 보내지 않고, 다르면 바뀐 부분(JSON patch)만 보냅니다. (chat/room_state.py)
+        :param target_user: User or user id (None이면 방 전체)
+        """
+        target_user_id = getattr(target_user, 'id', target_user)
+        update = room_state_store.update(self.room_id, target_user_id, room_states)
+        if update is None:
+            return
+        payload = json.dumps(update.frame)
+        if target_user_id is not None:
+            self._send_payload_to_user(payload, target_user_id=target_user_id,
                                        target_handler_version=None, immediately=immediately)
         else:
             self._send_payload_to_group(payload, immediately=immediately)
@@ -180,18 +246,10 @@ class MessageSender(object):
 
     def send_ping(self, identifier, immediately=False):
         assert type(identifier) in six.string_types
-        payload = json.dumps({
-            "type": "ping",
-            "identifier": identifier,
-        })
-        self._send_payload_to_reply_channel(payload, immediately=immediately)
+        self._send_payload_to_reply_channel(ping_frame(identifier), immediately=immediately)
 
     def send_pong(self, identifier, immediately=False):
-        payload = json.dumps({
-            "type": "pong",
-            "identifier": identifier,
-        })
-        self._send_payload_to_reply_channel(payload, immediately=immediately)
+        self._send_payload_to_reply_channel(pong_frame(identifier), immediately=immediately)
 
     def send_close(self, immediately=False):
         self.reply_channel.send({'close': True}, immediately=immediately)
@@ -3,12 +3,13 @@
 import re
 
 from django.contrib.auth import get_user_model
-from django.contrib.sites.models import Site
+from django.db import models
 from rest_framework import serializers
 
 User = get_user_model()
 
 from chat.models import ChatRoom, ChatMessage
+from chat.user_cards import build_user_card, get_user_card, get_user_cards
 from core.aws.fields import URLResolvableUUIDField
 
 
@@ -22,6 +23,9 @@ class ChatRoomSerializer(serializers.ModelSerializer):
         fields = ('id', 'room_type', 'owner', 'websocket_url', 'another_selves')
 
     def get_websocket_url(self, instance):
+        # django.contrib.sites는 INSTALLED_APPS에 없으므로, module import 시점에 Site를 import하지 않습니다.
+        # (chat.apps.ChatConfig.ready -> chat.context -> send_utils -> serializers)
+        from django.contrib.sites.models import Site
         domain = Site.objects.get(name='chat').domain
         return 'ws://{domain}/chat/{pk}/'.format(domain=domain, pk=instance.id)
 
@@ -32,21 +36,41 @@ class ChatRoomSerializer(serializers.ModelSerializer):
 #
 # Message serializer
 #
-class ChatUserSerializer(serializers.ModelSerializer):
-    nickname = serializers.CharField(source='social_default_nickname')
-    profile_image_url = serializers.CharField(source='social_default_profile_image_url')
+class ChatUserSerializer(serializers.Serializer):
+    """
+    user card(chat.user_cards)를 serialize합니다. User instance를 넘기면 card cache에서 찾습니다.
+    """
+    id = serializers.IntegerField()
+    nickname = serializers.CharField()
+    profile_image_url = serializers.CharField(allow_null=True)
     role = serializers.SerializerMethodField()
     is_staff = serializers.BooleanField()
 
-    class Meta:
-        model = User
-        fields = ('id', 'nickname', 'profile_image_url', 'role', 'is_staff')
+    def to_representation(self, instance):
+        if not isinstance(instance, dict):
+            card = get_user_card(instance.id)
+            # 삭제되었거나 DB에 없는 사용자는 넘겨받은 instance로 card를 만듭니다.
+            instance = card if card is not None else build_user_card(instance, {})
+        return super(ChatUserSerializer, self).to_representation(instance)
 
-    def get_role(self, user):
+    def get_role(self, card):
         role_dict = self.context.get('role_dict', None)
         if not role_dict:
             return 'none'
-        return role_dict.get(user.id, 'none')
+        return role_dict.get(card['id'], 'none')
+
+
+class ChatMessageListSerializer(serializers.ListSerializer):
+    """
+    serialize하기 전에 source user card를 한 번에 가져옵니다. (메세지마다 user query를 하지 않도록)
+    """
+
+    def to_representation(self, data):
+        chat_msgs = list(data.all() if isinstance(data, models.Manager) else data)
+        user_cards = dict(self.context.get('user_cards') or {})
+        user_cards.update(get_user_cards([chat_msg.source_user_id for chat_msg in chat_msgs]))
+        self.context['user_cards'] = user_cards
+        return super(ChatMessageListSerializer, self).to_representation(chat_msgs)
 
 
 class ChatMessageReadSerializer(serializers.ModelSerializer):
@@ -65,6 +89,7 @@ class ChatMessageReadSerializer(serializers.ModelSerializer):
     is_hidden = serializers.BooleanField()  # 메세지를 visible -> invisible로 변경 시, hide후 deliver하기 때문에 필요
     created_at = serializers.DateTimeField()
     updated_at = serializers.DateTimeField()
+    source = serializers.SerializerMethodField()
 
     def to_representation(self, instance):
         """
@@ -75,8 +100,12 @@ class ChatMessageReadSerializer(serializers.ModelSerializer):
 
         ret = OrderedDict()
         fields = self._readable_fields
+        # (MODIFIED) skip deferred columns (ex: ChatMessage.objects.for_read(with_extras=False))
+        deferred = instance.get_deferred_fields() if isinstance(instance, models.Model) else ()
 
         for field in fields:
+            if deferred and (field.source in deferred or (field.source == 'command' and 'extras' in deferred)):
+                continue
             try:
                 attribute = field.get_attribute(instance)
             except Exception:
@@ -98,6 +127,7 @@ class ChatMessageReadSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = ChatMessage
+        list_serializer_class = ChatMessageListSerializer
         fields = (
             'id',
             'type',
@@ -150,6 +180,16 @@ class ChatMessageReadSerializer(serializers.ModelSerializer):
                 return resized_url
         return original_content_url
 
+    def get_source(self, chat_msg):
+        if chat_msg.source_user_id is None:
+            return None
+        card = (self.context.get('user_cards') or {}).get(chat_msg.source_user_id)
+        if card is None:
+            card = get_user_card(chat_msg.source_user_id)
+        if card is None:
+            return None
+        return ChatUserSerializer(card, context=self.context).data
+
     def get_lottie_emoji_url(self, chat_msg):
         if not chat_msg.lottie_emoji_key:
             return ''
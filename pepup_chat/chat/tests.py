@@ -1,3 +1,1136 @@
-from django.test import TestCase
+import asyncio
+import atexit
+import json
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.apps import apps
+from django.contrib.auth.models import AnonymousUser
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.db.migrations.state import ProjectState
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.serializers import ValidationError
+from rest_framework.test import APIClient
+
+from accounts.models import Profile, User
+from chat.archive import ArchiveStore, archive_messages
+from chat.consumers import MultiplexChatConsumer
+from chat.db_pool import ConnectionRegistry, PooledExecutor
+from chat.executors import run_write
+from chat.index_audit import (
+    IndexInfo, QueryPattern, build_index_operations, find_redundant_indexes, find_unused_indexes, parse_pattern_key,
+    parse_query_pattern, pattern_key, recommend_indexes, render_migration,
+)
+from chat import journal as chat_journal, metrics
+from chat.journal import DEAD_LETTER_DIRECTORY, MessageJournal, flush_entries
+from chat.heartbeat import IDLE_CLOSE_CODE, PING_FRAME, TimerWheel, heartbeat_reply
+from chat.history import fetch_room_history
+from chat.message_models import (
+    ButtonsMessageTmpl, ImageChatMessageTmpl, PostbackAction, TemplateRenderCache, TextChatMessageTmpl, template_cache,
+)
+from chat.metrics import MetricsRegistry
+from chat.models import ChatMessage, ChatRoom
+from chat.profile_models import ChatSource
+from chat.ratelimit import POSTBACK, TEXT, Policy, RateLimiter, classify_frame, shared_buckets
+from chat.room_state import (
+    RoomStateLockTimeout, _cache_key, apply_patch, check_room_state_cache, get_state_cache, make_patch, room_state_store,
+)
+from chat.routing import websocket_urlpatterns
+from chat.search import get_search_backend, search_room_messages
+from chat.search.backends import SQLiteFTS5Backend, build_fts5_match
+from chat.search.signals import setup_search_backend
+from chat.search.tokenizer import tokenize, tokenize_query
+from chat.send_utils import MessageSender
+from chat.serializers import ChatMessageReadSerializer, ChatUserSerializer
+from chat.user_cards import get_shared_cache, get_user_card, get_user_cards, invalidate_user_card, local_cards
+from core.aws import S3_HOST
+from core.fields import RawJSON, loads
+
+
+class MessageFetchQueryCountTest(TestCase):
+    """
+    history fetch + ChatMessageReadSerializer(many=True) 의 query 수가 page 크기와 무관해야 합니다.
+    """
+    SPEAKERS = 5
+
+    @classmethod
+    def setUpTestData(cls):
+        # accounts.User는 test 동안에만 managed입니다. (core.test_runner) User.save()는 저장하지 않으므로 bulk_create로 만듭니다.
+        User.objects.bulk_create([User(id=user_id, email='user{}@example.com'.format(user_id))
+                                  for user_id in range(1, cls.SPEAKERS + 1)])
+        cls.room = ChatRoom.objects.create(owner_id=1)
+        ChatMessage.objects.bulk_create([
+            ChatMessage(message_type=1, room=cls.room, text='message {}'.format(i), code='chat$chat', version=1,
+                        source_user_id=i % cls.SPEAKERS + 1, template={'type': 'text'}, extras={'seq': i})
+            for i in range(60)
+        ])
+        cls.target_room = ChatRoom.objects.create(owner_id=1)
+        ChatMessage.objects.bulk_create([
+            ChatMessage(message_type=1, room=cls.target_room, text='only for {}'.format(i % cls.SPEAKERS + 1),
+                        code='chat$chat', version=1, source_user_id=1, target_user_id=i % cls.SPEAKERS + 1)
+            for i in range(20)
+        ])
+
+    def setUp(self):
+        local_cards.set_many({user_id: {'id': user_id, 'nickname': 'user{}'.format(user_id),
+                                        'profile_image_url': None, 'is_staff': False}
+                              for user_id in range(1, self.SPEAKERS + 1)})
+
+    def tearDown(self):
+        local_cards.clear()
+
+    def _count_queries(self, limit, **kwargs):
+        with CaptureQueriesContext(connection) as context:
+            chat_msgs = fetch_room_history(self.room.id, limit=limit, include_archive=False, **kwargs)
+            data = ChatMessageReadSerializer(chat_msgs, many=True).data
+        self.assertEqual(len(data), limit)
+        return len(context.captured_queries)
+
+    def test_constant_query_count(self):
+        self.assertEqual(self._count_queries(5), self._count_queries(50))
+
+    def test_single_query_with_deferred_columns(self):
+        self.assertEqual(self._count_queries(50, with_template=False, with_extras=False), 1)
+
+    def test_deliver_targeted_messages_without_user_queries(self):
+        sender = MessageSender(InMemoryChannelLayer(), self.target_room.id, reply_channel=None,
+                               room=self.target_room, role_dict={})
+        for limit in (2, 20):
+            chat_msgs = list(fetch_room_history(self.target_room.id, limit=limit, include_archive=False))
+            with CaptureQueriesContext(connection) as context:
+                sender.deliver_messages(chat_msgs)
+            self.assertEqual(len(context.captured_queries), 0)
+
+    def test_deferred_columns_are_skipped(self):
+        chat_msgs = fetch_room_history(self.room.id, limit=3, include_archive=False, with_extras=False)
+        data = ChatMessageReadSerializer(chat_msgs, many=True).data
+        self.assertNotIn('extras', data[0])
+        self.assertEqual(data[0]['source']['nickname'], 'user{}'.format(chat_msgs[0].source_user_id))
+
+
+class ArchiveHistoryTest(TestCase):
+    """
+    archive는 room별 segment에 이어 쓰다가 cap에 도달하면 닫고, 중단 후 state.json부터 이어서 진행해야 합니다.
+    fetch_room_history는 hot table -> archive 순으로 빠짐없이 이어져야 합니다.
+    """
+
+    def setUp(self):
+        User.objects.bulk_create([User(id=1, email='user1@example.com')])
+        self.room, self.other_room = ChatRoom.objects.create(owner_id=1), ChatRoom.objects.create(owner_id=1)
+        # room 메세지 12개, other_room 메세지 6개가 섞여 있고, room의 마지막 2개만 최근 메세지입니다.
+        ChatMessage.objects.bulk_create([
+            ChatMessage(message_type=1, room=self.room if i % 3 else self.other_room, text='message {}'.format(i),
+                        code='chat$chat', version=1, source_user_id=1)
+            for i in range(18)
+        ])
+        ChatMessage.objects.update(created_at=timezone.now() - timedelta(days=365))
+        ChatMessage.objects.create(message_type=1, room=self.room, text='hot 1', code='chat$chat', version=1)
+        ChatMessage.objects.create(message_type=1, room=self.room, text='hot 2', code='chat$chat', version=1)
+        self.room_ids = list(ChatMessage.objects.filter(room=self.room).order_by('-id').values_list('id', flat=True))
+        self.root = tempfile.mkdtemp()
+        self.store = ArchiveStore(root=self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _room_files(self, room_id):
+        return sorted(os.listdir(os.path.join(self.root, 'room-{}'.format(room_id))))
+
+    def test_archive_resume_and_read_back(self):
+        with override_settings(CHAT_ARCHIVE={'SEGMENT_MAX_ROWS': 5}):
+            self.assertEqual(archive_messages(store=self.store, batch_size=4, max_batches=1), 4)
+            # 중단된 실행이 state를 저장하기 전에 이어 쓴 member는 읽지 않고, 다시 실행할 때 잘라냅니다.
+            segment = self.store.load_state()['open_segments'][str(self.room.id)]
+            path = os.path.join(self.root, 'room-{}'.format(self.room.id),
+                                '{:012d}-open.jsonl.gz'.format(segment['first_id']))
+            with open(path, 'ab') as f:
+                f.write(b'uncommitted')
+            self.assertEqual(archive_messages(store=self.store, batch_size=4), 14)
+
+        self.assertEqual(ChatMessage.objects.count(), 2)
+        # batch(5번)마다 파일을 만들지 않고, 5개씩 이어 쓴 뒤 닫습니다.
+        room_files = self._room_files(self.room.id)
+        self.assertEqual(len(room_files), 3)
+        self.assertEqual(len([filename for filename in room_files if filename.endswith('-open.jsonl.gz')]), 1)
+        self.assertEqual(len(self._room_files(self.other_room.id)), 1)
+
+        with override_settings(CHAT_ARCHIVE={'ROOT': self.root}):
+            fetched, before_id = [], None
+            while True:
+                chat_msgs = fetch_room_history(self.room.id, before_id=before_id, limit=5)
+                if not chat_msgs:
+                    break
+                fetched += chat_msgs
+                before_id = chat_msgs[-1].id
+        self.assertEqual([chat_msg.id for chat_msg in fetched], self.room_ids)
+        self.assertEqual(fetched[2].text, 'message 17')
+
+
+class FastJSONFieldTest(TestCase):
+    """
+    DB에서 읽은 template / extras 는 접근할 때 decode되어야 합니다. (core.fields.LazyJSONAttribute)
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        User.objects.bulk_create([User(id=1, email='user1@example.com')])
+        cls.room = ChatRoom.objects.create(owner_id=1)
+        cls.chat_msg = ChatMessage.objects.create(
+            message_type=7, room=cls.room, text='', code='chat$chat', version=1, template={'type': 'buttons'},
+            extras={'command_code': 'open', 'postback_message_code': 'chat$open', 'params': {'id': 3}})
+
+    def test_read(self):
+        chat_msg = ChatMessage.objects.get(id=self.chat_msg.id)
+        self.assertEqual(chat_msg.template, {'type': 'buttons'})
+        self.assertEqual(chat_msg.command, {'code': 'open', 'postback_message_code': 'chat$open', 'params': {'id': 3}})
+        self.assertEqual(ChatMessageReadSerializer(chat_msg).data['template'], {'type': 'buttons'})
+
+    def test_mutate_and_save(self):
+        chat_msg = ChatMessage.objects.get(id=self.chat_msg.id)
+        chat_msg.template['b'] = 1
+        chat_msg.save()
+        self.assertEqual(ChatMessage.objects.get(id=self.chat_msg.id).template, {'type': 'buttons', 'b': 1})
+
+    def test_untouched_value_is_saved_as_read(self):
+        chat_msg = ChatMessage.objects.get(id=self.chat_msg.id)
+        chat_msg.text = 'edited'
+        chat_msg.save()
+        self.assertEqual(ChatMessage.objects.values_list('extras', flat=True).get(id=self.chat_msg.id),
+                         '{"command_code":"open","postback_message_code":"chat$open","params":{"id":3}}')
+        self.assertEqual(ChatMessage.objects.get(id=self.chat_msg.id).extras['params'], {'id': 3})
+
+    def test_values_list_returns_raw_json(self):
+        # jsonfield와 달리 values() / values_list() 는 decode하지 않습니다.
+        template = ChatMessage.objects.values_list('template', flat=True).get(id=self.chat_msg.id)
+        self.assertIsInstance(template, RawJSON)
+        self.assertEqual(loads(template), {'type': 'buttons'})
+
+    def test_deferred_field(self):
+        chat_msg = ChatMessage.objects.defer('template').get(id=self.chat_msg.id)
+        self.assertIn('template', chat_msg.get_deferred_fields())
+        self.assertEqual(chat_msg.template, {'type': 'buttons'})
+
+
+class MessageSenderDeliveryTest(TestCase):
+    """
+    broadcast 메세지는 "room-{}", target 메세지는 "room-{}-user-{}" group으로 전송되어야 합니다.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        User.objects.bulk_create([User(id=user_id, email='user{}@example.com'.format(user_id))
+                                  for user_id in (1, 2)])
+        cls.room = ChatRoom.objects.create(owner_id=1)
+        cls.broadcast = ChatMessage.objects.create(message_type=1, room=cls.room, text='hello', code='chat$chat',
+                                                   version=1)
+        cls.targeted = ChatMessage.objects.create(message_type=1, room=cls.room, text='only you', code='chat$chat',
+                                                  version=1, target_user_id=2, target_handler_version=3)
+
+    def _receive(self, layer, channel):
+        events = []
+
+        async def drain():
+            while not layer.channels.get(channel, asyncio.Queue()).empty():
+                events.append(await layer.receive(channel))
+        async_to_sync(drain)()
+        return events
+
+    def test_deliver_messages(self):
+        layer = InMemoryChannelLayer()
+        room_group = 'room-{}'.format(self.room.id)
+        async_to_sync(layer.group_add)(room_group, 'room-member')
+        async_to_sync(layer.group_add)('{}-user-2'.format(room_group), 'target-user')
+        sender = MessageSender(layer, self.room.id, reply_channel=None, room=self.room, role_dict={})
+
+        for immediately in (False, True):
+            sender.deliver_messages([self.broadcast, self.targeted], immediately=immediately)
+            [room_event] = self._receive(layer, 'room-member')
+            self.assertEqual((room_event['type'], room_event['room_id']), ('chat.payload', str(self.room.id)))
+            self.assertEqual([msg['text'] for msg in json.loads(room_event['text'])['messages']], ['hello'])
+            [user_event] = self._receive(layer, 'target-user')
+            self.assertEqual(user_event['handler_version'], 3)
+            self.assertEqual([msg['text'] for msg in json.loads(user_event['text'])['messages']], ['only you'])
+
+
+class UserCardTest(TestCase):
+    """
+    get_user_cards : process-local LRU -> shared cache -> DB 순서로 찾습니다.
+    """
+
+    def setUp(self):
+        User.objects.bulk_create([
+            User(id=21, email='a@example.com', nickname='alice'),
+            User(id=22, email='b@example.com', nickname='bob'),
+            User(id=23, email='c@example.com', phone='01012345678'),
+        ])
+        Profile.objects.create(user_id=21, thumbnail_img='profile/21.png')
+
+    def tearDown(self):
+        local_cards.clear()
+        get_shared_cache().clear()
+
+    def test_batched_load(self):
+        with self.assertNumQueries(1):
+            cards = get_user_cards([21, 22, 23, 24, None])
+        self.assertEqual(sorted(cards), [21, 22, 23])
+        self.assertEqual(cards[21]['nickname'], 'alice')
+        self.assertTrue(cards[21]['profile_image_url'].endswith('profile/21.png'))
+        self.assertIsNone(cards[22]['profile_image_url'])
+
+    def test_user_without_nickname_does_not_expose_contact(self):
+        card = get_user_card(23)
+        self.assertEqual(card['nickname'], '')
+        self.assertNotIn('01012345678', json.dumps(card))
+
+    def test_local_then_shared_then_db(self):
+        get_user_cards([21, 22])
+        with self.assertNumQueries(0):
+            self.assertEqual(get_user_card(21)['nickname'], 'alice')  # local
+        local_cards.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_user_card(22)['nickname'], 'bob')  # shared cache
+        self.assertEqual(local_cards.get_many([22]), {22: get_user_card(22)})
+        local_cards.clear()
+        get_shared_cache().clear()
+        with self.assertNumQueries(1):
+            get_user_cards([21, 22])
+
+    def test_invalidation(self):
+        get_user_cards([21, 22])
+        User.objects.filter(id=21).update(nickname='alice2')  # signal 없이 바뀐 경우 : cache 값을 그대로 사용
+        self.assertEqual(get_user_card(21)['nickname'], 'alice')
+        invalidate_user_card(21)
+        self.assertEqual(get_user_card(21)['nickname'], 'alice2')
+
+        Profile.objects.create(user_id=22, thumbnail_img='profile/22.png')  # post_save receiver
+        self.assertTrue(get_user_card(22)['profile_image_url'].endswith('profile/22.png'))
+
+    def test_serializer_with_missing_user(self):
+        data = ChatUserSerializer(User(id=99, email='gone@example.com')).data
+        self.assertEqual((data['id'], data['nickname'], data['profile_image_url']), (99, '', None))
+
+
+class SearchTokenizerTest(SimpleTestCase):
+
+    def test_hangul_bigrams(self):
+        self.assertEqual(tokenize('채팅방에서 Hello, World2!'), ['채팅', '팅방', '방에', '에서', 'hello', 'world2'])
+        self.assertEqual(tokenize('방 ＡＢＣ'), ['방', 'abc'])  # 한 글자 / 전각 영문(NFKC)
+        self.assertEqual(tokenize(None), [])
+
+    def test_query_terms(self):
+        self.assertEqual(tokenize_query('채팅방 방 hel'),
+                         [(['채팅', '팅방'], False), (['방'], True), (['hel'], True)])
+
+    def test_fts5_match(self):
+        self.assertEqual(build_fts5_match('채팅방 hel', [1, 2], ['all', 'u5']),
+                         'tokens : ("채팅 팅방" AND "hel"*) AND room : ("1" OR "2") AND audience : ("all" OR "u5")')
+        self.assertIsNone(build_fts5_match('!!', [1]))
+
+
+class SQLiteFTS5SearchTest(TestCase):
+    """
+    index -> search (phrase / audience) -> before_id pagination
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        User.objects.bulk_create([User(id=user_id, email='user{}@example.com'.format(user_id)) for user_id in (1, 2)])
+        cls.room = ChatRoom.objects.create(owner_id=1)
+        texts = ['채팅방에서 만나요', '채팅 방', '새 채팅방을 열었어요', 'hello chat', '채팅방 공지']
+        cls.messages = [ChatMessage.objects.create(message_type=1, room=cls.room, text=text, code='chat$chat',
+                                                   version=1) for text in texts]
+        cls.private = ChatMessage.objects.create(message_type=1, room=cls.room, text='비밀 채팅방', code='chat$chat',
+                                                 version=1, target_user_id=2)
+
+    def setUp(self):
+        self.backend = get_search_backend()
+        self.assertIsInstance(self.backend, SQLiteFTS5Backend)  # sqlite database의 기본 backend
+        self.backend.setup()
+        self.backend.index_messages(self.messages + [self.private])
+
+    def _search_all(self, query, user_id, page_size):
+        found, before = [], None
+        while True:
+            page = search_room_messages(self.room.id, query, user_id=user_id, before_id=before, limit=page_size)
+            found.extend(message.id for message in page.messages)
+            if page.next_before is None:
+                return found
+            before = page.next_before
+
+    def test_phrase_search_with_pagination(self):
+        expected = [self.messages[4].id, self.messages[2].id, self.messages[0].id]  # '채팅 방'은 phrase가 아님
+        self.assertEqual(self._search_all('채팅방', user_id=1, page_size=2), expected)
+        self.assertEqual(self._search_all('채팅방', user_id=2, page_size=2), [self.private.id] + expected)
+        self.assertEqual(self._search_all('hel', user_id=1, page_size=2), [self.messages[3].id])
+
+    def test_reindex_and_remove(self):
+        # setUpTestData의 instance는 test 사이에 공유되므로 다시 읽어서 바꿉니다.
+        notice = ChatMessage.objects.get(id=self.messages[4].id)
+        notice.text = '공지'
+        self.backend.index_messages([notice])
+        self.backend.remove_messages([self.messages[0].id])
+        self.assertEqual(self._search_all('채팅방', user_id=1, page_size=10), [self.messages[2].id])
+
+    def test_room_search_view(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.get(id=2))
+        self.assertEqual(client.get('/chat/rooms/{}/search/'.format(self.room.id), {'q': '채팅방'}).status_code, 403)
+        client.force_authenticate(User.objects.get(id=1))
+        response = client.get('/chat/rooms/{}/search/'.format(self.room.id), {'q': '채팅방', 'page_size': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([message['id'] for message in response.data['results']],
+                         [self.messages[4].id, self.messages[2].id])
+        self.assertEqual(response.data['next_before'], self.messages[2].id)
+
+    @override_settings(CHAT_SEARCH={'BACKEND': 'chat.search.backends.PostgresSearchBackend'})
+    def test_setup_skips_other_vendor(self):
+        with mock.patch('chat.search._backend', None):
+            setup_search_backend(sender=None)  # migrate를 실패시키지 않습니다.
+            with self.assertRaises(ImproperlyConfigured):
+                get_search_backend().setup()
+
+
+class IndexAuditTest(TestCase):
+    MESSAGE_TABLE = 'chat_chatmessage'
+
+    def _index(self, name, columns, unique=False, table=MESSAGE_TABLE):
+        return IndexInfo(name, table, tuple(columns), unique, False, 'database')
+
+    def test_parse_query_pattern(self):
+        sql = ('SELECT "chat_chatmessage"."id", "chat_chatmessage"."text" FROM "chat_chatmessage" '
+               'WHERE ("chat_chatmessage"."room_id" = %s AND "chat_chatmessage"."id" < %s) '
+               'ORDER BY "chat_chatmessage"."id" DESC LIMIT 20')
+        pattern = parse_query_pattern(sql)
+        self.assertEqual(pattern, QueryPattern(self.MESSAGE_TABLE, ('room_id',), ('id',), ('id',)))
+        self.assertEqual(parse_pattern_key(pattern_key(pattern)), pattern)
+        self.assertIsNone(parse_query_pattern('INSERT INTO "chat_chatmessage" ("text") VALUES (%s)'))
+        self.assertIsNone(parse_query_pattern('SELECT 1'))
+
+    def test_redundant_and_unused_indexes(self):
+        room = self._index('room', ['room_id'])
+        room_id = self._index('room_id', ['room_id', 'id'])
+        token = self._index('token', ['token'], unique=True)
+        created = self._index('created', ['created_at'])
+        created_copy = self._index('created_copy', ['created_at'])
+        indexes = [room, room_id, token, created, created_copy]
+        self.assertEqual(find_redundant_indexes(indexes),
+                         [(room, room_id, 'prefix'), (created_copy, created, 'duplicate')])
+        patterns = [QueryPattern(self.MESSAGE_TABLE, ('room_id',), ('id',), ('id',))]
+        self.assertEqual(find_unused_indexes(indexes, patterns), [created, created_copy])
+
+    def test_recommend_indexes(self):
+        pattern = QueryPattern(self.MESSAGE_TABLE, ('target_user_id',), (), ('id',))
+        self.assertEqual(recommend_indexes([], [(pattern, 10)], min_count=5),
+                         [(self.MESSAGE_TABLE, ('target_user_id', 'id'), 10)])
+        self.assertEqual(recommend_indexes([], [(pattern, 1)], min_count=5), [])
+        covering = self._index('target', ['target_user_id', 'id', 'room_id'])
+        self.assertEqual(recommend_indexes([covering], [(pattern, 10)]), [])
+
+    def test_migration_updates_model_state(self):
+        drops = [
+            self._index('chat_created_at_idx', ['created_at']),  # db_index=True field
+            self._index('chat_msg_room_id_idx', ['room_id', 'id']),  # Meta.indexes
+            self._index('manual_text_idx', ['text']),  # DB에만 있는 index
+        ]
+        creates = [('chat_chatroomparticipant', ('role', 'user_id'))]
+        operations, notes = build_index_operations(connection, apps, drops, creates)
+        self.assertEqual([type(operation).__name__ for operation in operations],
+                         ['SeparateDatabaseAndState', 'SeparateDatabaseAndState', 'RunSQL', 'AddIndex'])
+        self.assertEqual(len(notes), 3)
+
+        state = ProjectState.from_apps(apps)
+        for operation in operations:
+            operation.state_forwards('chat', state)
+        message = state.models['chat', 'chatmessage']
+        self.assertFalse(dict(message.fields)['created_at'].db_index)
+        self.assertEqual(message.options['indexes'], [])
+        participant_indexes = state.models['chat', 'chatroomparticipant'].options['indexes']
+        self.assertEqual([index.fields for index in participant_indexes], [['role', 'user']])
+        self.assertLessEqual(len(participant_indexes[0].name), 30)
+
+        source = render_migration(operations, '0004_trim_chatmessage_indexes', '0005_audit_chat_indexes')
+        namespace = {}
+        exec(compile(source, '0005_audit_chat_indexes.py', 'exec'), namespace)
+        self.assertEqual(len(namespace['Migration'].operations), 4)
+
+
+class MessageJournalTest(TransactionTestCase):
+    """
+    journal entry는 여러 번 replay해도 한 번만 저장되고, 저장할 수 없는 entry는 나머지를 막지 않아야 합니다.
+    (FK 검사가 commit 시점에 일어나므로 TransactionTestCase 입니다)
+    """
+
+    def setUp(self):
+        User.objects.bulk_create([User(id=1, email='user1@example.com')])
+        self.room = ChatRoom.objects.create(owner_id=1)
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _entry(self, text, room_id=None, created_at='2020-01-01T00:00:00+00:00'):
+        return {'message_type': 1, 'room_id': room_id or self.room.id, 'text': text, 'code': 'chat$chat',
+                'version': 1, 'token': str(uuid.uuid4()), 'created_at': created_at}
+
+    def _write_segment(self, directory, name, entries, tail=''):
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, name), 'w') as f:
+            f.write(''.join(json.dumps(entry) + '\n' for entry in entries) + tail)
+
+    def test_replay_is_idempotent_and_keeps_created_at(self):
+        entries = [self._entry('a'), self._entry('b')]
+        flush_entries(entries)
+        flush_entries(entries)
+        self.assertEqual(ChatMessage.objects.count(), 2)
+        chat_msg = ChatMessage.objects.get(token=entries[0]['token'])
+        self.assertEqual(chat_msg.created_at.isoformat(), '2020-01-01T00:00:00+00:00')
+
+    def test_recover_dead_process_journal(self):
+        directory = os.path.join(self.root, 'other-host-1')
+        self._write_segment(directory, '000000000001.log', [self._entry('a')])
+        # 마지막 줄은 쓰다가 죽은 entry 입니다.
+        self._write_segment(directory, '000000000002.log', [self._entry('b')], tail='{"message_type": 1, "te')
+        MessageJournal(root=self.root).recover()
+        self.assertEqual(sorted(ChatMessage.objects.values_list('text', flat=True)), ['a', 'b'])
+        self.assertFalse(os.path.exists(directory))
+
+    def test_install_replays_dead_process_journal_at_startup(self):
+        # save_message를 한 번도 호출하지 않아도, 시작(AppConfig.ready -> install)하자마자 replay 되어야 합니다.
+        directory = os.path.join(self.root, 'other-host-1')
+        self._write_segment(directory, '000000000001.log', [self._entry('a')])
+        with override_settings(CHAT_JOURNAL={'ENABLED': True, 'ROOT': self.root, 'FSYNC': False,
+                                             'FLUSH_INTERVAL': 60}):
+            chat_journal.install()
+            journal = chat_journal._journal
+            try:
+                deadline = time.monotonic() + 5
+                # replay가 끝나면 디렉토리가 지워집니다. (flusher thread와 같이 DB를 읽으면 sqlite table lock이 걸립니다)
+                while os.path.exists(directory) and time.monotonic() < deadline:
+                    time.sleep(0.05)
+                self.assertEqual(list(ChatMessage.objects.values_list('text', flat=True)), ['a'])
+            finally:
+                journal.stop()
+                atexit.unregister(journal.stop)
+                chat_journal._journal = None
+
+    def test_bad_entry_goes_to_dead_letter(self):
+        journal = MessageJournal(root=self.root, fsync=False)
+        journal.open()
+        bad, good = self._entry('deleted room', room_id=self.room.id + 100), self._entry('good')
+        journal.append(bad)
+        journal.append(good)
+        journal.flush()
+        journal.append(self._entry('next segment'))
+        journal.flush()
+        self.assertEqual(sorted(ChatMessage.objects.values_list('text', flat=True)), ['good', 'next segment'])
+        dead_letter = os.path.join(self.root, DEAD_LETTER_DIRECTORY)
+        [name] = os.listdir(dead_letter)
+        with open(os.path.join(dead_letter, name)) as f:
+            self.assertEqual([json.loads(line)['token'] for line in f], [bad['token']])
+
+
+class DBPoolTest(SimpleTestCase):
+    """
+    pool은 SIZE개 thread(= connection)만 사용하고, 오래 쉰 connection은 끊겼으면 닫아야 합니다.
+    종료된 thread의 connection은 reaper가 닫습니다. (DB 대신 mock connection을 사용합니다)
+    """
+
+    def _connection(self, usable=True):
+        return mock.Mock(connection=object(), in_atomic_block=False, **{'is_usable.return_value': usable})
+
+    def test_checkout_is_limited_to_pool_size(self):
+        executor = PooledExecutor(max_workers=2, aliases=[], health_check_idle=60, name='test-limit')
+        started, release = threading.Semaphore(0), threading.Event()
+
+        def task():
+            started.release()
+            release.wait(5)
+            return threading.current_thread().name
+
+        try:
+            futures = [executor.submit(task) for _ in range(5)]
+            self.assertTrue(started.acquire(timeout=5) and started.acquire(timeout=5))
+            self.assertEqual((executor._busy.value, executor._queued.value), (2, 3))
+            release.set()
+            names = {future.result(timeout=5) for future in futures}
+        finally:
+            release.set()
+            executor.shutdown()
+        # 작업은 5개지만 thread(connection)는 2개만 사용합니다.
+        self.assertEqual(len(names), 2)
+        self.assertTrue(all(name.startswith('chat-db-test-limit') for name in names))
+        self.assertEqual((executor._busy.value, executor._queued.value), (0, 0))
+
+    def test_idle_connection_health_check(self):
+        healthy, broken = self._connection(), self._connection(usable=False)
+        closed = metrics.registry.counter('chat_db_health_checks_total', 'Idle DB connection health checks',
+                                          alias='test-broken', result='closed')
+        with mock.patch('chat.db_pool.connections', {'test-healthy': healthy, 'test-broken': broken}):
+            executor = PooledExecutor(max_workers=1, aliases=['test-healthy', 'test-broken'],
+                                      health_check_idle=0, name='test-health')
+            try:
+                executor.submit(lambda: None).result(timeout=5)  # 처음 사용하는 connection은 확인하지 않습니다.
+                self.assertFalse(broken.is_usable.called)
+                executor.submit(lambda: None).result(timeout=5)
+            finally:
+                executor.shutdown()
+        healthy.close.assert_not_called()
+        broken.close.assert_called_once_with()
+        self.assertEqual(closed.value, 1)
+
+    def test_recently_used_connection_is_not_checked(self):
+        broken = self._connection(usable=False)
+        with mock.patch('chat.db_pool.connections', {'test-recent': broken}):
+            executor = PooledExecutor(max_workers=1, aliases=['test-recent'], health_check_idle=60,
+                                      name='test-recent')
+            try:
+                for _ in range(3):
+                    executor.submit(lambda: None).result(timeout=5)
+            finally:
+                executor.shutdown()
+        broken.is_usable.assert_not_called()
+        broken.close.assert_not_called()
+
+    def test_reap_connections_of_finished_threads(self):
+        registry = ConnectionRegistry()
+        finished, alive = self._connection(), self._connection()
+        thread = threading.Thread(target=registry.track, args=(finished,))
+        thread.start()
+        thread.join()
+        registry.track(alive)
+        self.assertEqual(registry.reap(), 1)
+        finished.close.assert_called_once_with()
+        finished.inc_thread_sharing.assert_called_once_with()
+        finished.dec_thread_sharing.assert_called_once_with()
+        alive.close.assert_not_called()
+        self.assertEqual(registry.reap(), 0)
+
+
+class RoomSerializedWriteTest(SimpleTestCase):
+    """
+    같은 방의 write는 순서대로 하나씩, 다른 방의 write는 동시에 실행되어야 합니다.
+    """
+
+    def _save(self, log, room_id, seq, delay):
+        log.append(('start', room_id, seq, threading.get_ident()))
+        time.sleep(delay)
+        log.append(('end', room_id, seq))
+
+    def _run(self, jobs):
+        log = []
+
+        async def scenario():
+            await asyncio.gather(*[run_write(self._save, log, room_id, seq, delay, room_id=room_id)
+                                   for room_id, seq, delay in jobs])
+        async_to_sync(scenario)()
+        return log
+
+    def test_same_room_in_order(self):
+        log = self._run([(1, seq, 0.02 if seq == 0 else 0) for seq in range(5)])
+        self.assertEqual([entry[:3] for entry in log if entry[0] == 'end'], [('end', 1, seq) for seq in range(5)])
+        for index in range(0, len(log), 2):
+            self.assertEqual((log[index][0], log[index + 1][0]), ('start', 'end'))
+
+    def test_other_rooms_do_not_wait(self):
+        log = self._run([(1, 0, 0.1), (2, 0, 0)])
+        self.assertEqual([entry[1] for entry in log if entry[0] == 'end'], [2, 1])
+
+
+@override_settings(CHAT_RATE_LIMIT={
+    'ENABLED': True,
+    'POLICIES': {TEXT: {'connection': (1, 3), 'user': (1, 5), 'room': (1, 100)}},
+    'CLOSE_AFTER_REJECTIONS': 3,
+})
+class RateLimiterTest(SimpleTestCase):
+    """
+    Redis가 아닌 channel layer에서는 local bucket만으로 제한합니다.
+    """
+
+    def tearDown(self):
+        shared_buckets.clear()
+
+    def _check(self, limiter, count, frame_type=TEXT):
+        loop = asyncio.new_event_loop()
+        try:
+            return [loop.run_until_complete(limiter.check(frame_type)) for _ in range(count)]
+        finally:
+            loop.close()
+
+    def test_connection_burst(self):
+        decisions = self._check(RateLimiter(None, user_id=1, room_id=1), 4)
+        self.assertEqual([decision.allowed for decision in decisions], [True, True, True, False])
+        self.assertEqual(decisions[-1].scope, 'connection')
+        self.assertGreater(decisions[-1].retry_after, 0)
+
+    def test_user_bucket_is_shared_between_connections(self):
+        self._check(RateLimiter(None, user_id=1, room_id=1), 3)
+        decisions = self._check(RateLimiter(None, user_id=1, room_id=2), 3)
+        self.assertEqual([decision.allowed for decision in decisions], [True, True, False])
+        self.assertEqual(decisions[-1].scope, 'user')
+
+    @override_settings(CHAT_RATE_LIMIT={'POLICIES': {TEXT: {'connection': (0, 5), 'user': (0, 5), 'room': (0, 2)}}})
+    def test_room_rejection_does_not_charge_other_scopes(self):
+        limiter = RateLimiter(None, user_id=1, room_id=1)
+        decisions = self._check(limiter, 4)
+        self.assertEqual([decision.scope for decision in decisions], [None, None, 'room', 'room'])
+        self.assertEqual(limiter.connection_buckets[TEXT].tokens, 3)
+        self.assertEqual(shared_buckets.get(limiter._shared_key('user', TEXT), Policy(0, 5)).local.tokens, 3)
+
+    def test_close_after_consecutive_rejections(self):
+        limiter = RateLimiter(None, user_id=1, room_id=1)
+        self._check(limiter, 5)
+        self.assertFalse(limiter.should_close())
+        self._check(limiter, 1)
+        self.assertTrue(limiter.should_close())
+
+    def test_frame_without_policy_is_allowed(self):
+        decisions = self._check(RateLimiter(None, user_id=1, room_id=1), 10, frame_type=POSTBACK)
+        self.assertTrue(all(decision.allowed for decision in decisions))
+
+    def test_classify_frame(self):
+        self.assertEqual(classify_frame({'message': 'hi'}), TEXT)
+        self.assertEqual(classify_frame({'message': {'code': 'chat$chat', 'postback_value': 1}}), POSTBACK)
+        self.assertEqual(classify_frame({'type': 'typing'}), 'status')
+
+
+def _load_room_context(room_id, session=None):
+    # 방 '0'은 비활성, 나머지는 active한 방으로 봅니다. (DB 없이 ConnectionContext.load)
+    return ChatRoom(id=int(room_id), owner_id=1, active=room_id != '0'), {}, {}
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+@mock.patch('chat.context.load_room_context', _load_room_context)
+class MultiplexChatConsumerTest(SimpleTestCase):
+
+    async def _connect(self):
+        communicator = WebsocketCommunicator(MultiplexChatConsumer, '/ws/chat/')
+        communicator.scope['user'] = AnonymousUser()
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def _control(self, communicator, frame_type, room):
+        await communicator.send_json_to({'type': frame_type, 'room': room})
+        return await communicator.receive_json_from()
+
+    def test_subscribe_and_receive_tagged_frames(self):
+        async def scenario():
+            communicator = await self._connect()
+            self.assertEqual(await self._control(communicator, 'subscribe', '1'), {'type': 'subscribed', 'room': '1'})
+            self.assertEqual(await self._control(communicator, 'subscribe', 2), {'type': 'subscribed', 'room': '2'})
+            layer = get_channel_layer()
+            await layer.group_send('room-2', {'type': 'chat.payload', 'room_id': '2',
+                                              'text': json.dumps({'type': 'toast', 'text': 'hi'})})
+            self.assertEqual(await communicator.receive_json_from(),
+                             {'room': '2', 'frame': {'type': 'toast', 'text': 'hi'}})
+
+            await communicator.send_json_to({'room': '1', 'message': 'hello'})
+            self.assertEqual(await communicator.receive_json_from(), {'room': '1', 'frame': {'message': 'hello'}})
+
+            self.assertEqual(await self._control(communicator, 'unsubscribe', '2'),
+                             {'type': 'unsubscribed', 'room': '2'})
+            await layer.group_send('room-2', {'type': 'chat.payload', 'room_id': '2', 'text': '{}'})
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+        async_to_sync(scenario)()
+
+    def test_inactive_room_is_not_subscribed(self):
+        async def scenario():
+            communicator = await self._connect()
+            self.assertEqual(await self._control(communicator, 'subscribe', '0'),
+                             {'type': 'error', 'error': 'room not found or inactive', 'room': '0'})
+            await communicator.disconnect()
+        async_to_sync(scenario)()
+
+    def test_message_requires_subscription(self):
+        async def scenario():
+            communicator = await self._connect()
+            await communicator.send_json_to({'room': '3', 'message': 'hello'})
+            self.assertEqual(await communicator.receive_json_from(),
+                             {'type': 'error', 'error': 'not subscribed', 'room': '3'})
+            await communicator.disconnect()
+        async_to_sync(scenario)()
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+@mock.patch('chat.context.load_room_context', _load_room_context)
+class ChatConsumerTest(TransactionTestCase):
+    """
+    "ws/chat/<room>/" 접속 (routing을 거쳐 connect / receive / room state snapshot)
+    """
+
+    def tearDown(self):
+        room_state_store.clear('5')
+
+    async def _connect(self, room_id):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/chat/{}/'.format(room_id))
+        communicator.scope['user'] = AnonymousUser()
+        connected, _ = await communicator.connect()
+        return communicator, connected
+
+    def test_connect_and_receive(self):
+        room_state_store.update('5', None, {'phase': 'open'})
+
+        async def scenario():
+            communicator, connected = await self._connect(5)
+            self.assertTrue(connected)
+            self.assertEqual(await communicator.receive_json_from(),
+                             {'type': 'room_states', 'room_states': {'phase': 'open'}, 'version': 1})
+            await communicator.send_json_to({'message': 'hello'})
+            self.assertEqual(await communicator.receive_json_from(), {'message': 'hello'})
+            await communicator.disconnect()
+        async_to_sync(scenario)()
+
+    def test_inactive_room_is_rejected(self):
+        async def scenario():
+            communicator, connected = await self._connect(0)
+            self.assertFalse(connected)
+        async_to_sync(scenario)()
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+                   CHAT_BROADCAST={'CHUNK_SIZE': 2})
+class BroadcastViewTest(TestCase):
+    """
+    POST chat/broadcast/ : superuser만 보낼 수 있고, active한 방마다 메세지 하나를 만들어 각 방의 group으로 보내야 합니다.
+    """
+
+    def setUp(self):
+        User.objects.bulk_create([User(id=1, email='bot@example.com', is_superuser=True),
+                                  User(id=2, email='user2@example.com')])
+        self.rooms = [ChatRoom.objects.create(owner_id=2) for _ in range(3)]
+        self.inactive_room = ChatRoom.objects.create(owner_id=2, active=False)
+        self.room_ids = [room.id for room in self.rooms] + [self.inactive_room.id]
+        self.client = APIClient()
+
+    def _post(self, user_id, **data):
+        if user_id is not None:
+            self.client.force_authenticate(User.objects.get(id=user_id))
+        return self.client.post('/chat/broadcast/', dict({'text': 'notice', 'room_ids': self.room_ids}, **data),
+                                format='json')
+
+    def test_permission(self):
+        self.assertIn(self._post(None).status_code, (401, 403))
+        self.assertEqual(self._post(2).status_code, 403)
+        self.assertFalse(ChatMessage.objects.exists())
+
+    def test_delivers_one_message_per_room(self):
+        channel_layer = get_channel_layer()
+        channels = {}
+        for room_id in self.room_ids:
+            channels[room_id] = async_to_sync(channel_layer.new_channel)()
+            async_to_sync(channel_layer.group_add)('room-{}'.format(room_id), channels[room_id])
+
+        response = self._post(1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['room_count'], response.data['last_room_id']), (3, self.rooms[-1].id))
+        chat_msgs = {chat_msg.room_id: chat_msg for chat_msg in ChatMessage.objects.all()}
+        self.assertEqual(sorted(chat_msgs), [room.id for room in self.rooms])
+        for room in self.rooms:
+            event = async_to_sync(channel_layer.receive)(channels[room.id])
+            [message] = json.loads(event['text'])['messages']
+            self.assertEqual((message['id'], message['room_id'], message['text']),
+                             (chat_msgs[room.id].id, room.id, 'notice'))
+            self.assertEqual(message['token'], str(chat_msgs[room.id].token))
+
+        # 같은 broadcast_id로 다시 보내도 메세지가 중복 생성되지 않습니다.
+        self.assertEqual(self._post(1, broadcast_id=str(response.data['broadcast_id'])).status_code, 200)
+        self.assertEqual(ChatMessage.objects.count(), 3)
+
+
+class MessageTmplKwargsTest(SimpleTestCase):
+    """
+    to_message_kwargs : ChatMessageWriteSerializer 없이 ChatMessage kwargs를 만듭니다.
+    """
+    IMAGE_KEY = uuid.UUID('6f1c2b9e-3d4a-4f5b-8c7d-2e1f0a9b8c7d')
+
+    def setUp(self):
+        self.source = ChatSource(user=User(id=3, email='source@example.com'))
+
+    def test_kwargs(self):
+        tmpl = TextChatMessageTmpl(self.source, 'hi', action_code='greet').with_room_id(10).with_target_user_id(4)
+        kwargs = tmpl.to_message_kwargs()
+        self.assertEqual(kwargs, {
+            'message_type': 1, 'room_id': 10, 'text': 'hi', 'code': 'chat$greet', 'source_user_id': 3,
+            'target_user_id': 4, 'version': 1, 'is_hidden': False,
+        })
+
+    def test_errors_are_keyed_by_field(self):
+        tmpl = TextChatMessageTmpl(self.source, None)
+        tmpl.is_hidden = 'yes'
+        tmpl.extras = 'not json'
+        tmpl.with_target_user_id('abc')
+        with self.assertRaises(ValidationError) as cm:
+            tmpl.to_message_kwargs()
+        self.assertEqual(cm.exception.detail, {
+            'text': ['This field may not be null.'],
+            'is_hidden': ['Must be a valid boolean.'],
+            'extras': ['Value must be valid JSON.'],
+            'target_user': ['A valid integer is required.'],
+            'room': ['This field is required.'],
+        })
+
+    def test_invalid_required_field_reports_type_error_only(self):
+        with self.assertRaises(ValidationError) as cm:
+            TextChatMessageTmpl(self.source, 'hi').with_room_id('abc').to_message_kwargs()
+        self.assertEqual(cm.exception.detail, {'room': ['A valid integer is required.']})
+
+    def test_required_fields_can_be_skipped(self):
+        kwargs = TextChatMessageTmpl(self.source, 'hi').to_message_kwargs(required=('message_type',))
+        self.assertNotIn('room_id', kwargs)
+
+    def test_image_key_becomes_content_url(self):
+        kwargs = ImageChatMessageTmpl(self.source, image_key=self.IMAGE_KEY).with_room_id(10).to_message_kwargs()
+        self.assertEqual(kwargs['content_url'], '{}/{}.jpg'.format(S3_HOST, self.IMAGE_KEY))
+        self.assertNotIn('image_key', kwargs)
+
+        tmpl = ImageChatMessageTmpl(self.source, image_key=self.IMAGE_KEY, content_url='http://cdn/x.jpg')
+        self.assertEqual(tmpl.with_room_id(10).to_message_kwargs()['content_url'], 'http://cdn/x.jpg')
+
+        with self.assertRaises(ValidationError) as cm:
+            ImageChatMessageTmpl(self.source, image_key='not-a-uuid').with_room_id(10).to_message_kwargs()
+        self.assertEqual(cm.exception.detail, {'image_key': ['Must be a valid UUID.']})
+
+    def test_builder_api_on_slotted_tmpl(self):
+        tmpl = TextChatMessageTmpl(self.source, 'hi')
+        self.assertIs(tmpl.with_handler_name('bot').with_action_code(None).with_room_id(10)
+                      .with_target_user_id(4).with_postback_parent_id(7).with_client_handler_version(2)
+                      .with_target_handler_version(3), tmpl)
+        self.assertEqual(tmpl.code, 'bot$chat')
+        self.assertEqual((tmpl.room, tmpl.target_user, tmpl.postback_parent), (10, 4, 7))
+        kwargs = tmpl.to_message_kwargs()
+        self.assertEqual((kwargs['client_handler_version'], kwargs['target_handler_version']), (2, 3))
+        self.assertNotIn('postback_parent_id', kwargs)
+        # slot을 사용하므로 설정하지 않은 field는 없고(저장하지 않음), 정의하지 않은 attribute는 설정할 수 없습니다.
+        self.assertFalse(hasattr(tmpl, '__dict__'))
+        self.assertFalse(hasattr(tmpl, 'caption'))
+        with self.assertRaises(AttributeError):
+            tmpl.unknown_field = 1
+
+    def test_buttons_tmpl(self):
+        actions = [PostbackAction(message_code='menu$open', label='Open')]
+        tmpl = ButtonsMessageTmpl(self.source, 'menu', actions, text='pick').with_room_id(10)
+        kwargs = tmpl.to_message_kwargs()
+        self.assertEqual(kwargs['message_type'], 3)
+        self.assertEqual(kwargs['template']['type'], 'buttons')
+        self.assertEqual(kwargs['template']['actions'], [actions[0].to_serializable()])
+
+
+class TemplateRenderCacheTest(SimpleTestCase):
+    """
+    입력값이 같은 template은 한 번만 렌더링하고, 입력값이 바뀌거나 evict / clear 되면 다시 렌더링해야 합니다.
+    """
+
+    def setUp(self):
+        self.source = ChatSource(user=User(id=3, email='source@example.com'))
+        template_cache.clear()
+
+    def tearDown(self):
+        template_cache.clear()
+
+    def _render_counter(self, value):
+        calls = []
+
+        def render():
+            calls.append(value)
+            return {'value': value}
+        return render, calls
+
+    def test_hit_and_eviction(self):
+        cache = TemplateRenderCache(maxsize=2)
+        render_a, calls_a = self._render_counter('a')
+        rendered = cache.get_or_render(('k', 'a'), render_a)
+        self.assertIs(cache.get_or_render(('k', 'a'), render_a), rendered)
+        self.assertEqual(calls_a, ['a'])
+
+        render_b, calls_b = self._render_counter('b')
+        render_c, calls_c = self._render_counter('c')
+        cache.get_or_render(('k', 'b'), render_b)
+        cache.get_or_render(('k', 'a'), render_a)  # a가 최근에 쓰였으므로 b가 evict 됩니다.
+        cache.get_or_render(('k', 'c'), render_c)
+        self.assertEqual(len(cache), 2)
+        cache.get_or_render(('k', 'a'), render_a)
+        cache.get_or_render(('k', 'b'), render_b)
+        self.assertEqual((calls_a, calls_b, calls_c), (['a'], ['b', 'b'], ['c']))
+
+        cache.clear()
+        cache.get_or_render(('k', 'a'), render_a)
+        self.assertEqual(calls_a, ['a', 'a'])
+
+    def test_unhashable_key_is_not_cached(self):
+        cache = TemplateRenderCache(maxsize=2)
+        render, calls = self._render_counter('a')
+        cache.get_or_render(('k', ['unhashable']), render)
+        cache.get_or_render(('k', ['unhashable']), render)
+        self.assertEqual((calls, len(cache)), (['a', 'a'], 0))
+
+    def test_buttons_tmpl_shares_rendered_template(self):
+        def buttons(label, params):
+            actions = [PostbackAction(message_code='menu$open', label=label, params=params)]
+            return ButtonsMessageTmpl(self.source, 'menu', actions, text='pick')
+
+        template = buttons('Open', {'id': 1}).template
+        # 다른 tmpl instance라도 입력값이 같으면 같은 dict를 재사용합니다.
+        self.assertIs(buttons('Open', {'id': 1}).template, template)
+        self.assertIsNot(buttons('Open', {'id': 2}).template, template)
+        self.assertIsNot(buttons('Close', {'id': 1}).template, template)
+        self.assertEqual(buttons('Open', {'id': 2}).template['actions'][0]['params'], {'id': 2, 'label': 'Open'})
+        template_cache.clear()
+        self.assertIsNot(buttons('Open', {'id': 1}).template, template)
+
+
+@override_settings(CHAT_METRICS={'EXPORT_ENDPOINT': True, 'SCRAPE_ALLOWED_IPS': ['10.0.0.9'], 'SCRAPE_TOKEN': 'scrape'})
+class MetricsEndpointTest(SimpleTestCase):
+
+    def test_anonymous_request_is_rejected(self):
+        self.assertEqual(self.client.get('/metrics/').status_code, 403)
+        self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+
+    def test_allowed_ip_and_token(self):
+        self.assertEqual(self.client.get('/metrics/', REMOTE_ADDR='10.0.0.9').status_code, 200)
+        response = self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer scrape')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+
+    def test_logged_in_user_without_is_staff(self):
+        request = RequestFactory().get('/metrics/', HTTP_AUTHORIZATION='Bearer scrape')
+        request.user = User(id=1, email='user1@example.com')
+        self.assertTrue(metrics.is_scrape_allowed(request))
+        del request.META['HTTP_AUTHORIZATION']
+        self.assertFalse(metrics.is_scrape_allowed(request))
+
+    @override_settings(CHAT_METRICS={})
+    def test_endpoint_is_disabled_by_default(self):
+        self.assertEqual(self.client.get('/metrics/', REMOTE_ADDR='10.0.0.9').status_code, 404)
+
+
+class MetricsRegistryTest(SimpleTestCase):
+
+    def test_collect_copies_metrics_under_lock(self):
+        registry = MetricsRegistry()
+        registry.counter('chat_test_total', 'test counter', index=0).inc()
+        collected = []
+        with registry._lock:  # _get이 새 metric을 추가하는 중
+            thread = threading.Thread(target=lambda: collected.append(registry.collect()))
+            thread.start()
+            thread.join(0.05)
+            self.assertTrue(thread.is_alive())
+            registry._metrics[('chat_test_total', (('index', 1),))] = registry._metrics.popitem()[1]
+        thread.join()
+        self.assertEqual([key for key, _ in collected[0]], [('chat_test_total', (('index', 1),))])
+
+
+class RoomStateStoreTest(TestCase):
+    ROOM_ID = 'room-state-test'
+
+    def tearDown(self):
+        room_state_store.clear(self.ROOM_ID)
+        room_state_store.clear(self.ROOM_ID, 7)
+
+    def test_patch_round_trip(self):
+        old = {'phase': 'open', 'deal': {'price': 1000, 'items': [1, 2]}, 'a/b': 1}
+        new = {'phase': 'closed', 'deal': {'price': 1000, 'items': [1, 2, 3], 'memo': 'x'}}
+        patch = make_patch(old, new)
+        self.assertEqual(apply_patch(old, patch), new)
+        self.assertIn({'op': 'remove', 'path': '/a~1b'}, patch)
+
+    def test_first_update_is_snapshot_then_patches(self):
+        state = {'phase': 'open', 'detail': {'text': 'x' * 200}}
+        first = room_state_store.update(self.ROOM_ID, None, state)
+        self.assertEqual(first.frame['type'], 'room_states')
+        self.assertEqual(first.version, 1)
+
+        second = room_state_store.update(self.ROOM_ID, None, dict(state, phase='closed'))
+        self.assertEqual(second.frame, {'type': 'room_states_patch', 'base_version': 1, 'version': 2,
+                                        'patch': [{'op': 'replace', 'path': '/phase', 'value': 'closed'}]})
+
+    def test_identical_state_is_suppressed(self):
+        room_state_store.update(self.ROOM_ID, None, {'phase': 'open'})
+        self.assertIsNone(room_state_store.update(self.ROOM_ID, None, {'phase': 'open'}))
+        self.assertEqual(room_state_store.get(self.ROOM_ID), (1, {'phase': 'open'}))
+
+    def test_snapshot_frames(self):
+        room_state_store.update(self.ROOM_ID, None, {'phase': 'open'})
+        room_state_store.update(self.ROOM_ID, 7, {'unread': 3})
+        room_state_store.update(self.ROOM_ID, 7, {'unread': 4})
+        frames = room_state_store.snapshot_frames(self.ROOM_ID, 7)
+        self.assertEqual(frames, [
+            {'type': 'room_states', 'room_states': {'phase': 'open'}, 'version': 1},
+            {'type': 'room_states', 'room_states': {'unread': 4}, 'version': 2, 'target_user': True},
+        ])
+
+    def test_process_local_cache_is_rejected(self):
+        with self.settings(CHAT_ROOM_STATE={'CACHE': 'default'}):
+            with self.assertRaises(ImproperlyConfigured):
+                room_state_store.update(self.ROOM_ID, None, {'phase': 'open'})
+            self.assertEqual([error.id for error in check_room_state_cache()], ['chat.E001'])
+        self.assertEqual(check_room_state_cache(), [])
+
+    def test_update_waits_for_state_lock(self):
+        cache = get_state_cache()
+        lock_key = _cache_key(self.ROOM_ID, None) + ':lock'
+        cache.add(lock_key, 'other-worker', timeout=60)
+        try:
+            with self.settings(CHAT_ROOM_STATE={'CACHE': 'chat_shared', 'LOCK_TIMEOUT': 0.05}):
+                with self.assertRaises(RoomStateLockTimeout):
+                    room_state_store.update(self.ROOM_ID, None, {'phase': 'open'})
+        finally:
+            cache.delete(lock_key)
+        self.assertIsNone(room_state_store.get(self.ROOM_ID))
+        self.assertEqual(room_state_store.update(self.ROOM_ID, None, {'phase': 'open'}).version, 1)
+        self.assertIsNone(cache.get(lock_key))
+
+
+class HeartbeatTest(SimpleTestCase):
+
+    def test_heartbeat_reply(self):
+        self.assertEqual(heartbeat_reply('{"type": "ping", "identifier": "a"}'),
+                         (True, '{"type": "pong", "identifier": "a"}'))
+        self.assertEqual(heartbeat_reply('{"type":"pong"}'), (True, None))
+        self.assertEqual(heartbeat_reply(json.dumps({'message': 'ping'})), (False, None))
+        self.assertEqual(heartbeat_reply('"ping"'), (False, None))
+
+    def test_idle_connection_is_pinged_then_closed(self):
+        class Connection(object):
+            def __init__(self):
+                self.sent = []
+                self.closed = None
+
+            async def send(self, text_data):
+                self.sent.append(text_data)
+
+            async def close(self, code):
+                self.closed = code
+
+        clock = [0.0]
+        wheel = TimerWheel(idle_timeout=2, ping_grace=1, tick=0.01, clock=lambda: clock[0])
+
+        async def scenario():
+            idle, active = Connection(), Connection()
+            wheel.register(idle)
+            wheel.register(active)
+            self.assertEqual(len(wheel), 2)
+            for _ in range(4):
+                clock[0] += 1
+                wheel.touch(active)
+                await asyncio.sleep(0.03)
+            self.assertEqual(idle.sent, [PING_FRAME])
+            self.assertEqual(idle.closed, IDLE_CLOSE_CODE)
+            self.assertEqual(active.sent, [])
+            self.assertIsNone(active.closed)
+            wheel.unregister(active)
+            self.assertEqual(len(wheel), 0)
+        async_to_sync(scenario)()
@@ -2,8 +2,12 @@ from django.conf.urls import url
 from django.urls import path
 
 from . import views
+from .search import views as search_views
 
 urlpatterns = [
     path('', views.index, name='index'),
+    path('search/', search_views.UserMessageSearchView.as_view(), name='message-search'),
+    path('rooms/<int:room_id>/search/', search_views.RoomMessageSearchView.as_view(), name='room-message-search'),
+    path('broadcast/', views.BroadcastView.as_view(), name='broadcast'),
     url(r'^(?P<room_name>[^/]+)/$', views.room, name='room'),
-]
\ No newline at end of file
+]
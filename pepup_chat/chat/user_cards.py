@@ -0,0 +1,180 @@
+# -*- encoding: utf-8 -*-
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+
+"""
+메세지 serialize 시 사용하는 사용자 정보(user card) cache 입니다.
+
+card = {'id', 'nickname', 'profile_image_url', 'is_staff'}
+- get_user_cards(user_ids) : 여러 사용자의 card를 한 번에 가져옵니다.
+    1. process-local LRU (LOCAL_TTL 초)
+    2. Django cache (CACHE alias, 여러 process가 공유. production에서는 Redis cache를 지정합니다)
+    3. DB : user + profile 한 번, social account 한 번 (cache에 없는 사용자만)
+- 사용자/프로필이 이 서버에서 저장·삭제되면 invalidate_user_card 가 두 cache에서 지웁니다. (AppConfig.ready)
+  다른 서버(pepup)에서 바뀐 프로필은 TTL 이후에 반영됩니다.
+
+settings 예시:
+    CHAT_USER_CARD = {
+        'CACHE': 'default',
+        'TTL': 300,
+        'LOCAL_TTL': 10,
+        'LOCAL_MAX_ENTRIES': 10000,
+    }
+"""
+
+DEFAULT_TTL = 300
+DEFAULT_LOCAL_TTL = 10
+DEFAULT_LOCAL_MAX_ENTRIES = 10000
+DEFAULT_PROFILE_IMAGE_NAME = 'default_profile.png'
+
+
+def get_user_card_config():
+    return getattr(settings, 'CHAT_USER_CARD', {})
+
+
+def _cache_key(user_id):
+    return 'chat:user-card:{}'.format(user_id)
+
+
+class LocalCardCache(object):
+    def __init__(self):
+        self._entries = OrderedDict()  # user_id -> (expires_at, card)
+        self._lock = threading.Lock()
+
+    def get_many(self, user_ids):
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for user_id in user_ids:
+                entry = self._entries.get(user_id)
+                if entry is not None and entry[0] > now:
+                    found[user_id] = entry[1]
+        return found
+
+    def set_many(self, cards):
+        config = get_user_card_config()
+        expires_at = time.monotonic() + config.get('LOCAL_TTL', DEFAULT_LOCAL_TTL)
+        max_entries = config.get('LOCAL_MAX_ENTRIES', DEFAULT_LOCAL_MAX_ENTRIES)
+        with self._lock:
+            for user_id, card in cards.items():
+                self._entries[user_id] = (expires_at, card)
+                self._entries.move_to_end(user_id)
+            while len(self._entries) > max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+local_cards = LocalCardCache()
+
+
+def get_shared_cache():
+    return caches[get_user_card_config().get('CACHE', 'default')]
+
+
+#
+# DB
+#
+def _get_social_thumbnails(user_ids):
+    """
+    :return: dict user_id -> 가장 최근 social account의 thumbnail (Profile.thumbnail_img_url 과 같은 규칙)
+    """
+    User = get_user_model()
+    relation = getattr(User, 'socialaccount_set', None)
+    if relation is None or not user_ids:  # allauth가 없는 환경
+        return {}
+    SocialAccount = relation.rel.related_model
+    thumbnails = {}
+    for user_id, extra_data in (SocialAccount.objects.filter(user_id__in=user_ids)
+                                .order_by('user_id', 'pk').values_list('user_id', 'extra_data')):
+        if 'properties' in extra_data:
+            thumbnails[user_id] = extra_data['properties'].get('thumbnail')
+        else:
+            thumbnails[user_id] = None  # 마지막 account 기준이므로 이전 값을 덮어씁니다.
+    return thumbnails
+
+
+def build_user_card(user, social_thumbnails):
+    profile = getattr(user, 'profile', None)
+    profile_image_url = None
+    if profile is not None:
+        if profile.thumbnail_img.name != DEFAULT_PROFILE_IMAGE_NAME or user.id not in social_thumbnails:
+            profile_image_url = profile.thumbnail_img.url if profile.thumbnail_img else None
+        else:
+            profile_image_url = social_thumbnails[user.id]
+    return {
+        'id': user.id,
+        'nickname': user.nickname or '',  # str(user)는 email / phone 이므로 다른 참여자에게 보내지 않습니다.
+        'profile_image_url': profile_image_url,
+        'is_staff': getattr(user, 'is_staff', False),
+    }
+
+
+def _load_cards(user_ids):
+    User = get_user_model()
+    users = list(User.objects.filter(id__in=user_ids).select_related('profile'))
+    needs_social = [user.id for user in users if getattr(user, 'profile', None) is not None
+                    and user.profile.thumbnail_img.name == DEFAULT_PROFILE_IMAGE_NAME]
+    social_thumbnails = _get_social_thumbnails(needs_social)
+    return {user.id: build_user_card(user, social_thumbnails) for user in users}
+
+
+#
+# API
+#
+def get_user_cards(user_ids):
+    """
+    :return: dict user_id -> card (존재하지 않는 사용자는 포함되지 않습니다)
+    """
+    user_ids = set(user_id for user_id in user_ids if user_id is not None)
+    cards = local_cards.get_many(user_ids)
+    missing = user_ids.difference(cards)
+    if not missing:
+        return cards
+
+    shared_cache = get_shared_cache()
+    shared = shared_cache.get_many([_cache_key(user_id) for user_id in missing])
+    fetched = {}
+    for user_id in missing:
+        card = shared.get(_cache_key(user_id))
+        if card is not None:
+            fetched[user_id] = card
+    missing.difference_update(fetched)
+
+    if missing:
+        loaded = _load_cards(missing)
+        shared_cache.set_many({_cache_key(user_id): card for user_id, card in loaded.items()},
+                              timeout=get_user_card_config().get('TTL', DEFAULT_TTL))
+        fetched.update(loaded)
+
+    local_cards.set_many(fetched)
+    cards.update(fetched)
+    return cards
+
+
+def get_user_card(user_id):
+    return get_user_cards([user_id]).get(user_id)
+
+
+def invalidate_user_card(user_id):
+    local_cards.discard(user_id)
+    get_shared_cache().delete(_cache_key(user_id))
+
+
+def invalidate_user_card_on_change(sender, instance, **kwargs):
+    """
+    User / Profile post_save, post_delete receiver.
+    """
+    user_id = instance.pk if isinstance(instance, get_user_model()) else instance.user_id
+    invalidate_user_card(user_id)
@@ -3,8 +3,20 @@ import json
 from django.shortcuts import render
 
 # Create your views here.
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponse
 from django.shortcuts import render
 from django.utils.safestring import mark_safe
+from rest_framework import permissions, serializers, status
+from rest_framework.exceptions import PermissionDenied as APIPermissionDenied
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from chat import metrics
+from chat.broadcast import BroadcastError, broadcast_template
+from chat.message_models import TextChatMessageTmpl
+from chat.models import ChatRoom
+from chat.profile_models import ChatSource
 
 
 def index(request):
@@ -13,4 +25,46 @@ def index(request):
 def room(request, room_name):
     return render(request, 'room.html', {
         'room_name_json': mark_safe(json.dumps(room_name))
-    })
\ No newline at end of file
+    })
+
+def metrics_view(request):
+    # Prometheus text exposition format
+    config = metrics.get_metrics_config()
+    if not config.get('EXPORT_ENDPOINT', False):
+        raise Http404
+    if not metrics.is_scrape_allowed(request, config):
+        raise PermissionDenied
+    return HttpResponse(metrics.registry.render_prometheus(), content_type='text/plain; version=0.0.4')
+
+
+class BroadcastParamsSerializer(serializers.Serializer):
+    text = serializers.CharField()
+    room_ids = serializers.ListField(child=serializers.IntegerField(min_value=1), min_length=1)
+    broadcast_id = serializers.UUIDField(required=False)
+    resume_after = serializers.IntegerField(required=False, min_value=0)
+
+
+class BroadcastView(APIView):
+    """
+    POST {"text": "...", "room_ids": [1, 2], "broadcast_id": <이어서 보낼 때>, "resume_after": <room id>}
+    superuser만 사용할 수 있고, request.user(bot 계정)가 보낸 text 메세지를 active한 방들에 보냅니다. (chat.broadcast)
+    response : {"broadcast_id": ..., "room_count": ..., "last_room_id": ...}
+    실패하면 500과 함께 이어서 보낼 broadcast_id / last_room_id 를 돌려줍니다.
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        if not request.user.is_superuser:
+            raise APIPermissionDenied()
+        params_serializer = BroadcastParamsSerializer(data=request.data)
+        params_serializer.is_valid(raise_exception=True)
+        params = params_serializer.validated_data
+        rooms = ChatRoom.objects.filter(active=True, id__in=params['room_ids'])
+        tmpl = TextChatMessageTmpl(source=ChatSource(user=request.user), text=params['text'])
+        try:
+            result = broadcast_template(tmpl, rooms, broadcast_id=params.get('broadcast_id'),
+                                        resume_after=params.get('resume_after'))
+        except BroadcastError as e:
+            return Response({'detail': str(e), 'broadcast_id': e.broadcast_id, 'last_room_id': e.last_room_id},
+                            status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return Response(result._asdict())
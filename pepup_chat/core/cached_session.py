@@ -0,0 +1,117 @@
+# -*- encoding: utf-8 -*-
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils.encoding import force_text
+
+from core.session import SessionStore as BaseSessionStore
+
+"""
+decode한 session을 process 안에 잠시(TTL) 보관하는 session backend 입니다. (SESSION_ENGINE = 'core.cached_session')
+
+- WebSocket connect마다 AuthMiddlewareStack이 session을 load하므로, 재접속이나 여러 탭은 같은 session을
+  반복해서 읽고 decode합니다.
+- TTL 안에서는 Redis에 접근하지 않고, cache된 dict의 사본을 돌려줍니다.
+- TTL이 지나면 GET과 TTL(남은 만료 시간)을 pipeline으로 한 번에 가져오고,
+  저장된 값의 version stamp(digest)가 같으면 decode하지 않고 재사용합니다.
+- 이 process에서 save/delete한 session은 cache에서 바로 지웁니다.
+  다른 process에서 바뀐 session은 최대 TTL만큼 늦게 반영됩니다.
+
+settings 예시:
+    CACHED_SESSION = {
+        'TTL': 5,  # seconds
+        'MAX_ENTRIES': 10000,
+    }
+"""
+
+DEFAULT_TTL = 5
+DEFAULT_MAX_ENTRIES = 10000
+
+
+def get_cached_session_config():
+    return getattr(settings, 'CACHED_SESSION', {})
+
+
+class DecodedSessionCache(object):
+    """
+    session key -> (expires_at, version stamp, decoded dict)
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_key):
+        with self._lock:
+            return self._entries.get(session_key)
+
+    def set(self, session_key, entry):
+        max_entries = get_cached_session_config().get('MAX_ENTRIES', DEFAULT_MAX_ENTRIES)
+        with self._lock:
+            self._entries[session_key] = entry
+            self._entries.move_to_end(session_key)
+            while len(self._entries) > max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, session_key):
+        with self._lock:
+            self._entries.pop(session_key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+decoded_sessions = DecodedSessionCache()
+
+
+class SessionStore(BaseSessionStore):
+
+    def load(self):
+        session_key = self.session_key
+        if session_key is None:
+            return super(SessionStore, self).load()
+        now = time.monotonic()
+        entry = decoded_sessions.get(session_key)
+        if entry is not None and entry[0] > now:
+            return dict(entry[2])
+
+        stored_key = self.get_real_stored_key(session_key)
+        try:
+            pipe = self.server.pipeline(transaction=False)
+            pipe.get(stored_key)
+            pipe.ttl(stored_key)
+            session_data, remaining = pipe.execute()
+        except Exception:
+            self._session_key = None
+            return {}
+        if session_data is None:
+            decoded_sessions.discard(session_key)
+            self._session_key = None
+            return {}
+
+        stamp = hashlib.sha1(session_data).digest()
+        if entry is not None and entry[1] == stamp:
+            data = entry[2]  # 바뀌지 않았으므로 decode하지 않습니다.
+        else:
+            data = self.decode(force_text(session_data))
+        ttl = get_cached_session_config().get('TTL', DEFAULT_TTL)
+        if remaining is not None and remaining >= 0:
+            ttl = min(ttl, remaining)  # session 만료 시각을 넘겨서 cache하지 않습니다.
+        decoded_sessions.set(session_key, (now + ttl, stamp, data))
+        return dict(data)
+
+    def save(self, must_create=False):
+        if self.session_key is not None:
+            decoded_sessions.discard(self.session_key)
+        super(SessionStore, self).save(must_create=must_create)
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            session_key = self.session_key
+        if session_key is not None:
+            decoded_sessions.discard(session_key)
+        super(SessionStore, self).delete(session_key)
@@ -0,0 +1,148 @@
+# -*- encoding: utf-8 -*-
+import json
+import math
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models
+from django.db.models.query_utils import DeferredAttribute
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+"""
+빠른 JSON encoder/decoder를 사용하는 model field 입니다. (jsonfield.JSONField 대체)
+
+- encoder/decoder : orjson > ujson(2.0+) > json 중 설치된 것을 사용합니다.
+  fast decoder가 읽지 못하는 값(NaN, 64bit를 넘는 정수 등)은 json 모듈로 다시 읽습니다.
+- 저장 형식은 jsonfield.JSONField와 같습니다. (TEXT column에 compact JSON 문자열, schema 변경 없음)
+- DB에서 읽은 값은 RawJSON(str)으로 들고 있다가, attribute에 처음 접근할 때 decode합니다.
+  (fetch한 메세지 대부분은 extras를 읽지 않습니다)
+- 한 번도 접근하지 않은 값은 save할 때 다시 encode하지 않고, 읽은 문자열을 그대로 저장합니다.
+- values() / values_list() 는 descriptor를 거치지 않으므로 decode되지 않은 JSON 문자열(RawJSON)을 돌려줍니다.
+  jsonfield.JSONField는 여기서도 decode된 dict / list를 돌려주었으므로 다릅니다. 값이 필요하면 loads()로 decode하세요.
+"""
+
+_encoder = DjangoJSONEncoder(separators=(',', ':'), ensure_ascii=False)  # datetime, Decimal, UUID 등
+
+
+class RawJSON(str):
+    """
+    DB에서 읽은 뒤 아직 decode하지 않은 JSON 문자열.
+    """
+    __slots__ = ()
+
+
+def _default(value):
+    return _encoder.default(value)
+
+
+def _json_dumps(value):
+    return _encoder.encode(value)
+
+
+if orjson is not None:
+    def _fast_dumps(value):
+        return orjson.dumps(value, default=_default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    _fast_loads = orjson.loads
+elif ujson is not None:
+    def _fast_dumps(value):
+        return ujson.dumps(value, ensure_ascii=False, escape_forward_slashes=False, default=_default)
+    _fast_loads = ujson.loads
+else:
+    _fast_dumps = _json_dumps
+    _fast_loads = json.loads
+
+
+def dumps(value):
+    try:
+        return _fast_dumps(value)
+    except (TypeError, ValueError, OverflowError):
+        return _json_dumps(value)
+
+
+def loads(text):
+    try:
+        return _fast_loads(text)
+    except (ValueError, OverflowError):
+        return json.loads(text)
+
+
+def sanitize(value):
+    """
+    fast decoder가 읽을 수 없는 NaN / Infinity를 None으로 바꿉니다. (data migration 용)
+    """
+    if isinstance(value, float) and (math.isnan(value) or math.isinf(value)):
+        return None
+    if isinstance(value, dict):
+        return {key: sanitize(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [sanitize(item) for item in value]
+    return value
+
+
+class LazyJSONAttribute(DeferredAttribute):
+    """
+    RawJSON을 처음 접근할 때 decode하여 instance.__dict__에 다시 저장합니다.
+
+    __set__이 있는 data descriptor여야 합니다. DeferredAttribute(non-data descriptor)만으로는
+    Model.__init__이 instance.__dict__에 넣은 RawJSON이 descriptor보다 먼저 읽혀 decode되지 않습니다.
+    """
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        value = super(LazyJSONAttribute, self).__get__(instance, cls)
+        if isinstance(value, RawJSON):
+            value = self.field.decode(value)
+            instance.__dict__[self.field.attname] = value
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
+class FastJSONField(models.TextField):
+    description = 'JSON (stored as text, decoded lazily)'
+    descriptor_class = LazyJSONAttribute
+
+    def decode(self, text):
+        if not text:
+            return None if self.null else text
+        return loads(text)
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return None
+        return RawJSON(value)
+
+    def to_python(self, value):
+        # Django deserializer(ex: chat.archive segment)는 value_to_string 결과인 JSON 문자열을 넘깁니다.
+        if isinstance(value, str):
+            try:
+                return self.decode(value)
+            except ValueError:
+                return value
+        return value
+
+    def pre_save(self, model_instance, add):
+        value = model_instance.__dict__.get(self.attname)
+        if isinstance(value, RawJSON):
+            return value  # 접근하지 않은 값은 decode하지 않습니다.
+        return super(FastJSONField, self).pre_save(model_instance, add)
+
+    def get_prep_value(self, value):
+        if isinstance(value, RawJSON):
+            return str(value)  # 접근하지 않은 값은 다시 encode하지 않습니다.
+        if self.null and value is None:
+            return None
+        return dumps(value)
+
+    def value_to_string(self, obj):
+        return self.get_prep_value(self.value_from_object(obj))
@@ -1,14 +1,285 @@
+# -*- encoding: utf-8 -*-
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
 
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, InterfaceError, OperationalError
+from django.db import connections as default_connections
+from django.db.backends.signals import connection_created
+
+"""
+read replica를 사용하는 database router 입니다.
+
+- db_for_write : 항상 'default'(primary)
+- db_for_read  : DATABASE_REPLICAS['ALIASES'] 중 하나. 아래 경우에는 'default'
+    - replica가 없거나 모두 제외(eject)된 경우
+    - 'default'에서 transaction(atomic) 중인 경우
+    - 같은 접속에서 write한 뒤 PIN_SECONDS 이내인 경우 (read-your-writes)
+      접속 = start_pin_scope()를 호출한 context(ex: websocket connection), 없으면 thread
+- 선택 : STRATEGY = 'round_robin' 또는 'least_latency' (query latency의 EWMA가 가장 작은 replica)
+- health : background thread가 PROBE_INTERVAL초마다 replica에 "SELECT 1"을 보내고, 연속 FAILURE_THRESHOLD번
+  실패(연결 오류, 일반 query의 연결 오류 포함)하면 EJECT_SECONDS 동안 제외합니다. 제외가 풀린 뒤 다시 한 번 실패하면 바로 제외합니다.
+    - db_for_read는 기록된 health 상태만 읽습니다. (request thread에서 probe query를 보내지 않습니다)
+    - thread는 처음 db_for_read가 호출될 때 시작합니다. PROBE_INTERVAL이 0이면 시작하지 않습니다.
+
+settings 예시:
+    DATABASES = {
+        'default': {...},
+        'replica1': {..., 'TEST': {'MIRROR': 'default'}},
+    }
+    DATABASE_REPLICAS = {
+        'ALIASES': ['replica1'],
+        'STRATEGY': 'round_robin',
+        'PIN_SECONDS': 2.0,
+        'PROBE_INTERVAL': 5,
+        'FAILURE_THRESHOLD': 3,
+        'EJECT_SECONDS': 30,
+    }
+"""
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PIN_SECONDS = 2.0
+DEFAULT_PROBE_INTERVAL = 5
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_EJECT_SECONDS = 30
+LATENCY_EWMA_WEIGHT = 0.2
+
+
+def get_replica_config():
+    return getattr(settings, 'DATABASE_REPLICAS', {})
+
+
+#
+# read-your-writes
+#
+_pin_state = ContextVar('db_pin_state', default=None)
+_thread_state = threading.local()
+
+
+def start_pin_scope():
+    """
+    현재 context(ex: consumer connect)부터 read-your-writes 범위를 따로 관리합니다.
+    state는 mutable dict이므로 sync_to_async thread 안에서 한 write도 같은 접속의 다음 read에 반영됩니다.
+    """
+    _pin_state.set({'until': 0.0})
+
+
+def _get_pin_state():
+    state = _pin_state.get()
+    if state is None:
+        state = getattr(_thread_state, 'pin', None)
+        if state is None:
+            state = _thread_state.pin = {'until': 0.0}
+    return state
+
+
+def pin_to_primary(seconds=None):
+    """
+    지금부터 seconds 동안 이 접속의 read를 primary로 보냅니다.
+    """
+    if seconds is None:
+        seconds = get_replica_config().get('PIN_SECONDS', DEFAULT_PIN_SECONDS)
+    state = _get_pin_state()
+    state['until'] = max(state['until'], time.monotonic() + seconds)
+
+
+def is_pinned_to_primary():
+    return _get_pin_state()['until'] > time.monotonic()
+
+
+@contextmanager
+def use_primary():
+    """
+    with 블록 안의 read를 primary로 보냅니다. (ex: 방금 다른 process가 쓴 row를 읽어야 하는 경우)
+    """
+    state = _get_pin_state()
+    previous = state['until']
+    state['until'] = float('inf')
+    try:
+        yield
+    finally:
+        state['until'] = previous
+
+
+#
+# health
+#
+class ReplicaHealth(object):
+    """
+    replica별 query latency(EWMA), 연속 실패 횟수, 제외 시각. 모든 thread가 공유합니다.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latency = {}
+        self._failures = {}
+        self._ejected_until = {}
+
+    def record_success(self, alias, elapsed):
+        with self._lock:
+            latency = self._latency.get(alias)
+            self._latency[alias] = elapsed if latency is None else (
+                latency + LATENCY_EWMA_WEIGHT * (elapsed - latency))
+            self._failures[alias] = 0
+
+    def record_failure(self, alias):
+        config = get_replica_config()
+        threshold = config.get('FAILURE_THRESHOLD', DEFAULT_FAILURE_THRESHOLD)
+        with self._lock:
+            failures = self._failures.get(alias, 0) + 1
+            if failures < threshold:
+                self._failures[alias] = failures
+                return
+            # 제외가 풀린 뒤 한 번만 더 실패해도 다시 제외되도록 threshold - 1 로 남겨둡니다.
+            self._failures[alias] = threshold - 1
+            self._ejected_until[alias] = time.monotonic() + config.get('EJECT_SECONDS', DEFAULT_EJECT_SECONDS)
+        logger.warning('replica %s ejected after %s consecutive failures', alias, failures)
+
+    def is_available(self, alias, now=None):
+        now = time.monotonic() if now is None else now
+        return self._ejected_until.get(alias, 0) <= now
+
+    def latency(self, alias):
+        return self._latency.get(alias, 0.0)  # 측정 전인 replica를 먼저 사용해 봅니다.
+
+    def reset(self):
+        with self._lock:
+            self._latency.clear()
+            self._failures.clear()
+            self._ejected_until.clear()
+
+
+replica_health = ReplicaHealth()
+
+
+def _measure_queries(alias, health):
+    def execute_wrapper(execute, sql, params, many, context):
+        started = time.monotonic()
+        try:
+            result = execute(sql, params, many, context)
+        except (OperationalError, InterfaceError):
+            health.record_failure(alias)
+            raise
+        health.record_success(alias, time.monotonic() - started)
+        return result
+    execute_wrapper.replica_alias = alias
+    return execute_wrapper
+
+
+def install_latency_wrapper(sender, connection, **kwargs):
+    """
+    connection_created receiver. replica connection의 query latency / 연결 오류를 replica_health에 기록합니다.
+    """
+    if connection.alias not in get_replica_config().get('ALIASES', ()):
+        return
+    if any(getattr(wrapper, 'replica_alias', None) for wrapper in connection.execute_wrappers):
+        return  # 같은 DatabaseWrapper가 다시 연결된 경우
+    connection.execute_wrappers.append(_measure_queries(connection.alias, replica_health))
+
+
+connection_created.connect(install_latency_wrapper)
+
+
+#
+# router
+#
 class PepupRouter(object):
+    def __init__(self, connections=None, health=None):
+        self.connections = connections or default_connections
+        self.health = health or replica_health
+        self._counter = itertools.count()
+        self._probe_lock = threading.Lock()
+        self._probe_thread = None
+        self._probe_stop = threading.Event()
+
+    def probe(self, alias):
+        started = time.monotonic()
+        try:
+            with self.connections[alias].cursor() as cursor:
+                cursor.execute('SELECT 1')
+        except DatabaseError:
+            logger.warning('replica %s probe failed', alias, exc_info=True)
+            self.health.record_failure(alias)
+            return False
+        self.health.record_success(alias, time.monotonic() - started)
+        return True
+
+    def probe_replicas(self):
+        """
+        제외되지 않은 replica를 한 번씩 probe합니다. (제외된 replica는 EJECT_SECONDS가 지나면 다시 사용합니다)
+        """
+        now = time.monotonic()
+        for alias in get_replica_config().get('ALIASES', ()):
+            if self.health.is_available(alias, now):
+                self.probe(alias)
+
+    def start_probing(self):
+        with self._probe_lock:
+            if self._probe_thread is not None:
+                return
+            interval = get_replica_config().get('PROBE_INTERVAL', DEFAULT_PROBE_INTERVAL)
+            if not interval:
+                self._probe_thread = False
+                return
+            self._probe_stop.clear()
+            self._probe_thread = threading.Thread(target=self._probe_loop, args=(interval,),
+                                                  name='db-replica-probe', daemon=True)
+            self._probe_thread.start()
+
+    def stop_probing(self):
+        with self._probe_lock:
+            thread, self._probe_thread = self._probe_thread, None
+        if thread:
+            self._probe_stop.set()
+            thread.join()
+
+    def _probe_loop(self, interval):
+        while True:
+            try:
+                self.probe_replicas()
+            finally:
+                # thread의 connection은 request처럼 정리되지 않으므로, 매번 닫고 다음 probe에서 다시 연결합니다.
+                for alias in get_replica_config().get('ALIASES', ()):
+                    self.connections[alias].close()
+            if self._probe_stop.wait(interval):
+                return
+
+    def get_available_replicas(self):
+        now = time.monotonic()
+        return [alias for alias in get_replica_config().get('ALIASES', ()) if self.health.is_available(alias, now)]
+
+    def choose_replica(self):
+        """
+        :return: replica alias (사용할 수 있는 replica가 없으면 None)
+        """
+        available = self.get_available_replicas()
+        if not available:
+            return None
+        if get_replica_config().get('STRATEGY', 'round_robin') == 'least_latency':
+            return min(available, key=self.health.latency)
+        return available[next(self._counter) % len(available)]
+
     def db_for_read(self, model, **hints):
-        return 'default'
+        if not get_replica_config().get('ALIASES'):
+            return DEFAULT_DB_ALIAS
+        if self._probe_thread is None:
+            self.start_probing()
+        if self.connections[DEFAULT_DB_ALIAS].in_atomic_block or is_pinned_to_primary():
+            return DEFAULT_DB_ALIAS
+        return self.choose_replica() or DEFAULT_DB_ALIAS
 
     def db_for_write(self, model, **hints):
-        return 'default'
+        if get_replica_config().get('ALIASES'):
+            pin_to_primary()
+        return DEFAULT_DB_ALIAS
 
     def allow_relation(self, obj1, obj2, **hints):
         return True
 
     def allow_migrate(self, db, app_label, model_name=None, **hints):
-        return True
-
+        return db not in get_replica_config().get('ALIASES', ())
@@ -3,9 +3,35 @@ import base64
 import logging
 
 from django.core.exceptions import SuspiciousOperation
+from django.core.signing import JSONSerializer
 from django.utils.encoding import force_bytes, force_text
 from redis_sessions.session import SessionStore as RedisSessionStore
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class MsgpackSerializer(object):
+    """
+    SESSION_SERIALIZER 용 msgpack serializer 입니다. (JSON보다 작고 빠름)
+    - msgpack으로 저장한 값은 MSGPACK_MARKER로 시작하고, 그 외의 값은 JSON으로 읽습니다.
+      따라서 JSONSerializer로 저장된 기존 session도 그대로 읽을 수 있습니다.
+    - msgpack이 설치되어 있지 않으면 JSON으로 저장합니다.
+    """
+    MSGPACK_MARKER = b'\x00mp:'
+
+    def dumps(self, obj):
+        if msgpack is None:
+            return JSONSerializer().dumps(obj)
+        return self.MSGPACK_MARKER + msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data):
+        if data.startswith(self.MSGPACK_MARKER):
+            return msgpack.unpackb(data[len(self.MSGPACK_MARKER):], raw=False)
+        return JSONSerializer().loads(data)
+
 
 class SessionStore(RedisSessionStore):
     """
@@ -0,0 +1,25 @@
+# -*- encoding: utf-8 -*-
+from django.apps import apps
+from django.test.runner import DiscoverRunner
+
+"""
+accounts.User / Profile 은 다른 서비스가 table을 관리하는 unmanaged model(MONDEIQUE_MODEL_MANAGED)입니다.
+test DB에는 그 table이 없으므로, test 동안에만 managed로 바꿔 migrate(syncdb)가 만들게 합니다.
+
+settings 예시:
+    TEST_RUNNER = 'core.test_runner.ManagedModelTestRunner'
+"""
+
+
+class ManagedModelTestRunner(DiscoverRunner):
+
+    def setup_test_environment(self, **kwargs):
+        self.unmanaged_models = [model for model in apps.get_models() if not model._meta.managed]
+        for model in self.unmanaged_models:
+            model._meta.managed = True
+        super(ManagedModelTestRunner, self).setup_test_environment(**kwargs)
+
+    def teardown_test_environment(self, **kwargs):
+        super(ManagedModelTestRunner, self).teardown_test_environment(**kwargs)
+        for model in self.unmanaged_models:
+            model._meta.managed = False
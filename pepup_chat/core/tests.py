@@ -0,0 +1,195 @@
+import base64
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+from django.db.utils import ConnectionHandler
+from django.test import SimpleTestCase, override_settings
+
+from core import cached_session
+from core.routers import PepupRouter, ReplicaHealth, start_pin_scope, use_primary
+from core.session import MsgpackSerializer
+
+REPLICAS = {
+    'ALIASES': ['replica_a', 'replica_b'],
+    'STRATEGY': 'round_robin',
+    'PIN_SECONDS': 60,
+    'PROBE_INTERVAL': 0,
+    'FAILURE_THRESHOLD': 2,
+    'EJECT_SECONDS': 60,
+}
+
+
+@override_settings(DATABASE_REPLICAS=REPLICAS)
+class PepupRouterTest(SimpleTestCase):
+    """
+    replica 두 개를 SQLite 파일로 대신합니다. (replica_b는 열 수 없는 경로로 바꿔 장애를 만듭니다)
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.connections = ConnectionHandler({
+            alias: {'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.path.join(self.tmpdir, alias + '.sqlite3')}
+            for alias in ('default', 'replica_a', 'replica_b')
+        })
+        self.router = PepupRouter(connections=self.connections, health=ReplicaHealth())
+        start_pin_scope()
+
+    def tearDown(self):
+        self.router.stop_probing()
+        self.connections.close_all()
+        shutil.rmtree(self.tmpdir)
+
+    def _break(self, alias):
+        self.connections[alias].close()
+        self.connections[alias].settings_dict['NAME'] = os.path.join(self.tmpdir, 'missing', alias + '.sqlite3')
+
+    def test_round_robin(self):
+        reads = [self.router.db_for_read(None) for _ in range(4)]
+        self.assertEqual(reads, ['replica_a', 'replica_b', 'replica_a', 'replica_b'])
+
+    def test_read_your_writes(self):
+        self.assertEqual(self.router.db_for_write(None), 'default')
+        self.assertEqual(self.router.db_for_read(None), 'default')
+        start_pin_scope()  # 다른 접속
+        self.assertNotEqual(self.router.db_for_read(None), 'default')
+
+    def test_use_primary(self):
+        with use_primary():
+            self.assertEqual(self.router.db_for_read(None), 'default')
+        self.assertNotEqual(self.router.db_for_read(None), 'default')
+
+    def test_failing_replica_is_ejected(self):
+        self._break('replica_b')
+        self.router.probe_replicas()
+        self.assertTrue(self.router.health.is_available('replica_b'))
+        self.router.probe_replicas()
+        self.assertFalse(self.router.health.is_available('replica_b'))
+        reads = [self.router.db_for_read(None) for _ in range(2)]
+        self.assertEqual(reads, ['replica_a', 'replica_a'])
+
+    def test_all_replicas_ejected_falls_back_to_primary(self):
+        self._break('replica_a')
+        self._break('replica_b')
+        self.router.probe_replicas()
+        self.router.probe_replicas()
+        self.assertEqual(self.router.db_for_read(None), 'default')
+
+    def test_read_does_not_probe(self):
+        self._break('replica_b')
+        probed = []
+        self.router.probe = probed.append
+        reads = [self.router.db_for_read(None) for _ in range(4)]
+        self.assertEqual(reads, ['replica_a', 'replica_b', 'replica_a', 'replica_b'])
+        self.assertEqual(probed, [])
+
+    @override_settings(DATABASE_REPLICAS=dict(REPLICAS, PROBE_INTERVAL=0.01))
+    def test_background_probe_ejects_replica(self):
+        self._break('replica_b')
+        self.router.db_for_read(None)
+        deadline = time.monotonic() + 5
+        while self.router.health.is_available('replica_b') and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.router.stop_probing()
+        self.assertFalse(self.router.health.is_available('replica_b'))
+        self.assertTrue(self.router.health.is_available('replica_a'))
+
+    @override_settings(DATABASE_REPLICAS=dict(REPLICAS, STRATEGY='least_latency'))
+    def test_least_latency(self):
+        self.router.health.record_success('replica_a', 0.050)
+        self.router.health.record_success('replica_b', 0.005)
+        self.assertEqual(self.router.db_for_read(None), 'replica_b')
+
+    def test_replicas_are_not_migrated(self):
+        self.assertTrue(self.router.allow_migrate('default', 'chat'))
+        self.assertFalse(self.router.allow_migrate('replica_a', 'chat'))
+
+
+class FakeSessionRedis(object):
+    """
+    session backend가 쓰는 redis 명령만 흉내냅니다. (다른 worker는 같은 instance에 직접 씁니다)
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def ttl(self, key):
+        return 3600 if key in self.values else -2
+
+    def exists(self, key):
+        return key in self.values
+
+    def setex(self, key, expiry, value):
+        self.values[key] = value.encode('utf-8') if isinstance(value, str) else value
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+    def pipeline(self, transaction=True):
+        server, results = self, []
+
+        class Pipeline(object):
+            def get(self, key):
+                results.append(server.get(key))
+
+            def ttl(self, key):
+                results.append(server.ttl(key))
+
+            def execute(self):
+                return list(results)
+
+        return Pipeline()
+
+
+@override_settings(SESSION_SERIALIZER='core.session.MsgpackSerializer', CACHED_SESSION={'TTL': 0})
+class CachedSessionTest(SimpleTestCase):
+    """
+    JSON으로 저장된 기존 session도 읽어야 하고, 다른 worker가 바꾼 session은 stamp가 달라지므로 다시 decode해야 합니다.
+    (TTL 0 이므로 load할 때마다 redis의 값을 확인합니다)
+    """
+
+    def setUp(self):
+        self.redis = FakeSessionRedis()
+        cached_session.decoded_sessions.clear()
+
+    def tearDown(self):
+        cached_session.decoded_sessions.clear()
+
+    def _store(self, session_key='s' * 32):
+        store = cached_session.SessionStore(session_key)
+        store.server = self.redis
+        return store
+
+    def _save_from_other_worker(self, data, serializer_path='core.session.MsgpackSerializer'):
+        # 다른 worker가 redis에 직접 저장한 것과 같습니다. (이 process의 cache는 그대로 둡니다)
+        with self.settings(SESSION_SERIALIZER=serializer_path):
+            store = self._store()
+            self.redis.setex(store.get_real_stored_key(store.session_key), 3600, store.encode(data))
+
+    def test_msgpack_round_trip(self):
+        serialized = MsgpackSerializer().dumps({'_auth_user_id': '1', 'tabs': [1, 2]})
+        self.assertTrue(serialized.startswith(MsgpackSerializer.MSGPACK_MARKER))
+        self.assertEqual(MsgpackSerializer().loads(serialized), {'_auth_user_id': '1', 'tabs': [1, 2]})
+
+    def test_json_session_still_loads(self):
+        self._save_from_other_worker({'_auth_user_id': '1'}, 'django.contrib.sessions.serializers.JSONSerializer')
+        stored = base64.b64decode(self.redis.get(self._store().get_real_stored_key('s' * 32)))
+        self.assertNotIn(MsgpackSerializer.MSGPACK_MARKER, stored)
+        self.assertEqual(self._store().load(), {'_auth_user_id': '1'})
+
+    def test_changed_session_is_decoded_again(self):
+        self._save_from_other_worker({'_auth_user_id': '1'})
+        with mock.patch.object(cached_session.SessionStore, 'decode',
+                               autospec=True, side_effect=cached_session.SessionStore.decode) as decode:
+            self.assertEqual(self._store().load(), {'_auth_user_id': '1'})
+            self.assertEqual(self._store().load(), {'_auth_user_id': '1'})
+            self.assertEqual(decode.call_count, 1)  # 바뀌지 않았으면 stamp가 같으므로 decode하지 않습니다.
+
+            self._save_from_other_worker({'_auth_user_id': '2'})
+            self.assertEqual(self._store().load(), {'_auth_user_id': '2'})
+            self.assertEqual(decode.call_count, 2)
@@ -8,3 +8,13 @@ def get_random_md5():
 
 def get_random_hex_string(digit):
     return binascii.hexlify(os.urandom(digit >> 1))
+
+
+def percentile(sorted_values, q):
+    """
+    정렬된 list에서 q(0~100) percentile 값을 구합니다. (nearest-rank)
+    """
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(q / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[index]
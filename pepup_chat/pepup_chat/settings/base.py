@@ -200,15 +200,47 @@ REST_FRAMEWORK = {
 
 AUTH_USER_MODEL = 'accounts.User'
 
+# unmanaged model(accounts.User 등)의 table도 test DB에 만듭니다. (see core/test_runner.py)
+TEST_RUNNER = 'core.test_runner.ManagedModelTestRunner'
+
 
 # DATABASE CONFIGURATION
 
 DATABASE_ROUTERS = [
     'core.routers.PepupRouter',
 ]
+# Read replicas (see core/routers.py). Each alias must also be defined in DATABASES.
+DATABASE_REPLICAS = {
+    'ALIASES': [],
+    'STRATEGY': 'round_robin',  # or 'least_latency'
+    'PIN_SECONDS': 2.0,  # read-your-writes window after a write on the same connection
+    'PROBE_INTERVAL': 5,
+    'FAILURE_THRESHOLD': 3,
+    'EJECT_SECONDS': 30,
+}
+
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Values every chat worker must see (room state versions, see chat/room_state.py).
+    # - run "manage.py createcachetable" once, or point this alias at a Redis/Memcached cache.
+    'chat_shared': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'chat_shared_cache',
+    },
+}
 
 
 SESSION_ENGINE = "django.contrib.sessions.backends.cache"
+# Redis session backend with a per-process decode cache (see core/cached_session.py):
+#   SESSION_ENGINE = 'core.cached_session'
+#   SESSION_SERIALIZER = 'core.session.MsgpackSerializer'  # still reads sessions stored as JSON
+CACHED_SESSION = {
+    'TTL': 5,  # seconds a decoded session is reused without reading Redis
+    'MAX_ENTRIES': 10000,
+}
 
 
 # Channels
@@ -220,4 +252,166 @@ CHANNEL_LAYERS = {
             "hosts": [('127.0.0.1', 6379)],
         },
     },
-}
\ No newline at end of file
+}
+
+# Chat message search (see chat/search/__init__.py)
+# - 'BACKEND' defaults to the DATABASE's vendor (SQLite FTS5 or PostgreSQL tsvector); set it to override.
+CHAT_SEARCH = {
+    'DATABASE': 'default',
+}
+
+
+# Chat message archive (see chat/archive.py)
+CHAT_ARCHIVE = {
+    'ROOT': os.path.join(BASE_DIR, '../../chat_archive'),
+    'MAX_AGE_DAYS': 180,
+    'BATCH_SIZE': 5000,
+    'SEGMENT_MAX_ROWS': 50000,
+    'SEGMENT_MAX_BYTES': 64 * 1024 * 1024,
+}
+
+
+# Query pattern capture for "manage.py audit_chat_indexes" (see chat/index_audit.py)
+CHAT_QUERY_CAPTURE = {
+    'ENABLED': False,
+    'PATH': os.path.join(BASE_DIR, '../../chat_query_patterns.json'),
+    'SAMPLE_RATE': 0.01,
+    'FLUSH_INTERVAL': 30,
+}
+
+
+# Chat hot-path metrics (see chat/metrics.py)
+CHAT_METRICS = {
+    'EXPORT_ENDPOINT': False,  # GET /metrics/ (Prometheus text format)
+    'SCRAPE_ALLOWED_IPS': ['127.0.0.1'],  # besides staff users and the SCRAPE_TOKEN bearer header
+    'SCRAPE_TOKEN': None,
+    'LOG_INTERVAL': 0,  # seconds; 0 disables the periodic log line
+}
+
+
+# Rendered buttons/carousel/header template cache (see chat/message_models.py)
+CHAT_TEMPLATE_CACHE = {
+    'MAX_SIZE': 1024,  # number of distinct rendered templates kept per process
+}
+
+
+# Template broadcast to many rooms (see chat/broadcast.py)
+CHAT_BROADCAST = {
+    'CHUNK_SIZE': 500,  # rooms per bulk insert
+    'CONCURRENCY': 50,  # in-flight group_send calls
+}
+
+
+# Cached user cards for message serialization (see chat/user_cards.py)
+# - 'CACHE' should point to a Redis-backed cache alias in production so cards are shared between processes.
+CHAT_USER_CARD = {
+    'CACHE': 'default',
+    'TTL': 300,  # seconds, shared cache
+    'LOCAL_TTL': 10,  # seconds, per-process LRU
+    'LOCAL_MAX_ENTRIES': 10000,
+}
+
+
+# DB connection pool for chat workers (see chat/db_pool.py)
+# - 켜면 database_sync_to_async 가 SIZE개 thread의 executor에서 실행되고, thread마다 connection을 CONN_MAX_AGE초 유지합니다.
+# - daphne/runworker 같은 chat worker process에서만 켜세요.
+CHAT_DB_POOL = {
+    'ENABLED': False,
+    'SIZE': 16,  # threads == persistent connections per alias
+    'ALIASES': None,  # None: every alias in DATABASES
+    'CONN_MAX_AGE': 300,  # seconds
+    'HEALTH_CHECK_IDLE': 30,  # seconds idle before a connection is checked with is_usable()
+    'REAP_INTERVAL': 30,  # seconds; closes connections left by finished threads
+}
+
+
+# Separate executor pools for consumer ORM work (see chat/executors.py)
+CHAT_EXECUTORS = {
+    'POOLS': {'write': 8, 'read': 16, 'auth': 4},  # threads per pool
+}
+
+
+# Inbound frame rate limiting (see chat/ratelimit.py)
+# - POLICIES : frame type -> scope -> (tokens per second, burst). user/room buckets are shared through Redis.
+CHAT_RATE_LIMIT = {
+    'ENABLED': True,
+    'POLICIES': {
+        'text': {'connection': (5, 10), 'user': (5, 20), 'room': (50, 200)},
+        'postback': {'connection': (2, 5), 'user': (2, 10), 'room': (20, 100)},
+        'status': {'connection': (10, 20), 'user': (10, 40), 'room': (100, 300)},
+    },
+    'LEASE_SECONDS': 1.0,  # tokens taken from Redis at once = rate * LEASE_SECONDS
+    'CLOSE_AFTER_REJECTIONS': 50,  # consecutive rejected frames before the connection is closed
+    'KEY_PREFIX': 'chat:ratelimit',
+}
+
+
+# Multiplexed websocket endpoint "ws/chat/" (see chat/consumers.py MultiplexChatConsumer)
+CHAT_MULTIPLEX = {
+    'MAX_ROOMS': 100,  # subscribed rooms per connection
+    'CONTROL_RATE': (5, 50),  # subscribe/unsubscribe frames: (per second, burst)
+}
+
+
+# Versioned room states sent as JSON-patch deltas (see chat/room_state.py)
+# - 'CACHE' must be shared by every chat worker; process-local caches fail the chat.E001 system check.
+CHAT_ROOM_STATE = {
+    'CACHE': 'chat_shared',
+    'TTL': 86400,  # seconds
+    'LOCK_TIMEOUT': 2.0,  # seconds; per-state lock around the version bump
+}
+
+
+# Heartbeat fast path and idle timeout (see chat/heartbeat.py)
+# - IDLE_TIMEOUT초 동안 frame이 없으면 server ping, 그 뒤 PING_GRACE초 안에도 없으면 접속을 닫습니다. (0이면 끔)
+CHAT_HEARTBEAT = {
+    'IDLE_TIMEOUT': 60,
+    'PING_GRACE': 10,
+    'TICK': 1.0,
+}
+
+
+# Write-behind message persistence (see chat/journal.py)
+# - 켜면 사용자 메세지는 local journal에 기록된 뒤 바로 전송되고, DB에는 FLUSH_INTERVAL 이내에 저장됩니다.
+# - 'ROOT'는 process 재시작 후에도 남는 local disk 경로여야 합니다. (죽은 process의 journal은 다음 process가 replay)
+CHAT_JOURNAL = {
+    'ENABLED': False,
+    'ROOT': os.path.join(BASE_DIR, '../../chat_journal'),
+    'FLUSH_INTERVAL': 0.5,  # seconds
+    'BATCH_SIZE': 500,
+    'FSYNC': True,
+}
+
+
+# Chat logging (see chat/log.py)
+# - 'chat' logger의 handler는 AppConfig.ready 에서 background thread(QueueListener)로 옮겨집니다.
+# - 실제 level 판단은 CHAT_LOG 에서 하므로, logger level은 DEBUG로 열어둡니다.
+CHAT_LOG = {
+    'LEVEL': 'INFO',
+    'ROOM_LEVELS': {},
+    'SAMPLE_RATES': {'DEBUG': 0.01},
+    'QUEUE_SIZE': 10000,
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'structured': {
+            '()': 'chat.log.StructuredFormatter',
+        },
+    },
+    'handlers': {
+        'chat_console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'structured',
+        },
+    },
+    'loggers': {
+        'chat': {
+            'handlers': ['chat_console'],
+            'level': 'DEBUG',
+            'propagate': False,
+        },
+    },
+}
@@ -1,12 +1,14 @@
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
+
+from chat.executors import PooledAuthMiddlewareStack
 
 import chat.routing
 
 # 클라이언트와 Channels 개발 서버가 연결 될 때, 어느 protocol 타입의 연결인지
 application = ProtocolTypeRouter({
     # (http->django views is added by default)
-    'websocket': AuthMiddlewareStack(
+    # user 조회는 'auth' executor pool에서 실행됩니다. (chat/executors.py)
+    'websocket': PooledAuthMiddlewareStack(
         URLRouter(
             chat.routing.websocket_urlpatterns
         )